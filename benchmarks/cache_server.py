@@ -0,0 +1,256 @@
+''' Local stand-in for the spacetime cache server.
+
+    python -m benchmarks.cache_server [--port 9000] [--latency 0.05] ...
+    python3 launch.py --cache_server 127.0.0.1:9000
+
+Speaks the cache protocol: GET /?q=<url>&u=<agent> returns a cbor dict with
+the url, the status and a pickled requests.Response, the format decoded by
+utils/download.py and utils/response.py. Serves either a synthetic site
+graph over the seed hosts or pages recorded in a jsonl file. '''
+import json
+import pickle
+import posixpath
+import random
+import time
+import zlib
+
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import cbor
+import requests
+
+from benchmarks.corpus import synthetic_page, vocabulary
+
+SEED_HOSTS = (
+    "www.ics.uci.edu", "www.cs.uci.edu", "www.informatics.uci.edu",
+    "www.stat.uci.edu")
+
+
+class SyntheticSite(object):
+    ''' A deterministic site graph. Every host has pages_per_host pages at
+    /page/<n>.html linking mostly within the host, plus pdf links and
+    unknown urls (404). A trap_rate fraction of pages also links into an
+    endless /archive/<n> chain of nearly identical pages. An alias_rate
+    fraction of page links is spelled another way (default port, dot
+    segment, tracking parameter) that serves the same page. With robots,
+    every host has a robots.txt disallowing /missing/ and a sitemap listing
+    all its pages. '''
+
+    def __init__(
+            self, hosts=SEED_HOSTS, pages_per_host=200, out_links=20,
+            trap_rate=0.05, seed=0, alias_rate=0.0, robots=False):
+        self.hosts = hosts
+        self.pages_per_host = pages_per_host
+        self.out_links = out_links
+        self.trap_rate = trap_rate
+        self.alias_rate = alias_rate
+        self.robots = robots
+        self.seed = seed
+        self.words = vocabulary(random.Random(seed), 5000)
+
+    def seeds(self):
+        return [f"https://{host}" for host in self.hosts]
+
+    def _rng(self, url):
+        return random.Random(zlib.crc32(url.encode("utf-8")) ^ self.seed)
+
+    def _links(self, rng, host):
+        links = list()
+        for _ in range(self.out_links):
+            roll = rng.random()
+            if roll < 0.75:
+                target = host
+            else:
+                target = rng.choice(self.hosts)
+            page = f"/page/{rng.randrange(self.pages_per_host)}.html"
+            if self.alias_rate and rng.random() < self.alias_rate:
+                links.append(rng.choice((
+                    f"https://{target.upper()}:443{page}",
+                    f"https://{target}/./page/../page{page[5:]}",
+                    f"https://{target}{page}?utm_source=feed")))
+            else:
+                links.append(f"https://{target}{page}")
+        links.append(f"/files/report{rng.randrange(100)}.pdf")
+        links.append(f"/missing/{rng.randrange(1000)}.html")
+        if rng.random() < self.trap_rate:
+            links.append(f"/archive/{rng.randrange(10)}")
+        return links
+
+    def page(self, url):
+        ''' Returns (status, content type, body) for url. '''
+        parsed = urlparse(url)
+        host = parsed.hostname or ""
+        path = posixpath.normpath(parsed.path or "/").rstrip("/")
+        if host not in self.hosts:
+            return 404, "text/html", b"<html>Not found</html>"
+        # Every spelling of a page is the same page.
+        rng = self._rng(f"https://{host}{path}")
+        if self.robots and path == "/robots.txt":
+            return 200, "text/plain", (
+                f"User-agent: *\nDisallow: /missing/\n\n"
+                f"Sitemap: https://{host}/sitemap.xml\n").encode("utf-8")
+        if self.robots and path == "/sitemap.xml":
+            locs = "".join(
+                f"<url><loc>https://{host}/page/{n}.html</loc></url>"
+                for n in range(self.pages_per_host))
+            return 200, "application/xml", (
+                '<?xml version="1.0" encoding="UTF-8"?><urlset xmlns='
+                f'"http://www.sitemaps.org/schemas/sitemap/0.9">{locs}</urlset>'
+            ).encode("utf-8")
+        if path.startswith("/files/"):
+            return 200, "application/pdf", b"%PDF-1.4 " + b"\0" * 2048
+        if path.startswith("/archive/"):
+            n = int(path.rsplit("/", 1)[1] or 0)
+            # Same text on every archive page, only the next link differs.
+            words = self.words[:40]
+            hrefs = [f"/archive/{n + 1}", f"/archive/{n + 1}?view=print"]
+            return 200, "text/html", synthetic_page(
+                random.Random(self.seed), paragraphs=10, words=words,
+                hrefs=hrefs)
+        if path.startswith("/page/") or not path:
+            # Each page draws from its own slice of the vocabulary.
+            start = rng.randrange(len(self.words) - 300)
+            return 200, "text/html; charset=utf-8", synthetic_page(
+                rng, paragraphs=rng.randrange(5, 40),
+                words=self.words[start:start + 300],
+                hrefs=self._links(rng, host))
+        return 404, "text/html", b"<html>Not found</html>"
+
+
+class RecordedSite(object):
+    ''' Pages from a jsonl file of {"url", "status", "content_type", "body"}.
+    Any other url is a 404. '''
+
+    def __init__(self, path):
+        self.pages = dict()
+        with open(path, encoding="utf-8") as recorded:
+            for line in recorded:
+                page = json.loads(line)
+                self.pages[page["url"]] = (
+                    page.get("status", 200),
+                    page.get("content_type", "text/html"),
+                    page["body"].encode("utf-8"))
+
+    def seeds(self):
+        return list(self.pages)[:1]
+
+    def page(self, url):
+        return self.pages.get(url, (404, "text/html", b"<html>Not found</html>"))
+
+
+def pickled_response(url, status, content_type, body):
+    resp = requests.models.Response()
+    resp.status_code = status
+    resp.url = url
+    resp._content = body
+    resp._content_consumed = True
+    resp.headers["Content-Type"] = content_type
+    resp.headers["Content-Length"] = str(len(body))
+    resp.encoding = "utf-8"
+    return pickle.dumps(resp)
+
+
+def make_handler(site, latency=0.0, jitter=0.0, error_rate=0.0,
+                 unavailable_rate=0.0, struggling_host=None,
+                 struggling_latency=0.0, struggling_error_rate=0.0):
+    ''' error_rate: fraction of fetches answered with an origin 500 page.
+    unavailable_rate: fraction answered with HTTP 503 by the cache itself,
+    which the downloader retries. struggling_host gets struggling_latency
+    more latency and struggling_error_rate more origin errors. '''
+
+    class CacheHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body=b""):
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            if "q" not in query or "u" not in query:
+                self._send(400)
+                return
+            url = query["q"][0]
+            struggling = (
+                struggling_host is not None
+                and urlparse(url).netloc == struggling_host)
+            if latency or jitter:
+                time.sleep(max(0.0, random.gauss(latency, jitter)))
+            if struggling and struggling_latency:
+                time.sleep(struggling_latency)
+            if random.random() < unavailable_rate:
+                self._send(503)
+                return
+            if (random.random() < error_rate
+                    or struggling and random.random() < struggling_error_rate):
+                status, content_type, body = (
+                    500, "text/html", b"<html>Internal Server Error</html>")
+            else:
+                status, content_type, body = site.page(url)
+            self._send(200, cbor.dumps({
+                "url": url, "status": status,
+                "response": pickled_response(url, status, content_type, body)}))
+
+    return CacheHandler
+
+
+def serve(site, host="127.0.0.1", port=0, ready=None, **behaviour):
+    ''' Serves forever. Puts the bound (host, port) on the ready queue. '''
+    server = ThreadingHTTPServer((host, port), make_handler(site, **behaviour))
+    server.daemon_threads = True
+    if ready is not None:
+        ready.put(server.server_address)
+    server.serve_forever()
+
+
+def add_site_arguments(parser):
+    parser.add_argument("--recorded", type=str, default=None)
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--out_links", type=int, default=20)
+    parser.add_argument("--trap_rate", type=float, default=0.05)
+    parser.add_argument("--alias_rate", type=float, default=0.0)
+    parser.add_argument("--robots", action="store_true", default=False)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--unavailable_rate", type=float, default=0.0)
+    parser.add_argument("--struggling_host", type=str, default=None)
+    parser.add_argument("--struggling_latency", type=float, default=0.0)
+    parser.add_argument("--struggling_error_rate", type=float, default=0.0)
+
+
+def site_from_arguments(args):
+    if args.recorded:
+        return RecordedSite(args.recorded)
+    return SyntheticSite(
+        pages_per_host=args.pages, out_links=args.out_links,
+        trap_rate=args.trap_rate, alias_rate=args.alias_rate,
+        robots=args.robots)
+
+
+def behaviour_from_arguments(args):
+    return dict(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        unavailable_rate=args.unavailable_rate,
+        struggling_host=args.struggling_host,
+        struggling_latency=args.struggling_latency,
+        struggling_error_rate=args.struggling_error_rate)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    add_site_arguments(parser)
+    args = parser.parse_args()
+    site = site_from_arguments(args)
+    print(f"Serving {', '.join(site.seeds())} on {args.host}:{args.port}")
+    serve(site, args.host, args.port, **behaviour_from_arguments(args))
@@ -0,0 +1,99 @@
+import os
+import random
+
+WORDS = (
+    "research faculty student course lecture computer science informatics "
+    "statistics machine learning data systems network security software "
+    "graduate undergraduate seminar project lab paper publication award "
+    "department school university irvine california news event professor "
+    "algorithm theory database vision language graphics health design").split()
+
+HOSTS = (
+    "www.ics.uci.edu", "www.cs.uci.edu", "www.informatics.uci.edu",
+    "www.stat.uci.edu", "vision.ics.uci.edu", "wics.ics.uci.edu")
+
+
+SYLLABLES = (
+    "ba be bi bo bu ka ke ki ko ku la le li lo lu ma me mi mo mu na ne ni no "
+    "nu ra re ri ro ru sa se si so su ta te ti to tu va ve vi vo vu").split()
+
+
+def vocabulary(rng, size):
+    ''' size distinct pseudo-words, so pages drawn from different slices do
+    not look like near duplicates of each other. '''
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choices(SYLLABLES, k=rng.randrange(2, 5))))
+    return sorted(words)
+
+
+def synthetic_page(rng, paragraphs=40, links=60, words=WORDS, hrefs=None):
+    ''' Returns html bytes shaped like a department page: nav links, script
+    and style blocks, paragraphs with inline links and some non-ascii.
+    Body text is drawn from words; hrefs replaces the random nav links. '''
+    parts = [
+        "<!DOCTYPE html><html><head><meta charset='utf-8'>",
+        "<title>", " ".join(rng.choices(words, k=5)), "</title>",
+        "<style>body { font-family: sans-serif; } .nav a { color: #036; }</style>",
+        "<script>var pages = ['a', 'b']; function go(x) { return x; }</script>",
+        "</head><body><div class='nav'>"]
+    for i in range(links if hrefs is None else 0):
+        host = rng.choice(HOSTS)
+        if i % 3 == 0:
+            href = f"/{rng.choice(WORDS)}/{rng.randrange(1000)}.html"
+        elif i % 3 == 1:
+            href = f"https://{host}/{rng.choice(WORDS)}/?id={rng.randrange(50)}"
+        else:
+            href = f"https://{host}/~{rng.choice(WORDS)}/#section{i}"
+        parts.append(f"<a href='{href}'>{rng.choice(WORDS)}</a> ")
+    for href in hrefs or ():
+        parts.append(f"<a href='{href}'>{rng.choice(words)}</a> ")
+    parts.append("</div><main>")
+    for _ in range(paragraphs):
+        text = rng.choices(words, k=rng.randrange(20, 120))
+        text.insert(rng.randrange(len(text)), "café naïve")
+        parts.append(f"<p>{' '.join(text)} <b>{rng.randrange(2024)}</b></p>")
+    parts.append("<noscript>Enable javascript</noscript></main></body></html>")
+    return "".join(parts).encode("utf-8")
+
+
+def load_pages(directory=None, count=200, seed=0):
+    ''' Recorded pages from directory (*.html), or synthetic ones. '''
+    if directory:
+        pages = list()
+        for name in sorted(os.listdir(directory)):
+            if name.endswith((".html", ".htm")):
+                with open(os.path.join(directory, name), "rb") as page:
+                    pages.append(page.read())
+        return pages
+    rng = random.Random(seed)
+    return [synthetic_page(rng) for _ in range(count)]
+
+
+def trap_urls(rng, count=5000):
+    ''' Urls as found on pages of the allowed domains: plain pages mixed
+    with the traps URL_RULES and the trap detector are there for
+    (calendars, wiki actions, session ids, paging, gitlab history, deep or
+    repeating paths), files, other domains and odd spellings. '''
+    makers = (
+        lambda host: f"https://{host}/{rng.choice(WORDS)}/{rng.randrange(500)}.html",
+        lambda host: f"https://{host}/~{rng.choice(WORDS)}/",
+        lambda host: f"https://{host}/people/{rng.choice(WORDS)}?id={rng.randrange(99)}",
+        lambda host: (
+            f"https://{host}/events/{rng.randrange(2000, 2030)}-"
+            f"{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}/"),
+        lambda host: f"https://{host}/events/month/?tribe-bar-date={rng.randrange(2000, 2030)}-01",
+        lambda host: f"https://{host}/wiki/doku.php?id={rng.choice(WORDS)}&do=diff&rev={rng.randrange(10**9)}",
+        lambda host: f"https://{host}/news/?page={rng.randrange(1000)}",
+        lambda host: f"https://{host}/list?sort={rng.choice(WORDS)}&filter={rng.choice(WORDS)}",
+        lambda host: f"https://{host}/app;jsessionid={rng.getrandbits(64):x}",
+        lambda host: "https://gitlab.ics.uci.edu/group/project/-/commits/" + (
+            f"{rng.getrandbits(160):040x}"),
+        lambda host: f"https://{host}/" + "/".join(
+            rng.choice(("a", "b", "c")) for _ in range(rng.randrange(4, 12))),
+        lambda host: f"https://{host}/files/{rng.choice(WORDS)}.{rng.choice(('pdf', 'zip', 'pptx', 'jpg'))}",
+        lambda host: f"https://www.{rng.choice(WORDS)}.com/{rng.choice(WORDS)}",
+        lambda host: f"HTTPS://{host.upper()}:443/./{rng.choice(WORDS)}/index.html?utm_source=x",
+        lambda host: f"mailto:{rng.choice(WORDS)}@{host}",
+    )
+    return [rng.choice(makers)(rng.choice(HOSTS)) for _ in range(count)]
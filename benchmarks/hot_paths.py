@@ -0,0 +1,366 @@
+''' Microbenchmarks of the per url and per page hot paths, with baselines.
+
+    python -m benchmarks.hot_paths run [--out before.json] [--quick]
+    python -m benchmarks.hot_paths run --out after.json --compare before.json
+    python -m benchmarks.hot_paths compare before.json after.json
+
+Runs offline from a scratch directory on fixtures: pages of the synthetic
+site served by benchmarks/cache_server.py (or captured pages, --pages DIR),
+a url list rich in traps (benchmarks/corpus.py) and a frontier preloaded
+with --frontier urls. For every function it reports ops/sec (best of
+--repeat rounds after a warm-up round), and from one more round under
+tracemalloc the peak memory allocated above the start and what was still
+allocated after it. compare flags functions that got slower or allocate
+more by over --threshold, and exits with status 1 if any did. '''
+import copy
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from argparse import ArgumentParser
+from configparser import ConfigParser
+
+from benchmarks.cache_server import SyntheticSite
+from benchmarks.corpus import load_pages, trap_urls
+
+CONFIG_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.ini")
+# Urls added or completed per round by the frontier benchmarks.
+FRONTIER_BATCH = 2000
+
+CASES = dict()
+
+
+def case(name):
+    ''' Registers make(fixtures) -> (ops per round, run round, setup or
+    None). setup runs untimed before every round. '''
+    def register(make):
+        CASES[name] = make
+        return make
+    return register
+
+
+class Fixtures(object):
+    def __init__(self, args):
+        cparser = ConfigParser()
+        cparser.read(CONFIG_FILE)
+        cparser["LOCAL PROPERTIES"]["SAVE"] = "frontier.shelve"
+        cparser["CRAWLER"]["ROBOTS_TTL"] = "0"
+        from utils.config import Config
+        self.config = Config(cparser)
+        self.frontier_size = max(args.frontier, FRONTIER_BATCH)
+        self.frontiers = list()
+
+        rng = random.Random(0)
+        self.urls = trap_urls(rng, args.urls)
+        if args.pages:
+            self.pages = [
+                (f"https://www.ics.uci.edu/captured/{i}.html", content)
+                for i, content in enumerate(load_pages(args.pages))]
+        else:
+            site = SyntheticSite(pages_per_host=max(1, args.count // 4))
+            self.pages = [
+                (url, site.page(url)[2])
+                for url in (
+                    f"https://{host}/page/{n}.html"
+                    for n in range(site.pages_per_host)
+                    for host in site.hosts)]
+        from utils.archive import ArchivedRaw
+        from utils.response import Response
+        self.responses = list()
+        for url, content in self.pages:
+            resp = Response({"url": url, "status": 200})
+            resp.raw_response = ArchivedRaw(
+                url, content, {"Content-Type": "text/html; charset=utf-8"})
+            self.responses.append((url, resp))
+
+
+@case("scraper.is_valid")
+def _is_valid(fixtures):
+    # Every url evaluated by the rules, as the first time it is found.
+    import scraper
+    from url_filter import UrlFilter
+    urls = fixtures.urls
+
+    def run():
+        url_filter = UrlFilter(scraper.URL_RULES)
+        for url in urls:
+            url_filter.is_valid(url)
+    return len(urls), run, None
+
+
+@case("scraper.is_valid (cached)")
+def _is_valid_cached(fixtures):
+    import scraper
+    from url_filter import UrlFilter
+    urls = fixtures.urls
+    url_filter = UrlFilter(scraper.URL_RULES)
+    for url in urls:
+        url_filter.is_valid(url)
+
+    def run():
+        for url in urls:
+            url_filter.is_valid(url)
+    return len(urls), run, None
+
+
+@case("canonical_url")
+def _canonical_url(fixtures):
+    from utils.canonical import canonical_url
+    urls = fixtures.urls
+
+    def run():
+        for url in urls:
+            canonical_url(url)
+    return len(urls), run, None
+
+
+@case("parse_document")
+def _parse_document(fixtures):
+    from document import parse_document
+    pages = fixtures.pages
+
+    def run():
+        for url, content in pages:
+            parse_document(url, content)
+    return len(pages), run, None
+
+
+@case("tokenizer.tokenize_text")
+def _tokenize_text(fixtures):
+    from document import parse_document
+    from tokenizer import tokenize_text
+    texts = [parse_document(url, content).text for url, content in fixtures.pages]
+
+    def run():
+        for text in texts:
+            tokenize_text(text)
+    return len(texts), run, None
+
+
+@case("word_stats.update_from_html")
+def _update_from_html(fixtures):
+    import word_stats
+    pages = fixtures.pages
+
+    def run():
+        for url, content in pages:
+            word_stats.update_from_html(url, content)
+    return len(pages), run, word_stats.reset
+
+
+@case("scraper.extract_next_links")
+def _extract_next_links(fixtures):
+    # Parse, tokenize, duplicate check, trap scoring and stats of each page,
+    # against empty crawl state every round.
+    import scraper
+    import word_stats
+    responses = fixtures.responses
+
+    def setup():
+        scraper.duplicates.close()
+        scraper.duplicates.configure(fixtures.config, True)
+        scraper.traps.configure(fixtures.config, True)
+        word_stats.reset()
+
+    def run():
+        for url, resp in responses:
+            scraper.extract_next_links(url, resp)
+    return len(responses), run, setup
+
+
+def _frontier(fixtures):
+    from crawler.frontier import Frontier
+    config = copy.copy(fixtures.config)
+    config.save_file = f"frontier-{len(fixtures.frontiers)}.shelve"
+    frontier = Frontier(config, True)
+    fixtures.frontiers.append(frontier)
+    rng = random.Random(1)
+    urls = [
+        f"https://{rng.choice(('www', 'vision', 'wics'))}.ics.uci.edu/"
+        f"p/{i}/{rng.getrandbits(32):x}.html"
+        for i in range(fixtures.frontier_size)]
+    for start in range(0, len(urls), 1000):
+        frontier.add_urls(urls[start:start + 1000])
+    return frontier, urls
+
+
+@case("Frontier.add_url")
+def _add_url(fixtures):
+    # Half of the urls were seen before, as on a typical page.
+    frontier, known = _frontier(fixtures)
+    rounds = iter(range(10 ** 9))
+    batch = list()
+
+    def setup():
+        n = next(rounds)
+        batch[:] = [
+            url for i in range(FRONTIER_BATCH // 2)
+            for url in (
+                f"https://www.ics.uci.edu/new/{n}/{i}.html",
+                known[(n * FRONTIER_BATCH + i) % len(known)])]
+
+    def run():
+        for url in batch:
+            frontier.add_url(url)
+    return FRONTIER_BATCH, run, setup
+
+
+@case("Frontier.mark_url_complete")
+def _mark_url_complete(fixtures):
+    frontier, known = _frontier(fixtures)
+    rounds = iter(range(10 ** 9))
+    batch = list()
+
+    def setup():
+        start = next(rounds) * FRONTIER_BATCH % (
+            len(known) - FRONTIER_BATCH + 1)
+        batch[:] = known[start:start + FRONTIER_BATCH]
+
+    def run():
+        for url in batch:
+            frontier.mark_url_complete(url)
+    return FRONTIER_BATCH, run, setup
+
+
+def measure(make, fixtures, repeat):
+    ops, run, setup = make(fixtures)
+    timings = list()
+    # The first round warms caches and imports and is not counted.
+    for _ in range(repeat + 1):
+        if setup:
+            setup()
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    if setup:
+        setup()
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    run()
+    gc.collect()
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    timings = sorted(timings[1:])
+    best = timings[0]
+    return {
+        "ops": ops,
+        "ops_per_s": round(ops / best, 1),
+        "us_per_op": round(best / ops * 1e6, 3),
+        "median_us_per_op": round(timings[len(timings) // 2] / ops * 1e6, 3),
+        "peak_kb": round((peak - before) / 1024, 1),
+        "retained_kb": round((after - before) / 1024, 1)}
+
+
+def run(args):
+    # Logs, rejected urls and save files go to a scratch directory.
+    os.chdir(tempfile.mkdtemp(prefix="hot-paths-"))
+    fixtures = Fixtures(args)
+    results = dict()
+    for name, make in CASES.items():
+        if args.only and not any(part in name for part in args.only):
+            continue
+        results[name] = measure(make, fixtures, args.repeat)
+        result = results[name]
+        print(f"{name:32s} {result['ops_per_s']:>12,.0f} ops/s "
+              f"{result['us_per_op']:>10.2f} us/op "
+              f"{result['peak_kb']:>10,.0f} KB peak "
+              f"{result['retained_kb']:>10,.0f} KB retained", flush=True)
+    for frontier in fixtures.frontiers:
+        frontier.close()
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "pages": len(fixtures.pages),
+            "captured": bool(args.pages),
+            "urls": len(fixtures.urls),
+            "frontier": fixtures.frontier_size,
+            "repeat": args.repeat},
+        "results": results}
+
+
+def compare(before, after, threshold):
+    ''' Prints the change of every function in both runs. Returns the names
+    of those slower, or allocating more, by over threshold. '''
+    regressions = list()
+    print(f"{'function':32s} {'ops/s before':>13s} {'after':>13s} "
+          f"{'change':>8s} {'peak KB':>9s} {'change':>8s}")
+    for name, old in before["results"].items():
+        new = after["results"].get(name)
+        if new is None:
+            continue
+        speed = new["ops_per_s"] / old["ops_per_s"] - 1
+        memory = (new["peak_kb"] - old["peak_kb"]) / max(old["peak_kb"], 1.0)
+        regressed = speed < -threshold or memory > threshold
+        if regressed:
+            regressions.append(name)
+        print(f"{name:32s} {old['ops_per_s']:>13,.0f} {new['ops_per_s']:>13,.0f} "
+              f"{speed:>+8.1%} {new['peak_kb']:>9,.0f} {memory:>+8.1%}"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def load(path):
+    with open(path) as results:
+        return json.load(results)
+
+
+def main():
+    parser = ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--out", type=str, default=None)
+    run_parser.add_argument("--compare", type=str, default=None)
+    run_parser.add_argument("--threshold", type=float, default=0.1)
+    run_parser.add_argument("--only", type=str, nargs="*", default=None)
+    run_parser.add_argument("--pages", type=str, default=None)
+    run_parser.add_argument("--count", type=int, default=200)
+    run_parser.add_argument("--urls", type=int, default=5000)
+    run_parser.add_argument("--frontier", type=int, default=100000)
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("--quick", action="store_true", default=False)
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("before", type=str)
+    compare_parser.add_argument("after", type=str)
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        regressions = compare(
+            load(args.before), load(args.after), args.threshold)
+    else:
+        if args.quick:
+            args.count, args.urls = min(args.count, 40), min(args.urls, 1000)
+            args.frontier = min(args.frontier, 10000)
+            args.repeat = min(args.repeat, 3)
+        paths = [
+            os.path.abspath(path) if path else None
+            for path in (args.out, args.compare, args.pages)]
+        args.out, args.compare, args.pages = paths
+        results = run(args)
+        if args.out:
+            with open(args.out, "w") as out:
+                json.dump(results, out, indent=1)
+            print(f"Saved to {args.out}.")
+        regressions = list()
+        if args.compare:
+            print()
+            regressions = compare(load(args.compare), results, args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} regressed over {args.threshold:.0%}: "
+              f"{', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+''' Per-page parse timings: the old three BeautifulSoup parses per page
+against the single streaming parse in document.py.
+
+    python -m benchmarks.parse_bench [--pages DIR] [--count N]
+
+Needs beautifulsoup4 for the "before" column only. '''
+import time
+
+from argparse import ArgumentParser
+from urllib.parse import urljoin, urldefrag, urlparse
+
+from benchmarks.corpus import load_pages
+from document import parse_document
+from tokenizer import tokenize_text
+
+BASE = "https://www.ics.uci.edu/index.html"
+
+
+def old_links(content):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(content, "lxml")
+    out_links, seen_on_page = list(), set()
+    for a in soup.find_all("a", href=True):
+        href = (a.get("href") or "").strip()
+        if not href:
+            continue
+        abs_url, _ = urldefrag(urljoin(BASE, href))
+        p = urlparse(abs_url)
+        if p.netloc:
+            abs_url = p._replace(netloc=p.netloc.lower()).geturl()
+        if abs_url not in seen_on_page:
+            seen_on_page.add(abs_url)
+            out_links.append(abs_url)
+    return out_links
+
+
+def old_text(content):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(content, "lxml")
+    for tag in soup(["script", "style", "noscript"]):
+        tag.decompose()
+    return soup.get_text(separator=" ", strip=True)
+
+
+def old_pipeline(content):
+    # extract_next_links parsed once for links and update_from_html was
+    # called twice for valid pages.
+    links = old_links(content)
+    old_text(content)
+    return links, old_text(content)
+
+
+def new_pipeline(content):
+    doc = parse_document(BASE, content)
+    return doc.links, doc.text
+
+
+def per_page_ms(pipeline, pages, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for content in pages:
+            pipeline(content)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000 / len(pages)
+
+
+def main(pages_dir, count, repeat):
+    pages = load_pages(pages_dir, count)
+    mismatched = 0
+    for content in pages:
+        old_out, new_out = old_pipeline(content), new_pipeline(content)
+        if (old_out[0] != new_out[0]
+                or tokenize_text(old_out[1]) != tokenize_text(new_out[1])):
+            mismatched += 1
+    before = per_page_ms(old_pipeline, pages, repeat)
+    after = per_page_ms(new_pipeline, pages, repeat)
+    print(f"pages: {len(pages)} ({'recorded' if pages_dir else 'synthetic'}), "
+          f"avg size {sum(map(len, pages)) // len(pages)} bytes")
+    print(f"before (3 BeautifulSoup parses): {before:.3f} ms/page")
+    print(f"after  (1 streaming lxml parse): {after:.3f} ms/page")
+    print(f"speedup: {before / after:.1f}x, "
+          f"pages with different links or tokens: {mismatched}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--pages", type=str, default=None)
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    main(args.pages, args.count, args.repeat)
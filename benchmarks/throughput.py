@@ -0,0 +1,118 @@
+''' End-to-end crawl benchmark against the local stand-in cache server.
+
+    python -m benchmarks.throughput --threads 4 --politeness 0.05 --latency 0.02
+
+Starts benchmarks/cache_server.py in a separate process and runs the crawl
+launch.py runs (launch.crawl: analytics, Frontier, the Worker for
+DOWNLOAD_MODE with its parse stage and archive) against it from a scratch
+directory. Workers are only subclassed to stop after --max_pages downloads
+and to time process(). Reports pages/sec, the p50/p99 latency of each stage
+recorded in utils/metrics.py and peak RSS. Needs no network and no cache
+server registration. '''
+import os
+import resource
+import tempfile
+import time
+
+from argparse import ArgumentParser
+from configparser import ConfigParser
+from multiprocessing import Process, Queue
+from threading import Lock
+
+from benchmarks.cache_server import (
+    serve, add_site_arguments, site_from_arguments, behaviour_from_arguments)
+from utils.config import Config
+from utils.metrics import metrics
+import launch
+
+CONFIG_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.ini")
+
+
+class PageBudget(object):
+    def __init__(self, max_pages):
+        self.max_pages = max_pages
+        self.pages = 0
+        self.lock = Lock()
+
+    def take_page(self):
+        ''' False once the page budget is used up. '''
+        with self.lock:
+            if self.max_pages and self.pages >= self.max_pages:
+                return False
+            self.pages += 1
+            return True
+
+
+def timed_worker_factory(base, budget):
+    class TimedWorker(base):
+        ''' The crawler's worker, stopping the crawl once the budget of
+        downloads is used up and timing what happens to each page. '''
+
+        def record_download(self, tbd_url, resp, start):
+            super().record_download(tbd_url, resp, start)
+            if not budget.take_page():
+                # Workers finish the urls they have and exit.
+                self.frontier.stop()
+
+        def process(self, tbd_url, resp):
+            with metrics.timer("process"):
+                return super().process(tbd_url, resp)
+
+    return TimedWorker
+
+
+def start_cache_server(args):
+    ready = Queue()
+    server = Process(
+        target=serve, args=(site_from_arguments(args),),
+        kwargs=dict(ready=ready, **behaviour_from_arguments(args)),
+        daemon=True)
+    server.start()
+    return server, ready.get(timeout=30)
+
+
+def run(args):
+    server, address = start_cache_server(args)
+    cparser = ConfigParser()
+    cparser.read(CONFIG_FILE)
+    cparser["LOCAL PROPERTIES"]["THREADCOUNT"] = str(args.threads)
+    cparser["LOCAL PROPERTIES"]["SAVE"] = "frontier.shelve"
+    cparser["LOCAL PROPERTIES"]["PARSE_PROCESSES"] = str(args.parse_processes)
+    cparser["CRAWLER"]["POLITENESS"] = str(args.politeness)
+    cparser["CRAWLER"]["SEEDURL"] = ",".join(site_from_arguments(args).seeds())
+    config = Config(cparser)
+    config.cache_server = address
+
+    budget = PageBudget(args.max_pages)
+    workdir = tempfile.mkdtemp(prefix="crawl-bench-")
+    os.chdir(workdir)
+    start = time.perf_counter()
+    launch.crawl(
+        config, True, worker_factory=timed_worker_factory(
+            launch.worker_class(config), budget))
+    elapsed = time.perf_counter() - start
+    server.terminate()
+
+    pages = metrics.snapshot()["counters"].get("pages", 0)
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"\n===== THROUGHPUT ({args.threads} threads, "
+          f"{args.parse_processes} parse processes, "
+          f"politeness {args.politeness}s, latency {args.latency}s) =====")
+    print(f"pages: {pages} in {elapsed:.2f}s "
+          f"-> {pages / elapsed:.1f} pages/sec")
+    print(f"peak RSS: {peak_rss_mb:.1f} MB, scratch dir: {workdir}")
+    print(f"{'stage':20s} {'count':>7s} {'p50 ms':>9s} {'p99 ms':>9s}")
+    for stage, summary in metrics.snapshot()["stages"].items():
+        print(f"{stage:20s} {summary['count']:7d} "
+              f"{summary['p50_ms']:9.2f} {summary['p99_ms']:9.2f}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--politeness", type=float, default=0.05)
+    parser.add_argument("--max_pages", type=int, default=1000)
+    parser.add_argument("--parse_processes", type=int, default=0)
+    add_site_arguments(parser)
+    run(parser.parse_args())
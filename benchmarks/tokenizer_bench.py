@@ -0,0 +1,98 @@
+''' Tokenizer microbenchmark: the previous per-character loop against the
+regex tokenizer, on the visible text of pages.
+
+    python -m benchmarks.tokenizer_bench [--pages DIR] [--count N]
+
+Also checks that every mode produces exactly the previous output. '''
+import time
+
+from argparse import ArgumentParser
+
+from benchmarks.corpus import load_pages
+from document import parse_document
+from tokenizer import tokenize_text, iter_tokens
+from word_stats import STOP_WORDS
+
+# Characters whose handling differs easily between implementations.
+EDGE_CASES = (
+    "Kelvin İstanbul ２３ x²y café-naïve "
+    "ABC_defég straße \U0001d7d8abc ÀÉ tab\there\n 42nd")
+
+
+def reference_tokenize(text):
+    # tokenizer.tokenize_text before it switched to a regex scan.
+    tokens = []
+    current = []
+    for ch in text:
+        if ord(ch) > 127:
+            if current:
+                tokens.append("".join(current).lower())
+                current = []
+            continue
+        if ch.isalnum():
+            current.append(ch)
+        else:
+            if current:
+                tokens.append("".join(current).lower())
+                current = []
+    if current:
+        tokens.append("".join(current).lower())
+    return tokens
+
+
+def reference_filtered(text):
+    return [
+        t for t in reference_tokenize(text)
+        if t not in STOP_WORDS and len(t) > 1]
+
+
+def new_filtered(text):
+    return list(iter_tokens(text, STOP_WORDS, min_length=2))
+
+
+def per_page_us(tokenize, texts, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in texts:
+            tokenize(text)
+        best = min(best, time.perf_counter() - start)
+    return best * 1e6 / len(texts)
+
+
+def check(texts):
+    for text in texts + [EDGE_CASES]:
+        expected = reference_tokenize(text)
+        assert tokenize_text(text) == expected
+        for chunk_size in (1, 7, 4096):
+            assert list(iter_tokens(text, chunk_size=chunk_size)) == expected
+        assert new_filtered(text) == reference_filtered(text)
+
+
+def main(pages_dir, count, repeat):
+    texts = [
+        parse_document("https://www.ics.uci.edu/", page).text
+        for page in load_pages(pages_dir, count)]
+    check(texts)
+    chars = sum(map(len, texts)) // len(texts)
+    print(f"pages: {len(texts)} ({'recorded' if pages_dir else 'synthetic'}), "
+          f"avg text {chars} chars; outputs identical")
+    rows = (
+        ("tokenize (per-char loop)", reference_tokenize),
+        ("tokenize (regex)", tokenize_text),
+        ("tokenize + stopwords (per-char loop)", reference_filtered),
+        ("tokenize + stopwords (iter_tokens)", new_filtered))
+    timings = {name: per_page_us(f, texts, repeat) for name, f in rows}
+    for name, us in timings.items():
+        print(f"{name:40s} {us:9.1f} us/page")
+    print(f"speedup: {timings[rows[0][0]] / timings[rows[1][0]]:.1f}x plain, "
+          f"{timings[rows[2][0]] / timings[rows[3][0]]:.1f}x filtered")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--pages", type=str, default=None)
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    main(args.pages, args.count, args.repeat)
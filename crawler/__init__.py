@@ -1,6 +1,11 @@
+import signal
+import time
+
 from utils import get_logger
+from utils.metrics import metrics
 from crawler.frontier import Frontier
 from crawler.worker import Worker
+from crawler.parse_stage import close_parse_stages
 
 class Crawler(object):
     def __init__(self, config, restart, frontier_factory=Frontier, worker_factory=Worker):
@@ -11,16 +16,62 @@ class Crawler(object):
         self.worker_factory = worker_factory
 
     def start_async(self):
+        start = time.perf_counter()
         self.workers = [
             self.worker_factory(worker_id, self.config, self.frontier)
             for worker_id in range(self.config.threads_count)]
+        self._track_utilization()
         for worker in self.workers:
             worker.start()
+        seconds = time.perf_counter() - start
+        metrics.observe("worker spawn", seconds)
+        self.logger.info(
+            f"Started {len(self.workers)} workers in {seconds:.3f}s.")
 
     def start(self):
-        self.start_async()
-        self.join()
+        # Ctrl+C stops the crawl gracefully, a second one interrupts it.
+        try:
+            previous = signal.signal(signal.SIGINT, self._interrupt)
+        except ValueError:
+            # Only the main thread can install handlers.
+            previous = None
+        try:
+            self.start_async()
+            self.join()
+        finally:
+            if previous is not None:
+                signal.signal(signal.SIGINT, previous)
+
+    def _interrupt(self, signum, frame):
+        self.logger.info("Interrupted, finishing the urls in flight.")
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        self.stop()
+
+    def stop(self):
+        # Workers finish the url they have and exit, join() then flushes.
+        self.frontier.stop()
+
+    def _track_utilization(self):
+        # Share of the time the fetch slots spent not waiting for an url.
+        slots = len(self.workers)
+        if self.config.download_mode == "async":
+            slots *= self.config.async_in_flight
+        waits = metrics.histogram("wait for url")
+        started = time.monotonic()
+        waited = waits.total
+
+        def utilization():
+            elapsed = slots * (time.monotonic() - started)
+            return {
+                "overall": round(
+                    max(0.0, 1 - (waits.total - waited) / elapsed), 3),
+                "now": round(
+                    1 - self.frontier.to_be_downloaded.waiting() / slots, 3)}
+
+        metrics.gauge("worker utilization", utilization)
 
     def join(self):
         for worker in self.workers:
             worker.join()
+        close_parse_stages()
+        self.frontier.close()
@@ -0,0 +1,55 @@
+import asyncio
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from crawler.worker import Worker
+from utils.download import download_async
+
+
+class AsyncWorker(Worker):
+    ''' Worker that keeps up to config.async_in_flight downloads in flight on
+    one event loop, over a pooled aiohttp session. The frontier still hands
+    out at most one url per host at a time, so concurrent downloads are
+    spread across hosts. Pass it to Crawler as the worker_factory. '''
+
+    def __init__(self, worker_id, config, frontier):
+        # Optional dependency, only needed for DOWNLOAD_MODE = async.
+        import aiohttp
+        super().__init__(worker_id, config, frontier)
+
+    def run(self):
+        asyncio.run(self._crawl())
+        self.logger.info("Frontier is empty. Stopping Crawler.")
+
+    async def _crawl(self):
+        import aiohttp
+        in_flight = self.config.async_in_flight
+        # get_tbd_url blocks until a host may be fetched, so it is called
+        # from threads instead of on the event loop.
+        with ThreadPoolExecutor(in_flight) as pool:
+            connector = aiohttp.TCPConnector(limit=in_flight)
+            async with aiohttp.ClientSession(connector=connector) as session:
+                await asyncio.gather(*(
+                    self._fetch_loop(session, pool) for _ in range(in_flight)))
+
+    async def _fetch_loop(self, session, pool):
+        loop = asyncio.get_running_loop()
+        while True:
+            tbd_url = await loop.run_in_executor(
+                pool, self.frontier.get_tbd_url)
+            if not tbd_url:
+                return
+            handed_off = False
+            try:
+                start = time.perf_counter()
+                resp = await download_async(
+                    session, tbd_url, self.config, self.logger)
+                self.record_download(tbd_url, resp, start)
+                # Off the event loop: parsing, or waiting for a parse stage
+                # slot, would hold up the other downloads.
+                handed_off = await loop.run_in_executor(
+                    pool, self.process, tbd_url, resp)
+            finally:
+                if not handed_off:
+                    self.frontier.mark_url_complete(tbd_url)
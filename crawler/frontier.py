@@ -1,17 +1,33 @@
 import os
-import shelve
 
 from threading import Thread, RLock
-from queue import Queue, Empty
 
 from utils import get_logger, get_urlhash, normalize
-from scraper import is_valid
+from utils.canonical import canonicalize, canonicalizer
+from utils.metrics import metrics
+from scraper import filter_valid, is_trap, reject_and_log, traps, RULES_VERSION
+from crawler.politeness import AdaptiveDelay
+from crawler.robots import RobotsCache
+from crawler.scheduler import HostScheduler, get_host
+from crawler.store import FrontierStore, remove_store
 
 class Frontier(object):
     def __init__(self, config, restart):
         self.logger = get_logger("FRONTIER")
         self.config = config
-        self.to_be_downloaded = list()
+        # POLITENESS is the floor, hosts that struggle get longer delays.
+        self.delays = AdaptiveDelay(
+            self.config.time_delay, self.config.max_time_delay)
+        self.to_be_downloaded = HostScheduler(
+            self.config.time_delay, host_delay=self.delays.delay)
+        metrics.gauge("slowest hosts", self.delays.slowest)
+        metrics.gauge("queued urls", self.to_be_downloaded.__len__)
+        metrics.gauge("outstanding", self.to_be_downloaded.outstanding)
+        metrics.gauge("in flight urls", self.to_be_downloaded.in_flight)
+        self.lock = RLock()
+        # Urls whose host was released by mark_url_fetched.
+        self._fetched = set()
+        self._stopped = False
         
         if not os.path.exists(self.config.save_file) and not restart:
             # Save file does not exist, but request to load save.
@@ -22,9 +38,28 @@ class Frontier(object):
             # Save file does exists, but request to start from seed.
             self.logger.info(
                 f"Found save file {self.config.save_file}, deleting it.")
-            os.remove(self.config.save_file)
+        if restart:
+            remove_store(self.config.save_file)
         # Load existing save file, or create one if it does not exist.
-        self.save = shelve.open(self.config.save_file)
+        # Any write-ahead log left by a crash is replayed into it.
+        self.save = FrontierStore(
+            self.config.save_file,
+            durability=self.config.save_durability,
+            flush_records=self.config.save_flush_records,
+            flush_seconds=self.config.save_flush_seconds,
+            compact_records=self.config.save_compact_records,
+            rules_version=RULES_VERSION,
+            seen=self.config.seen_set)
+        # robots.txt and sitemaps of each host, see crawler/robots.py.
+        self.robots = None
+        if self.config.robots_ttl:
+            self.robots = RobotsCache(
+                config, restart,
+                on_urls=lambda urls: self.add_urls(filter_valid(urls)),
+                on_fetch=self.record_fetch, ttl=self.config.robots_ttl,
+                max_sitemaps=self.config.max_sitemaps,
+                max_sitemap_urls=self.config.max_sitemap_urls)
+            self.on_commit(self.robots.checkpoint)
         if restart:
             for url in self.config.seed_urls:
                 self.add_url(url)
@@ -37,36 +72,169 @@ class Frontier(object):
 
     def _parse_save_file(self):
         ''' This function can be overridden for alternate saving techniques. '''
-        total_count = len(self.save)
-        tbd_count = 0
-        for url, completed in self.save.values():
-            if not completed and is_valid(url):
-                self.to_be_downloaded.append(url)
-                tbd_count += 1
+        # Pending urls are queued from a background thread so downloading
+        # starts right away. Workers wait for it rather than stop early.
+        self.to_be_downloaded.start_loading()
+        Thread(target=self._load_pending, daemon=True).start()
+
+    def _load_pending(self):
+        tbd_count = revalidated = 0
+        stale = list()
+        try:
+            for urlhash, url, version in self.save.pending():
+                if version == RULES_VERSION:
+                    self.to_be_downloaded.push(url)
+                    tbd_count += 1
+                elif version != f"!{RULES_VERSION}":
+                    # Validated under other rules, or never.
+                    stale.append((urlhash, url))
+                    if len(stale) >= 10000:
+                        tbd_count += self._push_valid(stale)
+                        revalidated += len(stale)
+                        stale = list()
+            tbd_count += self._push_valid(stale)
+            revalidated += len(stale)
+        finally:
+            self.to_be_downloaded.finish_loading()
         self.logger.info(
-            f"Found {tbd_count} urls to be downloaded from {total_count} "
-            f"total urls discovered.")
+            f"Found {tbd_count} urls to be downloaded, {revalidated} of them "
+            f"validated again for changed rules.")
+
+    def _push_valid(self, pending):
+        # Validates a batch of saved (urlhash, url) at once.
+        valid = set(filter_valid(url for _, url in pending))
+        for urlhash, url in pending:
+            # Recorded before pushing, so it cannot overwrite a completion.
+            self.save.validated(urlhash, url, url in valid)
+            if url in valid:
+                self.to_be_downloaded.push(url)
+        return sum(1 for _, url in pending if url in valid)
 
     def get_tbd_url(self):
-        try:
-            return self.to_be_downloaded.pop()
-        except IndexError:
-            return None
+        # Blocks until the url's host may be fetched without breaking
+        # politeness. The host stays reserved until mark_url_complete.
+        while True:
+            with metrics.timer("wait for url"):
+                url = self.to_be_downloaded.pop()
+            if url is None:
+                return None
+            if self.robots is not None and self.robots.fetch_next(url):
+                # robots.txt or a sitemap of the host took its turn.
+                self.to_be_downloaded.push(url)
+                self.to_be_downloaded.release(url)
+                continue
+            wait = self.robots.wait(url) if self.robots is not None else 0
+            if wait:
+                # Its robots.txt could not be fetched, the host waits for
+                # the next attempt with its urls still queued.
+                self.to_be_downloaded.push(url)
+                self.to_be_downloaded.release(url, wait)
+                continue
+            if is_trap(url):
+                # Queued before its template was blocked. Not fetched, so
+                # the host is free again right away.
+                self._mark_url_complete(url, delay=0)
+            elif self.robots is not None and not self.robots.allowed(url):
+                reject_and_log(url, "disallowed by robots.txt")
+                self._mark_url_complete(url, delay=0)
+            else:
+                return url
 
     def add_url(self, url):
-        url = normalize(url)
-        urlhash = get_urlhash(url)
-        if urlhash not in self.save:
-            self.save[urlhash] = (url, False)
-            self.save.sync()
-            self.to_be_downloaded.append(url)
+        self.add_urls((url,))
+
+    def add_urls(self, urls):
+        with metrics.timer("frontier add"):
+            self._add_urls(urls)
+
+    def _add_urls(self, urls):
+        # Adds a page's outlinks with one lookup in the store's seen set.
+        by_hash = dict()
+        # Other spellings, that used to be fetched as urls of their own.
+        aliases = dict()
+        plain = set()
+        for url in urls:
+            canonical = canonicalize(url)
+            urlhash = get_urlhash(canonical)
+            by_hash.setdefault(urlhash, canonical)
+            spelling = get_urlhash(normalize(url))
+            if spelling == urlhash:
+                plain.add(urlhash)
+            else:
+                aliases.setdefault(urlhash, set()).add(spelling)
+        with self.lock:
+            new = self.save.missing(list(by_hash))
+            for urlhash in new:
+                # Group committed by the store, see SAVE_DURABILITY.
+                self.save[urlhash] = (by_hash[urlhash], False)
+        prevented = aliases and canonicalizer.count_prevented(
+            aliases, plain, set(new))
+        if prevented:
+            metrics.count("duplicate fetches prevented", prevented)
+        for urlhash in new:
+            url = by_hash[urlhash]
+            self.to_be_downloaded.push(url, last=traps.low_yield(url))
     
     def mark_url_complete(self, url):
+        with metrics.timer("frontier complete"):
+            self._mark_url_complete(url)
+
+    def _mark_url_complete(self, url, delay=None):
         urlhash = get_urlhash(url)
-        if urlhash not in self.save:
-            # This should not happen.
-            self.logger.error(
-                f"Completed url {url}, but have not seen it before.")
+        with self.lock:
+            if urlhash not in self.save:
+                # This should not happen.
+                self.logger.error(
+                    f"Completed url {url}, but have not seen it before.")
 
-        self.save[urlhash] = (url, True)
-        self.save.sync()
+            self.save[urlhash] = (url, True)
+            fetched = url in self._fetched
+            self._fetched.discard(url)
+        if fetched:
+            self.to_be_downloaded.handed_back()
+        else:
+            self.to_be_downloaded.release(url, delay)
+
+    def record_fetch(self, url, status, seconds):
+        # Adapts the host's delay to how its download went.
+        self.delays.observe(get_host(url), seconds, status)
+
+    def mark_url_fetched(self, url):
+        # Frees the url's host for the next download while the page is still
+        # being parsed elsewhere. Workers keep waiting for its outlinks until
+        # mark_url_complete.
+        with self.lock:
+            self._fetched.add(url)
+        self.to_be_downloaded.hand_off(url)
+
+    def stop(self):
+        # Workers get no more urls. Those in flight are still completed, so
+        # what is left queued is exactly what a resumed crawl picks up.
+        if self._stopped:
+            return
+        self._stopped = True
+        self.logger.info(
+            f"Stopping with {len(self.to_be_downloaded)} urls queued, "
+            f"waiting for {self.to_be_downloaded.in_flight()} in flight.")
+        self.to_be_downloaded.stop()
+
+    def on_commit(self, callback):
+        # callback() runs before each group commit of the save file, e.g. to
+        # persist state that has to be on disk before the urls it came from
+        # are committed as completed.
+        self.save.commit_hooks.append(callback)
+
+    def close(self):
+        # Commits and compacts everything still in the write-ahead log.
+        stats = self.save.seen_stats()
+        self.logger.info(
+            f"Seen set ({stats['kind']}): {stats['urls']} urls in "
+            f"{stats['bytes'] / 1024:.0f} KB, {stats['answered_in_memory']} "
+            f"of {stats['lookups']} lookups answered from memory.")
+        self.logger.info(
+            f"Canonical urls: {canonicalizer.prevented} duplicate fetches "
+            f"prevented, {canonicalizer.cache_hits} of "
+            f"{canonicalizer.lookups} urls canonicalized from the cache.")
+        if self.robots is not None:
+            self.robots.close()
+        self.save.close()
@@ -0,0 +1,121 @@
+import multiprocessing
+import signal
+
+from concurrent.futures import ProcessPoolExecutor
+from queue import SimpleQueue
+from time import perf_counter
+from threading import BoundedSemaphore, Lock, Thread
+
+from utils import get_logger
+from utils.metrics import metrics
+import scraper
+
+_stages = dict()
+_stages_lock = Lock()
+
+
+def get_parse_stage(config):
+    ''' The stage shared by all workers, or None if PARSE_PROCESSES is 0. '''
+    if not config.parse_processes:
+        return None
+    with _stages_lock:
+        if config.parse_processes not in _stages:
+            _stages[config.parse_processes] = ParseStage(
+                config.parse_processes, config.parse_in_flight)
+        return _stages[config.parse_processes]
+
+
+def _ignore_interrupts():
+    # Ctrl+C reaches the whole process group. The crawler drains the pool
+    # when it stops, so the pages in it are still parsed and recorded.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _analyze_page(url, resp):
+    # Runs in a pool process, whose own metrics are never read. Its stage
+    # timings (parse, tokenize) go back with the page.
+    page = scraper.analyze_page(url, resp)
+    return page, metrics.drain_stages()
+
+
+def close_parse_stages():
+    with _stages_lock:
+        for stage in _stages.values():
+            stage.close()
+        _stages.clear()
+
+
+class ParseStage(object):
+    ''' Runs scraper.analyze_page, the parsing, tokenizing and fingerprinting
+    of a page, in a pool of processes so it is not bound by the GIL.
+
+    At most `in_flight` pages are submitted and not yet recorded; submit()
+    blocks until one finishes, which keeps the fetched responses waiting in
+    memory bounded when parsing falls behind. Analyzed pages are handed to
+    their callback one at a time on a thread of this process. '''
+
+    def __init__(self, processes, in_flight=0):
+        self.logger = get_logger("PARSE")
+        # Children are forked from a clean server process rather than from
+        # the crawler and its threads, where that is available.
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context(
+            "forkserver" if "forkserver" in methods else "spawn")
+        if "forkserver" in methods:
+            context.set_forkserver_preload(["scraper"])
+        self._pool = ProcessPoolExecutor(
+            processes, mp_context=context, initializer=_ignore_interrupts)
+        self._slots = BoundedSemaphore(in_flight or 2 * processes)
+        self._in_flight = 0
+        self._in_flight_lock = Lock()
+        metrics.gauge("parse in flight", lambda: self._in_flight)
+        self._done = SimpleQueue()
+        self._recorder = Thread(target=self._record, daemon=True)
+        self._recorder.start()
+
+    def submit(self, url, resp, callback):
+        ''' Analyzes the page in the pool, then calls callback(url, page)
+        with the scraper.PageAnalysis, or None if it failed. '''
+        with metrics.timer("parse slot wait"):
+            self._slots.acquire()
+        self._count_in_flight(1)
+        start = perf_counter()
+        try:
+            future = self._pool.submit(_analyze_page, url, resp)
+        except BaseException:
+            self._count_in_flight(-1)
+            self._slots.release()
+            raise
+        future.add_done_callback(
+            lambda future: self._done.put((url, future, callback, start)))
+
+    def _count_in_flight(self, n):
+        with self._in_flight_lock:
+            self._in_flight += n
+
+    def _record(self):
+        while True:
+            item = self._done.get()
+            if item is None:
+                return
+            url, future, callback, start = item
+            # Queueing for a process included
+            metrics.observe("parse in pool", perf_counter() - start)
+            try:
+                page, stages = future.result()
+                metrics.merge_stages(stages)
+            except Exception as e:
+                self.logger.error(f"Failed to analyze {url}: {e!r}")
+                page = None
+            try:
+                callback(url, page)
+            except Exception:
+                self.logger.exception(f"Failed to record {url}.")
+            finally:
+                self._count_in_flight(-1)
+                self._slots.release()
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+        self._done.put(None)
+        self._recorder.join()
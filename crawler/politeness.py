@@ -0,0 +1,73 @@
+from threading import Lock
+
+# A fetch is slow if it takes slow_factor times the host's usual latency,
+# and at least this long; below it, cache hits vs misses are just noise.
+SLOW_SECONDS = 1.0
+# Weight of the latest fetch in a host's usual latency.
+LATENCY_WEIGHT = 0.2
+# Statuses the cache server reports its own errors with, such as a host it
+# could not reach.
+CACHE_ERROR_STATUSES = range(600, 607)
+
+
+def failed(status):
+    ''' Statuses that mean the host (or the cache in front of it) is
+    struggling: unreachable, rate limited, a server error or a cache
+    error. '''
+    return (
+        status == 0 or status == 429 or 500 <= status < 600
+        or status in CACHE_ERROR_STATUSES)
+
+
+class AdaptiveDelay(object):
+    ''' Per host crawl delay, adjusted AIMD style after every fetch.
+
+    A failed or slow fetch multiplies the host's delay by `backoff`, up to
+    `ceiling`. Any other fetch takes `step` off it again, down to `floor`.
+    The floor is POLITENESS and is never undercut. With ceiling <= floor
+    every host simply keeps the floor. '''
+
+    def __init__(self, floor, ceiling, backoff=2.0, slow_factor=3.0):
+        self.floor = floor
+        self.ceiling = max(floor, ceiling)
+        self.backoff = backoff
+        self.slow_factor = slow_factor
+        self.step = max(floor, 0.05)
+        self.backoffs = 0
+        # Only hosts above the floor are kept.
+        self._delays = dict()
+        self._latency = dict()
+        self._lock = Lock()
+
+    def delay(self, host):
+        return self._delays.get(host, self.floor)
+
+    def observe(self, host, seconds, status):
+        ''' Updates host's delay with a fetch that took `seconds` and
+        returned `status`. Returns the new delay. '''
+        if self.ceiling <= self.floor:
+            return self.floor
+        with self._lock:
+            usual = self._latency.get(host)
+            self._latency[host] = seconds if usual is None else (
+                usual + LATENCY_WEIGHT * (seconds - usual))
+            slow = usual is not None and seconds > max(
+                SLOW_SECONDS, self.slow_factor * usual)
+            delay = self._delays.get(host, self.floor)
+            if failed(status) or slow:
+                delay = min(
+                    self.ceiling, max(delay * self.backoff, delay + self.step))
+                self.backoffs += 1
+            else:
+                delay = max(self.floor, delay - self.step)
+            if delay > self.floor:
+                self._delays[host] = delay
+            else:
+                self._delays.pop(host, None)
+            return delay
+
+    def slowest(self, top=20):
+        ''' {host: delay} of the top hosts held above the floor. '''
+        with self._lock:
+            return dict(sorted(
+                self._delays.items(), key=lambda item: -item[1])[:top])
@@ -0,0 +1,297 @@
+import gzip
+import io
+import os
+import pickle
+import re
+import time
+import zlib
+
+from threading import Lock
+from urllib.parse import urljoin, urlsplit
+
+from lxml import etree
+
+from crawler.scheduler import get_host
+from utils import get_logger
+from utils.download import download
+
+# Statuses after which robots.txt is fetched again on the host's next turn,
+# as are 5xx and the cache server's 600-606, up to FETCH_ATTEMPTS times.
+RETRY_STATUSES = (0, 429)
+FETCH_ATTEMPTS = 3
+# How long a host waits for its robots.txt to be fetched again after
+# FETCH_ATTEMPTS failures. As in RFC 9309 a server error means nothing is
+# allowed, so a host with no rules fetched yet is not crawled meanwhile.
+RETRY_SECONDS = 600.0
+# Decompressed size of a sitemap read at most.
+MAX_SITEMAP_BYTES = 50 * 1024 * 1024
+# Persisted state is rewritten at most this often.
+SAVE_SECONDS = 30.0
+
+_SITEMAP_PARSER = etree.XMLParser(
+    recover=True, resolve_entities=False, no_network=True)
+
+
+class RobotsRules(object):
+    ''' The Allow and Disallow rules of one robots.txt group, as in RFC
+    9309: * matches anything, a trailing $ anchors the end, the longest
+    matching rule wins and Allow wins a tie. '''
+
+    def __init__(self, rules=()):
+        # (length, allow, pattern), most specific first.
+        self.rules = sorted(
+            ((len(path), allow, _compile(path)) for allow, path in rules),
+            key=lambda rule: (-rule[0], not rule[1]))
+
+    def allowed(self, url):
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        if path == "/robots.txt":
+            return True
+        for _, allow, pattern in self.rules:
+            if pattern.match(path):
+                return allow
+        return True
+
+
+def _compile(path):
+    anchored = path.endswith("$")
+    if anchored:
+        path = path[:-1]
+    pattern = ".*".join(re.escape(part) for part in path.split("*"))
+    return re.compile(pattern + ("\\Z" if anchored else ""), re.DOTALL)
+
+
+def parse_robots(text, agent):
+    ''' (RobotsRules of the group for agent, or of *, and the Sitemap urls)
+    of a robots.txt. agent is a lowercase product token. '''
+    groups = dict()
+    sitemaps = list()
+    agents = list()
+    in_rules = False
+    for line in text.splitlines():
+        line = line.split("#", 1)[0].strip()
+        if ":" not in line:
+            continue
+        key, value = line.split(":", 1)
+        key, value = key.strip().lower(), value.strip()
+        if key == "user-agent":
+            if in_rules:
+                agents = list()
+                in_rules = False
+            agents.append(value.lower())
+            for name in agents:
+                groups.setdefault(name, list())
+        elif key in ("allow", "disallow"):
+            in_rules = True
+            if value:
+                for name in agents:
+                    groups[name].append((key == "allow", value))
+        elif key == "sitemap" and value:
+            sitemaps.append(value)
+    rules = groups.get(agent)
+    if rules is None:
+        rules = groups.get("*", ())
+    return RobotsRules(rules), sitemaps
+
+
+def parse_sitemap(content):
+    ''' (page urls, sitemap urls) listed in a sitemap, sitemap index or
+    plain text sitemap, gzipped or not. '''
+    if content[:2] == b"\x1f\x8b":
+        with gzip.GzipFile(fileobj=io.BytesIO(content)) as unzipped:
+            content = unzipped.read(MAX_SITEMAP_BYTES)
+    if not content.lstrip().startswith(b"<"):
+        return [
+            line.strip() for line in content.decode("utf-8", "replace")
+            .splitlines() if line.strip().startswith("http")], []
+    root = etree.fromstring(content, parser=_SITEMAP_PARSER)
+    if root is None:
+        return [], []
+    locs = [
+        element.text.strip() for element in root.iter("{*}loc", "loc")
+        if element.text and element.text.strip()]
+    if etree.QName(root).localname.lower() == "sitemapindex":
+        return [], locs
+    return locs, []
+
+
+class _HostRobots(object):
+    __slots__ = (
+        "expires", "rules", "sitemaps", "attempts", "known", "sitemaps_fetched")
+
+    def __init__(self):
+        self.expires = 0.0
+        self.rules = None
+        # Sitemaps not fetched yet, one per turn of the host.
+        self.sitemaps = list()
+        self.attempts = 0
+        # Whether robots.txt was ever fetched, or found missing (4xx).
+        self.known = False
+        self.sitemaps_fetched = 0
+
+    def __getstate__(self):
+        return (
+            self.expires, self.rules, self.sitemaps, self.attempts,
+            self.known, self.sitemaps_fetched)
+
+    def __setstate__(self, state):
+        if len(state) == 4:
+            # Saved before: every host with an expiry had been resolved.
+            state = tuple(state) + (state[0] > 0, 0)
+        (self.expires, self.rules, self.sitemaps, self.attempts, self.known,
+         self.sitemaps_fetched) = state
+
+
+class RobotsCache(object):
+    ''' robots.txt rules and sitemaps of every host, fetched through the
+    cache server like any page and kept for `ttl` seconds in
+    `<SAVE>.robots`.
+
+    Fetching them uses a turn of the host, so the frontier calls
+    fetch_next() for a url's host, which fetches robots.txt or one sitemap
+    if either is due, before it hands the url out. A host whose robots.txt
+    could never be fetched is held back, see wait(). At most max_sitemaps
+    sitemaps are fetched per host each ttl. Urls listed in sitemaps are
+    passed to on_urls. '''
+
+    def __init__(
+            self, config, restart, on_urls, on_fetch=None, ttl=86400.0,
+            max_sitemaps=10, max_sitemap_urls=50000):
+        self.logger = get_logger("ROBOTS")
+        self.config = config
+        self.on_urls = on_urls
+        self.on_fetch = on_fetch
+        self.ttl = ttl
+        self.max_sitemaps = max_sitemaps
+        self.max_sitemap_urls = max_sitemap_urls
+        self.agent = config.user_agent.split()[0].lower()
+        self._hosts = dict()
+        self._lock = Lock()
+        self._dirty = False
+        self._saved = 0.0
+        self._path = f"{config.save_file}.robots"
+        if restart and os.path.exists(self._path):
+            os.remove(self._path)
+        if os.path.exists(self._path):
+            with open(self._path, "rb") as saved:
+                self._hosts = pickle.loads(zlib.decompress(saved.read()))
+
+    def fetch_next(self, url):
+        ''' Fetches robots.txt of url's host if it is due, else one of its
+        sitemaps if any is left. Returns whether it fetched anything. '''
+        host = get_host(url)
+        with self._lock:
+            entry = self._hosts.get(host)
+            if entry is None:
+                entry = self._hosts[host] = _HostRobots()
+        if time.time() >= entry.expires:
+            self._fetch_robots(url, entry)
+        elif entry.sitemaps and entry.sitemaps_fetched < self.max_sitemaps:
+            entry.sitemaps_fetched += 1
+            self._fetch_sitemap(entry.sitemaps.pop(0), entry)
+        else:
+            return False
+        self._dirty = True
+        return True
+
+    def wait(self, url):
+        ''' Seconds url's host must wait for its robots.txt to be fetched
+        again, 0 if its rules are known. '''
+        entry = self._hosts.get(get_host(url))
+        if entry is None or entry.known:
+            return 0.0
+        return max(entry.expires - time.time(), 0.0)
+
+    def allowed(self, url):
+        entry = self._hosts.get(get_host(url))
+        return entry is None or entry.rules is None or entry.rules.allowed(url)
+
+    def _get(self, url):
+        start = time.perf_counter()
+        resp = download(url, self.config, self.logger)
+        if self.on_fetch:
+            self.on_fetch(url, resp.status, time.perf_counter() - start)
+        raw = resp.raw_response
+        if not 200 <= resp.status < 300 or raw is None:
+            return resp.status, None
+        return resp.status, raw.content or b""
+
+    def _fetch_robots(self, url, entry):
+        parts = urlsplit(url)
+        robots_url = f"{parts.scheme}://{parts.netloc}/robots.txt"
+        status, content = self._get(robots_url)
+        if content is None and (status in RETRY_STATUSES or status >= 500):
+            entry.attempts += 1
+            if entry.attempts < FETCH_ATTEMPTS:
+                # Again on the host's next turn.
+                return
+            # The rules fetched before, if any, still hold meanwhile.
+            self.logger.info(
+                f"No robots.txt from {robots_url} after {entry.attempts} "
+                f"attempts (status {status}), "
+                f"{'keeping its rules' if entry.known else 'holding the host'}"
+                f" for {RETRY_SECONDS:.0f}s.")
+            entry.expires = time.time() + RETRY_SECONDS
+            entry.attempts = 0
+            return
+        entry.attempts = 0
+        entry.known = True
+        entry.expires = time.time() + self.ttl
+        entry.sitemaps_fetched = 0
+        if content is None:
+            # No robots.txt (4xx): everything is allowed.
+            entry.rules = None
+            entry.sitemaps = list()
+            return
+        entry.rules, sitemaps = parse_robots(
+            content.decode("utf-8", "replace"), self.agent)
+        # Only the host's own sitemaps, they are fetched on its turns.
+        sitemaps = [urljoin(robots_url, sitemap) for sitemap in sitemaps]
+        entry.sitemaps = [
+            sitemap for sitemap in sitemaps
+            if get_host(sitemap) == get_host(robots_url)
+        ][:self.max_sitemaps]
+        self.logger.info(
+            f"{robots_url}: {len(entry.rules.rules)} rules, "
+            f"{len(entry.sitemaps)} sitemaps.")
+
+    def _fetch_sitemap(self, sitemap_url, entry):
+        status, content = self._get(sitemap_url)
+        if content is None:
+            return
+        try:
+            urls, sitemaps = parse_sitemap(content)
+        except (OSError, EOFError, etree.LxmlError, ValueError) as e:
+            self.logger.error(f"Could not read sitemap {sitemap_url}: {e!r}")
+            return
+        host = get_host(sitemap_url)
+        # A sitemap index lists more sitemaps, fetched on later turns.
+        room = (
+            self.max_sitemaps - entry.sitemaps_fetched - len(entry.sitemaps))
+        entry.sitemaps.extend(
+            sitemap for sitemap in sitemaps[:max(room, 0)]
+            if get_host(sitemap) == host)
+        urls = urls[:self.max_sitemap_urls]
+        if urls:
+            self.logger.info(f"{sitemap_url}: {len(urls)} urls.")
+            self.on_urls(urls)
+
+    def checkpoint(self, force=False):
+        ''' Persists the cache, at most every SAVE_SECONDS unless forced. '''
+        now = time.monotonic()
+        if not self._dirty or (not force and now - self._saved < SAVE_SECONDS):
+            return
+        with self._lock:
+            data = zlib.compress(
+                pickle.dumps(self._hosts, pickle.HIGHEST_PROTOCOL), 1)
+            self._dirty = False
+            self._saved = now
+        with open(f"{self._path}.tmp", "wb") as out:
+            out.write(data)
+        os.replace(f"{self._path}.tmp", self._path)
+
+    def close(self):
+        self.checkpoint(force=True)
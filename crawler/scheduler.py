@@ -0,0 +1,168 @@
+import heapq
+import time
+
+from collections import deque
+from threading import Condition
+from urllib.parse import urlparse
+
+from utils.metrics import metrics
+
+
+def get_host(url):
+    return urlparse(url).netloc.lower()
+
+
+class HostScheduler(object):
+    ''' Thread safe per-host url queues.
+
+    Hosts with pending urls wait in a heap keyed on the earliest time they
+    may be fetched again. A host that is handed out stays checked out until
+    release() is called for it, so at most one fetch per host is in flight
+    and two fetches of the same host are always at least `delay` apart, or
+    host_delay(host) apart if that is given. '''
+
+    def __init__(self, delay, host_delay=None):
+        self.delay = delay
+        self.host_delay = host_delay
+        self._queues = dict()
+        self._ready = list()
+        self._busy = set()
+        self._next_fetch = dict()
+        self._size = 0
+        self._loading = 0
+        self._handed_off = 0
+        self._waiting = 0
+        self._stopped = False
+        self._cond = Condition()
+
+    def __len__(self):
+        return self._size
+
+    def outstanding(self):
+        ''' Queued urls, hosts being fetched, urls handed off and loads in
+        progress. '''
+        with self._cond:
+            return (self._size + len(self._busy) + self._handed_off
+                    + self._loading)
+
+    def in_flight(self):
+        ''' Urls handed out by pop() and not released yet, as at most one
+        per host is, plus urls handed off and loads in progress. '''
+        with self._cond:
+            return len(self._busy) + self._handed_off + self._loading
+
+    def waiting(self):
+        ''' Callers blocked in pop(). '''
+        return self._waiting
+
+    def stop(self):
+        ''' From now on pop() returns None, to every caller, queued urls or
+        not. What is in flight can still be released. '''
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def start_loading(self):
+        ''' Until finish_loading(), pop() waits instead of returning None
+        when nothing is queued, because more urls are on their way. '''
+        with self._cond:
+            self._loading += 1
+
+    def finish_loading(self):
+        with self._cond:
+            self._loading -= 1
+            self._cond.notify_all()
+
+    def hand_off(self, url):
+        ''' Releases url's host while the url is still being worked on
+        elsewhere, e.g. parsed in another process. Until handed_back(),
+        pop() waits instead of returning None, as its outlinks are still
+        to come. '''
+        with self._cond:
+            self._handed_off += 1
+        self.release(url)
+
+    def handed_back(self):
+        with self._cond:
+            self._handed_off -= 1
+            self._cond.notify_all()
+
+    def push(self, url, last=False):
+        ''' Queues url. With last, it is only fetched once the other urls
+        of its host are. '''
+        host = get_host(url)
+        with self._cond:
+            queue = self._queues.get(host)
+            if queue is None:
+                queue = self._queues[host] = deque()
+            if last:
+                queue.appendleft(url)
+            else:
+                queue.append(url)
+            self._size += 1
+            if len(queue) == 1 and host not in self._busy:
+                heapq.heappush(
+                    self._ready, (self._next_fetch.pop(host, 0), host))
+                self._cond.notify()
+
+    def pop(self):
+        ''' Blocks until the earliest eligible host may be fetched and
+        returns one of its urls. Returns None once nothing is queued and
+        nothing is in flight, since an url in flight can still add more, or
+        once stopped. '''
+        with self._cond:
+            while True:
+                if self._stopped:
+                    return None
+                if not self._ready:
+                    if not (self._size or self._busy or self._handed_off
+                            or self._loading):
+                        # Wake the other waiters so they stop too.
+                        self._cond.notify_all()
+                        return None
+                    # Everything left belongs to hosts being fetched, is
+                    # handed off or is still loading.
+                    self._wait()
+                    continue
+                next_fetch, host = self._ready[0]
+                wait = next_fetch - time.monotonic()
+                if wait > 0:
+                    with metrics.timer("politeness wait"):
+                        self._wait(wait)
+                    continue
+                heapq.heappop(self._ready)
+                queue = self._queues[host]
+                url = queue.pop()
+                if not queue:
+                    del self._queues[host]
+                self._size -= 1
+                self._busy.add(host)
+                return url
+
+    def _wait(self, timeout=None):
+        # Caller holds the condition.
+        self._waiting += 1
+        try:
+            self._cond.wait(timeout)
+        finally:
+            self._waiting -= 1
+
+    def release(self, url, delay=None):
+        ''' Marks the fetch of url as finished, making its host eligible
+        again after the politeness delay, or after `delay`. '''
+        host = get_host(url)
+        with self._cond:
+            if host not in self._busy:
+                return
+            self._busy.discard(host)
+            if delay is None:
+                delay = self.host_delay(host) if self.host_delay else self.delay
+            next_fetch = time.monotonic() + delay
+            if host in self._queues:
+                heapq.heappush(self._ready, (next_fetch, host))
+                self._cond.notify()
+            else:
+                self._next_fetch[host] = next_fetch
+                if not self._busy and not self._size:
+                    # Possibly the last url in flight, waiters may be done.
+                    self._cond.notify_all()
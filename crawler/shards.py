@@ -0,0 +1,236 @@
+import multiprocessing
+import signal
+import time
+import zlib
+
+from functools import partial
+from queue import Empty
+from threading import Thread, Lock
+
+from crawler.frontier import Frontier
+from crawler.scheduler import get_host
+from seen_set import DigestSet, url_digest
+from utils import get_logger
+from utils.canonical import canonicalize
+
+# Urls for another shard are sent once this many are waiting for it, or
+# FLUSH_SECONDS after they were found.
+BATCH_URLS = 500
+FLUSH_SECONDS = 0.2
+# Shards report whether they are idle every REPORT_SECONDS; the crawl ends
+# once two checks POLL_SECONDS apart find all of them idle and nothing moved.
+REPORT_SECONDS = 0.1
+POLL_SECONDS = 0.3
+
+
+def shard_of(url, shards):
+    ''' Index of the shard that owns url's host. '''
+    return zlib.crc32(get_host(url).encode("utf-8")) % shards
+
+
+def shard_path(path, shard, shards):
+    ''' Per shard name of a file or directory. The shard count is part of
+    it, so a crawl resumed with another count does not mix partitions. '''
+    return f"{path}.shard-{shard}-of-{shards}"
+
+
+class ShardExchange(object):
+    ''' What the shard processes share: one inbound queue of url batches
+    per shard, and the counters the coordinator watches to tell when the
+    whole crawl has run out of urls. '''
+
+    def __init__(self, context, shards):
+        self.queues = [context.Queue() for _ in range(shards)]
+        self.sent = context.Array("q", shards)
+        self.received = context.Array("q", shards)
+        self.fetched = context.Array("q", shards)
+        self.idle = context.Array("b", shards)
+        self.done = context.Event()
+        # Set along with done to stop early, leaving queued urls for a resume
+        self.stop = context.Event()
+
+    def _snapshot(self):
+        return tuple(
+            tuple(counters.get_obj())
+            for counters in (self.idle, self.sent, self.received, self.fetched))
+
+    def coordinate(self, processes, logger):
+        ''' Sets done once every shard is idle with no batch in transit.
+        Stops the crawl if a shard process died. '''
+        previous = None
+        while not self.done.is_set():
+            time.sleep(POLL_SECONDS)
+            for shard, process in enumerate(processes):
+                if process.exitcode is not None:
+                    logger.error(
+                        f"Shard {shard} exited with {process.exitcode}, "
+                        f"stopping the others.")
+                    self.stop.set()
+                    self.done.set()
+            snapshot = self._snapshot()
+            idle, sent, received, _ = snapshot
+            if all(idle) and sum(sent) == sum(received) and snapshot == previous:
+                self.done.set()
+            previous = snapshot
+
+
+class ShardedFrontier(Frontier):
+    ''' Frontier of one shard. Keeps the urls of the hosts it owns and sends
+    the others, in batches, to the shards that own them. Each host belongs
+    to exactly one shard, so per host politeness holds across processes.
+
+    Urls still buffered or in a queue when a shard is killed are lost. '''
+
+    def __init__(self, config, restart, shard, exchange):
+        self.shard = shard
+        self.exchange = exchange
+        self._outbox = [list() for _ in exchange.queues]
+        self._outbox_lock = Lock()
+        # Digests of the urls already sent, so each is sent once.
+        self._sent = DigestSet()
+        super().__init__(config, restart)
+        # Workers keep waiting while other shards may still send urls.
+        self.to_be_downloaded.start_loading()
+        for target in (self._receive, self._flush, self._report):
+            Thread(target=target, daemon=True).start()
+
+    def get_tbd_url(self):
+        url = super().get_tbd_url()
+        if not url:
+            return None
+        if self.exchange.stop.is_set():
+            # Left pending in the save file for the next run. The host is
+            # released so the other workers get to stop as well.
+            self.to_be_downloaded.release(url)
+            return None
+        with self.exchange.fetched.get_lock():
+            self.exchange.fetched[self.shard] += 1
+        return url
+
+    def add_urls(self, urls):
+        own = list()
+        full = list()
+        with self._outbox_lock:
+            for url in urls:
+                canonical = canonicalize(url)
+                shard = shard_of(canonical, len(self._outbox))
+                if shard == self.shard:
+                    own.append(url)
+                elif self._sent.add(url_digest(canonical)):
+                    self._outbox[shard].append(url)
+                    if len(self._outbox[shard]) >= BATCH_URLS:
+                        full.append(shard)
+            for shard in full:
+                self._send(shard)
+        super().add_urls(own)
+
+    def _send(self, shard):
+        # Callers hold _outbox_lock, so an empty outbox means sent counts it
+        batch, self._outbox[shard] = self._outbox[shard], list()
+        with self.exchange.sent.get_lock():
+            self.exchange.sent[self.shard] += 1
+        self.exchange.queues[shard].put(batch)
+
+    def _flush(self):
+        while not self.exchange.done.is_set():
+            time.sleep(FLUSH_SECONDS)
+            with self._outbox_lock:
+                for shard, urls in enumerate(self._outbox):
+                    if urls:
+                        self._send(shard)
+
+    def _receive(self):
+        inbox = self.exchange.queues[self.shard]
+        while not self.exchange.done.is_set():
+            try:
+                batch = inbox.get(timeout=POLL_SECONDS)
+            except Empty:
+                continue
+            # Queued before it is counted, so the shard is not idle meanwhile
+            super().add_urls(batch)
+            with self.exchange.received.get_lock():
+                self.exchange.received[self.shard] += 1
+
+    def _report(self):
+        coordinator = multiprocessing.parent_process()
+        while not self.exchange.done.wait(REPORT_SECONDS):
+            if coordinator is not None and not coordinator.is_alive():
+                # Stop cleanly, committing progress, rather than crawl on.
+                self.exchange.stop.set()
+                self.exchange.done.set()
+            with self._outbox_lock:
+                buffered = any(self._outbox)
+            # Only this frontier's own hold is left when nothing is queued,
+            # being fetched or parsed.
+            self.exchange.idle[self.shard] = (
+                not buffered and self.to_be_downloaded.outstanding() == 1)
+        if self.exchange.stop.is_set():
+            self.stop()
+        self.to_be_downloaded.finish_loading()
+
+
+def _run_shard(crawl, config, restart, shard, exchange, results):
+    shards = len(exchange.queues)
+    config.save_file = shard_path(config.save_file, shard, shards)
+    config.reject_log = shard_path(config.reject_log, shard, shards)
+    if config.archive_dir:
+        config.archive_dir = shard_path(config.archive_dir, shard, shards)
+    if config.metrics_file:
+        config.metrics_file = shard_path(config.metrics_file, shard, shards)
+    if config.metrics_port:
+        config.metrics_port += shard
+    result = crawl(
+        config, restart,
+        frontier_factory=partial(
+            ShardedFrontier, shard=shard, exchange=exchange))
+    if exchange.stop.is_set():
+        # Nothing may read what is still queued, do not wait on it at exit.
+        for queue in exchange.queues:
+            queue.cancel_join_thread()
+    if multiprocessing.parent_process().is_alive():
+        results.put((shard, result))
+
+
+def run_sharded(crawl, config, restart, shards):
+    ''' Runs crawl(config, restart, frontier_factory=...) in one process per
+    shard and returns what each returned, ordered by shard. Every shard
+    crawls the hosts that shard_of assigns it, with its own save file. '''
+    logger = get_logger("SHARDS")
+    context = multiprocessing.get_context("spawn")
+    exchange = ShardExchange(context, shards)
+    results = context.Queue()
+    processes = [
+        context.Process(
+            target=_run_shard,
+            args=(crawl, config, restart, shard, exchange, results))
+        for shard in range(shards)]
+    for process in processes:
+        process.start()
+    logger.info(f"Started {shards} shards.")
+
+    def interrupt(signum, frame):
+        # The shards drain and commit, then report as usual.
+        logger.info("Interrupted, stopping the shards.")
+        exchange.stop.set()
+        exchange.done.set()
+        signal.signal(signal.SIGINT, previous)
+
+    previous = signal.signal(signal.SIGINT, interrupt)
+    try:
+        exchange.coordinate(processes, logger)
+        returned = dict()
+        while len(returned) < shards:
+            try:
+                shard, result = results.get(timeout=POLL_SECONDS)
+                returned[shard] = result
+            except Empty:
+                if all(process.exitcode is not None for process in processes):
+                    break
+        for process in processes:
+            process.join()
+    finally:
+        signal.signal(signal.SIGINT, previous)
+    missing = set(range(shards)) - returned.keys()
+    if missing:
+        logger.error(f"Shards {sorted(missing)} did not finish.")
+    return [returned[shard] for shard in sorted(returned)]
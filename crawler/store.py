@@ -0,0 +1,416 @@
+import glob
+import json
+import os
+import shelve
+
+from threading import Thread, RLock, Event
+
+from seen_set import DigestSet, BloomFilter, urlhash_digest
+from utils import get_logger
+from utils.metrics import metrics
+
+DURABILITY_LEVELS = ("none", "batch", "sync")
+# Files dbm modules may add to a shelve's name.
+DBM_EXTENSIONS = ("db", "dat", "dir", "bak")
+# Key marking a pending index as built.
+_INDEXED = "__indexed__"
+# Key counting the completed urls still marked in the pending index.
+_COMPLETED = "__completed__"
+# The pending index is rebuilt once completed markers outnumber both the
+# pending urls and this.
+REBUILD_COMPLETED = 1000
+SEEN_KINDS = {"digests": DigestSet, "bloom": BloomFilter}
+
+
+def wal_segments(save_file):
+    ''' Returns the write-ahead log segments of a save file, oldest first. '''
+    segments = glob.glob(f"{glob.escape(save_file)}.wal.*")
+    return sorted(
+        (path for path in segments if path.rsplit(".", 1)[1].isdigit()),
+        key=lambda path: int(path.rsplit(".", 1)[1]))
+
+
+def discard_log(save_file):
+    for path in wal_segments(save_file):
+        os.remove(path)
+
+
+def remove_store(save_file):
+    ''' Deletes a save file, its pending index and its log, whichever dbm
+    files they were stored in. '''
+    discard_log(save_file)
+    if os.path.exists(f"{save_file}.seen"):
+        os.remove(f"{save_file}.seen")
+    for name in (
+            save_file, f"{save_file}.pending", f"{save_file}.pending.new"):
+        remove_dbm(name)
+
+
+def remove_dbm(name):
+    # .dir first, dbm.dumb reads a database without it as empty.
+    for path in [f"{name}.dir", name] + [
+            f"{name}.{ext}" for ext in DBM_EXTENSIONS]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class FrontierStore(object):
+    ''' Shelve backed map of urlhash -> (url, completed) with group commit.
+
+    A second shelve, <save_file>.pending, indexes the urls not completed
+    yet as urlhash -> (url, rules version). The version is the one the url
+    was last validated under, prefixed with "!" if it was rejected, so a
+    resume only reads pending urls and only re-validates them when the
+    rules have changed. Completed urls are marked None rather than deleted,
+    which would rewrite the whole dbm.dumb index each time, and compaction
+    rebuilds the index without them once they outnumber the pending urls.
+
+    Membership is answered from memory by a set of 64-bit url hash digests,
+    saved to <save_file>.seen at each compaction:
+        digests -> a DigestSet of every url hash, about 12-16 bytes a url.
+        bloom   -> a BloomFilter, about 1.2 bytes a url. Urls it has not
+                   seen are answered from memory, the rest from the shelve.
+
+    Writes go to an in-memory overlay and are appended to a write-ahead log
+    that is flushed once `flush_records` records are buffered or every
+    `flush_seconds`. Once `compact_records` records are logged, a background
+    thread merges the overlay into the shelve with a single sync and drops
+    the log segment. Any log left behind by a crash is replayed on open.
+
+    durability:
+        none  -> log is handed to the OS at each group commit.
+        batch -> log is also fsynced at each group commit.
+        sync  -> every record is flushed and fsynced before returning. '''
+
+    def __init__(
+            self, save_file, durability="batch", flush_records=500,
+            flush_seconds=1.0, compact_records=100000, rules_version=None,
+            seen="digests"):
+        assert durability in DURABILITY_LEVELS, (
+            f"Durability should be one of {', '.join(DURABILITY_LEVELS)}.")
+        self.logger = get_logger("STORE", "FRONTIER")
+        self.save_file = save_file
+        self.durability = durability
+        self.flush_records = flush_records
+        self.flush_seconds = flush_seconds
+        self.compact_records = compact_records
+        self.rules_version = rules_version
+        assert seen in SEEN_KINDS, (
+            f"Seen set should be one of {', '.join(SEEN_KINDS)}.")
+
+        self._db = shelve.open(save_file)
+        self._pending = shelve.open(f"{save_file}.pending")
+        self._db_lock = RLock()
+        self._lock = RLock()
+        self._overlay = dict()
+        self._compacting = dict()
+        self._buffer = list()
+        self._logged = 0
+        # Called before each group commit, see Frontier.on_commit.
+        self.commit_hooks = list()
+        if _INDEXED not in self._pending:
+            self._build_pending()
+        if _COMPLETED not in self._pending:
+            self._pending[_COMPLETED] = 0
+        self._completed = self._pending[_COMPLETED]
+        self._seen = self._load_seen(seen)
+        self.seen_lookups = self.seen_misses = 0
+        self._segment = self._replay()
+        self._wal = open(self._segment_path(self._segment), "a", encoding="utf-8")
+
+        self._closed = Event()
+        self._compact_requested = Event()
+        self._flusher = Thread(target=self._run, daemon=True)
+        self._flusher.start()
+
+    def _segment_path(self, segment):
+        return f"{self.save_file}.wal.{segment}"
+
+    def _build_pending(self):
+        # Save files written before the pending index existed.
+        for urlhash in self._db:
+            url, completed = self._db[urlhash]
+            if not completed:
+                self._pending[urlhash] = (url, None)
+        self._pending[_INDEXED] = True
+        self._pending.sync()
+
+    def _rebuild_pending(self):
+        # Caller holds _db_lock, with the shelve synced. Copies the pending
+        # urls to a new index and swaps it in. A crash before the new one
+        # is complete leaves no index, which is then built from the shelve.
+        path = f"{self.save_file}.pending"
+        new_path = f"{path}.new"
+        remove_dbm(new_path)
+        with shelve.open(new_path) as rebuilt:
+            for urlhash in self._pending.keys():
+                if urlhash in (_INDEXED, _COMPLETED):
+                    continue
+                value = self._pending[urlhash]
+                if value is not None:
+                    rebuilt[urlhash] = value
+            rebuilt[_INDEXED] = True
+            rebuilt[_COMPLETED] = 0
+        self._pending.close()
+        remove_dbm(path)
+        # dbm.dumb reads the index from .dir, so it is moved last.
+        for ext in [""] + [f".{ext}" for ext in DBM_EXTENSIONS]:
+            if os.path.exists(f"{new_path}{ext}"):
+                os.replace(f"{new_path}{ext}", f"{path}{ext}")
+        self._pending = shelve.open(path)
+        self.logger.info(
+            f"Rebuilt the pending index of {self.save_file} without "
+            f"{self._completed} completed urls.")
+        self._completed = 0
+
+    def _seen_path(self):
+        return f"{self.save_file}.seen"
+
+    def _load_seen(self, kind):
+        # A seen set saved for another kind, or none (older save files and
+        # new ones), is built from the shelve keys.
+        path = self._seen_path()
+        if os.path.exists(path):
+            with open(path, "rb") as saved:
+                if saved.read(16).rstrip(b"\0").decode() == kind:
+                    return SEEN_KINDS[kind].fromfile(saved)
+        seen = SEEN_KINDS[kind]()
+        for urlhash in self._db:
+            seen.add(urlhash_digest(urlhash))
+        return seen
+
+    def _save_seen(self, seen):
+        # seen must not hold a url whose record is not in the shelve or a
+        # log segment yet.
+        path = self._seen_path()
+        kind = next(k for k, cls in SEEN_KINDS.items() if isinstance(seen, cls))
+        with open(f"{path}.tmp", "wb") as saved:
+            saved.write(kind.encode().ljust(16, b"\0"))
+            seen.tofile(saved)
+            saved.flush()
+            os.fsync(saved.fileno())
+        os.replace(f"{path}.tmp", path)
+
+    def _apply(self, urlhash, url, completed, version):
+        # Caller holds _db_lock.
+        self._db[urlhash] = (url, completed)
+        if completed:
+            if urlhash in self._pending:
+                # A smaller value is written over the old one in place.
+                self._pending[urlhash] = None
+                self._completed += 1
+        else:
+            self._pending[urlhash] = (url, version)
+
+    def _record(self, urlhash, url, completed, version):
+        # Caller holds _lock.
+        self._seen.add(urlhash_digest(urlhash))
+        self._overlay[urlhash] = (url, completed, version)
+        self._buffer.append(
+            json.dumps([urlhash, url, completed, version]) + "\n")
+        if (self.durability == "sync"
+                or len(self._buffer) >= self.flush_records):
+            self.flush()
+
+    def _replay(self):
+        ''' Applies log segments left by an unclean shutdown to the shelve
+        and returns the number of the next segment to write. '''
+        segments = wal_segments(self.save_file)
+        if not segments:
+            return 0
+        replayed = 0
+        for path in segments:
+            with open(path, encoding="utf-8") as wal:
+                for line in wal:
+                    try:
+                        urlhash, url, completed, *version = json.loads(line)
+                    except ValueError:
+                        # Torn write at the tail of the log.
+                        continue
+                    self._apply(
+                        urlhash, url, completed, version[0] if version else None)
+                    self._seen.add(urlhash_digest(urlhash))
+                    replayed += 1
+        self._db.sync()
+        self._pending[_COMPLETED] = self._completed
+        self._pending.sync()
+        self._save_seen(self._seen)
+        for path in segments:
+            os.remove(path)
+        self.logger.info(
+            f"Replayed {replayed} records from {len(segments)} log segments "
+            f"of {self.save_file}.")
+        return int(segments[-1].rsplit(".", 1)[1]) + 1
+
+    def __contains__(self, urlhash):
+        return not self.missing((urlhash,))
+
+    def missing(self, urlhashes):
+        ''' Returns the url hashes out of urlhashes that are not stored. '''
+        with self._lock:
+            self.seen_lookups += len(urlhashes)
+            maybe = {
+                urlhash for urlhash in urlhashes
+                if urlhash_digest(urlhash) in self._seen}
+            self.seen_misses += len(urlhashes) - len(maybe)
+            if isinstance(self._seen, DigestSet):
+                return [h for h in urlhashes if h not in maybe]
+            # Bloom filter false positives are told apart by the shelve.
+            found = {
+                urlhash for urlhash in maybe
+                if urlhash in self._overlay or urlhash in self._compacting}
+        with self._db_lock:
+            found.update(
+                urlhash for urlhash in maybe
+                if urlhash not in found and urlhash in self._db)
+        return [urlhash for urlhash in urlhashes if urlhash not in found]
+
+    def seen_stats(self):
+        with self._lock:
+            return {
+                "kind": type(self._seen).__name__,
+                "urls": len(self._seen),
+                "bytes": self._seen.nbytes,
+                "lookups": self.seen_lookups,
+                "answered_in_memory": self.seen_misses + (
+                    self.seen_lookups - self.seen_misses
+                    if isinstance(self._seen, DigestSet) else 0)}
+
+    def __getitem__(self, urlhash):
+        with self._lock:
+            if urlhash in self._overlay:
+                return self._overlay[urlhash][:2]
+            if urlhash in self._compacting:
+                return self._compacting[urlhash][:2]
+        with self._db_lock:
+            return self._db[urlhash]
+
+    def __setitem__(self, urlhash, value):
+        url, completed = value
+        with self._lock:
+            self._record(urlhash, url, completed, self.rules_version)
+
+    def validated(self, urlhash, url, valid):
+        ''' Records that a pending url was validated under rules_version. '''
+        version = self.rules_version if valid else f"!{self.rules_version}"
+        with self._lock:
+            if urlhash in self._overlay and self._overlay[urlhash][1]:
+                # Completed in the meantime.
+                return
+            self._record(urlhash, url, False, version)
+
+    def __len__(self):
+        with self._lock, self._db_lock:
+            pending = self._overlay.keys() | self._compacting.keys()
+            return len(self._db) + sum(1 for h in pending if h not in self._db)
+
+    def __bool__(self):
+        with self._lock:
+            if self._overlay or self._compacting:
+                return True
+        with self._db_lock:
+            return len(self._db) > 0
+
+    def values(self):
+        with self._lock, self._db_lock:
+            pending = dict(self._compacting)
+            pending.update(self._overlay)
+            for urlhash in self._db:
+                if urlhash not in pending:
+                    yield self._db[urlhash]
+            for url, completed, _ in pending.values():
+                yield url, completed
+
+    def pending(self, batch_size=1000):
+        ''' Yields (urlhash, url, version) for every url not completed,
+        without reading completed ones. Locks are only held per batch, so
+        the store stays usable while this is consumed. '''
+        with self._lock:
+            recent = dict(self._compacting)
+            recent.update(self._overlay)
+        with self._db_lock:
+            urlhashes = [
+                h for h in self._pending.keys()
+                if h not in (_INDEXED, _COMPLETED)]
+        for start in range(0, len(urlhashes), batch_size):
+            batch = list()
+            with self._db_lock:
+                for urlhash in urlhashes[start:start + batch_size]:
+                    if urlhash in recent or urlhash not in self._pending:
+                        continue
+                    value = self._pending[urlhash]
+                    if value is not None:
+                        batch.append((urlhash, *value))
+            yield from batch
+        for urlhash, (url, completed, version) in recent.items():
+            if not completed:
+                yield urlhash, url, version
+
+    def sync(self):
+        self.flush()
+
+    def flush(self):
+        ''' Group commit: writes out all buffered log records at once. '''
+        with self._lock:
+            if not self._buffer:
+                return
+            with metrics.timer("commit hooks"):
+                for hook in self.commit_hooks:
+                    hook()
+            with metrics.timer("save commit"):
+                self._wal.write("".join(self._buffer))
+                self._wal.flush()
+                if self.durability != "none":
+                    os.fsync(self._wal.fileno())
+            self._logged += len(self._buffer)
+            self._buffer.clear()
+            if self._logged >= self.compact_records:
+                self._compact_requested.set()
+
+    def compact(self):
+        ''' Merges everything logged so far into the shelve and deletes the
+        log segment holding it. Lookups keep working while this runs. '''
+        with self._lock:
+            self.flush()
+            if not self._overlay:
+                return
+            self._wal.close()
+            old_segment = self._segment_path(self._segment)
+            self._segment += 1
+            self._wal = open(
+                self._segment_path(self._segment), "a", encoding="utf-8")
+            self._compacting, self._overlay = self._overlay, dict()
+            self._logged = 0
+            # Everything in it is in the shelve or the old segment now.
+            seen = self._seen.copy()
+        with self._db_lock, metrics.timer("save compact"):
+            for urlhash, value in self._compacting.items():
+                self._apply(urlhash, *value)
+            self._db.sync()
+            pending = len(self._pending) - 2 - self._completed
+            if self._completed > max(pending, REBUILD_COMPLETED):
+                self._rebuild_pending()
+            self._pending[_COMPLETED] = self._completed
+            self._pending.sync()
+        self._save_seen(seen)
+        with self._lock:
+            self._compacting = dict()
+        os.remove(old_segment)
+
+    def _run(self):
+        while not self._closed.wait(self.flush_seconds):
+            self.flush()
+            if self._compact_requested.is_set():
+                self._compact_requested.clear()
+                self.compact()
+
+    def close(self):
+        self._closed.set()
+        self._flusher.join()
+        self.compact()
+        with self._lock:
+            self._wal.close()
+            os.remove(self._segment_path(self._segment))
+        with self._db_lock:
+            self._db.close()
+            self._pending.close()
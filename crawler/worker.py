@@ -1,10 +1,39 @@
-from threading import Thread
+import time
+
+from hashlib import sha256
+from threading import Thread, Lock
 
-from inspect import getsource
 from utils.download import download
+from utils.archive import get_archive
+from crawler.parse_stage import get_parse_stage
 from utils import get_logger
+from utils.metrics import metrics
 import scraper
-import time
+
+# Imports scraper.py must not use, pages only come through the cache server.
+FORBIDDEN_IMPORTS = {
+    "requests": ("from requests import", "import requests"),
+    "urllib.request": ("from urllib.request import", "import urllib.request")}
+# {sha256 of scraper.py: forbidden imports it uses}
+_checked = dict()
+_checked_lock = Lock()
+
+
+def check_scraper(path=scraper.__file__):
+    ''' Asserts scraper.py uses none of FORBIDDEN_IMPORTS. The source is
+    only scanned once per version of the file. '''
+    with open(path, "rb") as source:
+        content = source.read()
+    digest = sha256(content).hexdigest()
+    with _checked_lock:
+        used = _checked.get(digest)
+        if used is None:
+            text = content.decode("utf-8", "replace")
+            used = _checked[digest] = [
+                name for name, spellings in FORBIDDEN_IMPORTS.items()
+                if any(spelling in text for spelling in spellings)]
+    for name in used:
+        raise AssertionError(f"Do not use {name} in scraper.py")
 
 
 class Worker(Thread):
@@ -12,9 +41,10 @@ class Worker(Thread):
         self.logger = get_logger(f"Worker-{worker_id}", "Worker")
         self.config = config
         self.frontier = frontier
+        self.archive = get_archive(config)
+        self.parse_stage = get_parse_stage(config)
         # basic check for requests in scraper
-        assert {getsource(scraper).find(req) for req in {"from requests import", "import requests"}} == {-1}, "Do not use requests in scraper.py"
-        assert {getsource(scraper).find(req) for req in {"from urllib.request import", "import urllib.request"}} == {-1}, "Do not use urllib.request in scraper.py"
+        check_scraper()
         super().__init__(daemon=True)
         
     def run(self):
@@ -23,12 +53,44 @@ class Worker(Thread):
             if not tbd_url:
                 self.logger.info("Frontier is empty. Stopping Crawler.")
                 break
-            resp = download(tbd_url, self.config, self.logger)
-            self.logger.info(
-                f"Downloaded {tbd_url}, status <{resp.status}>, "
-                f"using cache {self.config.cache_server}.")
-            scraped_urls = scraper.scraper(tbd_url, resp)
-            for scraped_url in scraped_urls:
-                self.frontier.add_url(scraped_url)
+            handed_off = False
+            try:
+                start = time.perf_counter()
+                resp = download(tbd_url, self.config, self.logger)
+                self.record_download(tbd_url, resp, start)
+                handed_off = self.process(tbd_url, resp)
+            finally:
+                # Politeness is enforced per host by the frontier, which
+                # keeps the host reserved until the url is marked complete.
+                if not handed_off:
+                    self.frontier.mark_url_complete(tbd_url)
+
+    def record_download(self, tbd_url, resp, start):
+        seconds = time.perf_counter() - start
+        metrics.observe("download", seconds)
+        self.frontier.record_fetch(tbd_url, resp.status, seconds)
+
+    def process(self, tbd_url, resp):
+        self.logger.info(
+            f"Downloaded {tbd_url}, status <{resp.status}>, "
+            f"using cache {self.config.cache_server}.")
+        metrics.count("pages")
+        metrics.count(f"status {resp.status}")
+        if self.archive:
+            with metrics.timer("archive"):
+                self.archive.append(tbd_url, resp)
+        if self.parse_stage:
+            # The page is parsed in another process; the url is marked
+            # complete once its outlinks are added. Returns True for that.
+            self.frontier.mark_url_fetched(tbd_url)
+            self.parse_stage.submit(tbd_url, resp, self._record)
+            return True
+        self.frontier.add_urls(scraper.scraper(tbd_url, resp))
+        return False
+
+    def _record(self, tbd_url, page):
+        try:
+            self.frontier.add_urls(
+                scraper.filter_valid(scraper.record_page(tbd_url, page)))
+        finally:
             self.frontier.mark_url_complete(tbd_url)
-            time.sleep(self.config.time_delay)
\ No newline at end of file
@@ -0,0 +1,96 @@
+from urllib.parse import urljoin, urldefrag, urlparse
+from lxml import etree
+
+# Text inside these tags is not visible on the page.
+SKIPPED_TAGS = {"script", "style", "noscript"}
+
+
+class Document(object):
+    ''' A page parsed once, shared by every consumer of it.
+
+    Attributes:
+        url: The url the page was fetched from (after redirects).
+        links: Absolute, defragmented outlinks in page order, no duplicates.
+        text: Visible text, the strings of the page stripped and joined by
+            single spaces. '''
+
+    def __init__(self, url, links, text):
+        self.url = url
+        self.links = links
+        self.text = text
+
+
+class _Extractor(object):
+    ''' lxml parser target. Collects hrefs and visible strings from the
+    parser's events without building a tree. '''
+
+    def __init__(self):
+        self.hrefs = list()
+        self.strings = list()
+        self._pending = list()
+        self._skip_depth = 0
+
+    def _flush(self):
+        if self._pending:
+            text = "".join(self._pending).strip()
+            if text:
+                self.strings.append(text)
+            self._pending = list()
+
+    def start(self, tag, attrib):
+        self._flush()
+        if tag in SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag == "a":
+            href = attrib.get("href")
+            if href is not None:
+                self.hrefs.append(href)
+
+    def end(self, tag):
+        self._flush()
+        if tag in SKIPPED_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+
+    def data(self, data):
+        if not self._skip_depth:
+            self._pending.append(data)
+
+    def comment(self, text):
+        self._flush()
+
+    def close(self):
+        self._flush()
+        return self
+
+
+def parse_document(url, content):
+    ''' Parses html bytes in a single streaming pass. url is used as the
+    base for relative links. '''
+    extractor = _Extractor()
+    parser = etree.HTMLParser(target=extractor)
+    try:
+        parser.feed(content)
+        parser.close()
+    except etree.LxmlError:
+        # Keep whatever was extracted before the parser gave up.
+        extractor.close()
+
+    links = list()
+    seen_on_page = set()
+    for href in extractor.hrefs:
+        href = href.strip()
+        if not href:
+            continue
+        # Absolute url without the fragment, so #... is not a new page.
+        try:
+            abs_url, _ = urldefrag(urljoin(url, href))
+            parsed = urlparse(abs_url)
+        except ValueError:
+            continue
+        # Lowercase hostname only (keep the path).
+        if parsed.netloc:
+            abs_url = parsed._replace(netloc=parsed.netloc.lower()).geturl()
+        if abs_url not in seen_on_page:
+            seen_on_page.add(abs_url)
+            links.append(abs_url)
+    return Document(url, links, " ".join(extractor.strings))
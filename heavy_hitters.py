@@ -0,0 +1,80 @@
+from collections import Counter
+from heapq import nlargest
+
+
+class SpaceSaving(object):
+    ''' Approximate word counts in bounded memory (Space-Saving).
+
+    Keeps at most 2 * capacity words. When that fills up, only (at most)
+    the capacity most frequent are kept and `floor` is raised to the largest count
+    dropped. A word that is not kept starts again at floor + its increments,
+    so for every kept word
+
+        count - error <= true count <= count
+
+    and no word whose true count is above floor can be missing. '''
+
+    def __init__(self, capacity=10000):
+        self.capacity = capacity
+        self.floor = 0
+        self.total = 0
+        self._counts = Counter()
+        self._errors = dict()
+
+    def __len__(self):
+        return len(self._counts)
+
+    def update(self, words):
+        ''' Adds an iterable of words, or a mapping of word -> increment. '''
+        counts = self._counts
+        if hasattr(words, "items"):
+            self.total += sum(words.values())
+        else:
+            words = words if isinstance(words, (list, tuple)) else list(words)
+            self.total += len(words)
+        if self.floor:
+            new = dict.fromkeys(set(words) - counts.keys(), self.floor)
+            dict.update(counts, new)
+            self._errors.update(new)
+        counts.update(words)
+        if len(counts) > 2 * self.capacity:
+            self._shrink()
+
+    def _shrink(self):
+        # Keeps the words counted above the (capacity + 1)th largest count
+        threshold = sorted(self._counts.values(), reverse=True)[self.capacity]
+        self.floor = max(self.floor, threshold)
+        self._counts = Counter({
+            word: count for word, count in self._counts.items()
+            if count > threshold})
+        self._errors = {
+            word: error for word, error in self._errors.items()
+            if word in self._counts}
+
+    def merge(self, other):
+        ''' Adds the counts of another summary. A word missing from one side
+        may have had up to that side's floor there. '''
+        counts, errors = dict(), dict()
+        for word in self._counts.keys() | other._counts.keys():
+            counts[word] = (
+                self._counts.get(word, self.floor)
+                + other._counts.get(word, other.floor))
+            errors[word] = (
+                self._errors.get(word, 0 if word in self._counts else self.floor)
+                + other._errors.get(
+                    word, 0 if word in other._counts else other.floor))
+        self.floor += other.floor
+        self.total += other.total
+        self._counts = Counter(counts)
+        self._errors = {word: error for word, error in errors.items() if error}
+        if len(self._counts) > 2 * self.capacity:
+            self._shrink()
+
+    def most_common(self, n=None):
+        ''' [(word, count, error), ...] by descending count. '''
+        if n is None:
+            n = len(self._counts)
+        return [
+            (word, count, self._errors.get(word, 0))
+            for word, count in nlargest(
+                n, self._counts.items(), key=lambda item: item[1])]
@@ -1,26 +1,95 @@
+import time
+# Set before the crawler is imported, startup time is reported from it.
+STARTED = time.perf_counter()
+
 from configparser import ConfigParser
 from argparse import ArgumentParser
 
-from utils.server_registration import get_cache_server
 from utils.config import Config
 from crawler import Crawler
+from crawler.frontier import Frontier
+from crawler.shards import run_sharded
+from crawler.worker import Worker
+from utils.metrics import start_reporter, metrics
 
+import word_stats
 from word_stats import write_report
+from scraper import rejections, duplicates, traps
+from utils.canonical import canonicalizer
+
+IMPORT_SECONDS = time.perf_counter() - STARTED
 
-def main(config_file, restart):
+def main(config_file, restart, cache_server=None, shards=1):
     cparser = ConfigParser()
     cparser.read(config_file)
     config = Config(cparser)
-    config.cache_server = get_cache_server(config, restart)
-    crawler = Crawler(config, restart)
-    crawler.start()
+    if cache_server:
+        # Skip registration and use a known cache, e.g. the local stand-in
+        # in benchmarks/cache_server.py.
+        host, port = cache_server.rsplit(":", 1)
+        config.cache_server = (host, int(port))
+    else:
+        from utils.server_registration import get_cache_server
+        config.cache_server = get_cache_server(config, restart)
+    if shards > 1:
+        # Each shard process crawls part of the hosts, see crawler/shards.py.
+        word_stats.configure_counter(config)
+        blocked = dict()
+        for state, rejected, shard_blocked in run_sharded(
+                crawl, config, restart, shards):
+            word_stats.merge_state(state)
+            rejections.merge_counts(*rejected)
+            blocked.update(shard_blocked)
+    else:
+        blocked = crawl(config, restart)[2]
     
     # print stats after crawl is finished
     write_report()
+    rejections.write_report()
+    traps.write_report(blocked)
+
+def worker_class(config):
+    # The worker for DOWNLOAD_MODE.
+    if config.download_mode == "async":
+        # Only imported in async mode, with its event loop.
+        from crawler.async_worker import AsyncWorker
+        return AsyncWorker
+    return Worker
+
+def crawl(config, restart, frontier_factory=Frontier, worker_factory=None):
+    # Runs one crawler to the end and returns its analytics.
+    word_stats.configure(config, restart)
+    rejections.configure(config)
+    duplicates.configure(config, restart)
+    traps.configure(config, restart)
+    canonicalizer.configure(config)
+    reporter = start_reporter(config)
+    if worker_factory is None:
+        worker_factory = worker_class(config)
+    crawler = Crawler(
+        config, restart, frontier_factory=frontier_factory,
+        worker_factory=worker_factory)
+    metrics.observe("startup imports", IMPORT_SECONDS)
+    crawler.logger.info(
+        f"Imported the crawler in {IMPORT_SECONDS:.3f}s, ready to crawl "
+        f"{time.perf_counter() - STARTED:.3f}s after start.")
+    # Analytics are checkpointed along with the frontier.
+    crawler.frontier.on_commit(word_stats.checkpoint)
+    crawler.frontier.on_commit(traps.checkpoint)
+    crawler.start()
+    if reporter:
+        reporter.close()
+    duplicates.close()
+    traps.close()
+    word_stats.close()
+    rejections.flush()
+    return word_stats.export_state(), rejections.counts(), traps.blocked()
 
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("--restart", action="store_true", default=False)
     parser.add_argument("--config_file", type=str, default="config.ini")
+    parser.add_argument("--cache_server", type=str, default=None)
+    parser.add_argument("--shards", type=int, default=1)
     args = parser.parse_args()
-    main(args.config_file, args.restart)
\ No newline at end of file
+    main(args.config_file, args.restart, args.cache_server, args.shards)
\ No newline at end of file
@@ -0,0 +1,98 @@
+import os
+
+from argparse import ArgumentParser
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.archive import segment_paths, segment_length, read_segment
+import scraper
+import word_stats
+
+# Records per replay task, so one large segment still spreads over the pool.
+TASK_RECORDS = 2000
+# Rejected urls are logged here, in the archive, unless --reject_log says
+# otherwise, so they do not mix with the live crawl's log.
+REPLAY_REJECT_LOG = "rejected_urls.replay.log"
+
+
+def replay_records(task):
+    ''' Runs scraper.scraper over a slice (path, start, stop) of a segment
+    and returns the number of pages. '''
+    path, start, stop = task
+    pages = 0
+    for url, resp in read_segment(path, start, stop):
+        scraper.scraper(url, resp)
+        pages += 1
+    return pages
+
+
+def _start_process(reject_log):
+    # Every pool process logs its rejections to its own file.
+    scraper.rejections.path = f"{reject_log}.{os.getpid()}"
+
+
+def replay(task):
+    ''' replay_records in a pool process. Also returns the word stats,
+    rejection counts, (exact, near) duplicates and blocked trap templates
+    of the slice. Duplicates and traps are only found among the pages one
+    process replays. '''
+    word_stats.reset()
+    scraper.rejections.flush()
+    reasons, hosts = scraper.rejections.counts()
+    exact, near = scraper.duplicates.exact, scraper.duplicates.near
+    pages = replay_records(task)
+    scraper.rejections.flush()
+    new_reasons, new_hosts = scraper.rejections.counts()
+    return (
+        pages, word_stats.export_state(),
+        (new_reasons - reasons, new_hosts - hosts),
+        (scraper.duplicates.exact - exact, scraper.duplicates.near - near),
+        scraper.traps.blocked())
+
+
+def main(archive_dir, processes, reject_log=None):
+    scraper.rejections.path = reject_log or os.path.join(
+        archive_dir, REPLAY_REJECT_LOG)
+    tasks = list()
+    for path in segment_paths(archive_dir):
+        length = segment_length(path)
+        for start in range(0, length, TASK_RECORDS):
+            tasks.append((path, start, min(start + TASK_RECORDS, length)))
+
+    pages = 0
+    duplicates = Counter()
+    if processes > 1:
+        blocked = dict()
+        with ProcessPoolExecutor(
+                processes, initializer=_start_process,
+                initargs=(scraper.rejections.path,)) as pool:
+            for task_pages, state, rejected, (exact, near), task_blocked in (
+                    pool.map(replay, tasks)):
+                pages += task_pages
+                word_stats.merge_state(state)
+                scraper.rejections.merge_counts(*rejected)
+                duplicates.update(exact=exact, near=near)
+                blocked.update(task_blocked)
+    else:
+        for task in tasks:
+            pages += replay_records(task)
+        duplicates.update(
+            exact=scraper.duplicates.exact, near=scraper.duplicates.near)
+        blocked = scraper.traps.blocked()
+
+    print(
+        f"Replayed {pages} archived responses from {archive_dir}, "
+        f"{duplicates['exact']} exact and {duplicates['near']} near "
+        f"duplicates.")
+    word_stats.write_report()
+    scraper.rejections.write_report()
+    scraper.traps.write_report(blocked)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--archive", type=str, required=True)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--reject_log", type=str, default=None)
+    args = parser.parse_args()
+    main(args.archive, args.processes, args.reject_log)
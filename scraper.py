@@ -1,18 +1,47 @@
 import re
-from urllib.parse import urlparse, urljoin, urldefrag
-from bs4 import BeautifulSoup
-import nltk
-nltk.download('stopwords')
-from nltk.corpus import stopwords
-from collections import Counter
+from url_filter import UrlFilter, Rule, AnyPattern, rules_version
+from utils.rejection_log import RejectionLog
+from simhash import DuplicateIndex
+from trap_detector import TrapDetector
+from utils.metrics import metrics
+from utils.canonical import canonicalize
+from collections import Counter, namedtuple
 unique_pages = set()
 
 REJECTED_LOGS = "rejected_urls.log"
+#Buffered in a background thread, see utils/rejection_log.py
+rejections = RejectionLog(REJECTED_LOGS)
+#SimHash fingerprints of crawled pages, see simhash.py
+duplicates = DuplicateIndex()
+#Yield per url template, blocks templates that stop yielding anything new
+traps = TrapDetector()
+
+ALLOWED_DOMAINS = re.compile(r"(?:^|\.)(?:ics|cs|informatics|stat)\.uci\.edu\Z")
+GITLAB_SECTIONS = re.compile(
+    r"/-/(?:commits?/|tree/|tags|compare|merge_requests|issues|pipelines"
+    r"|jobs|branches|project_members|activity|blob/)")
+GITLAB_HASH = re.compile(r"/[0-9a-f]{32,}(?:/|$)")
+FILE_EXTENSIONS = (
+    r"\.(?:css|js|bmp|gif|jpe?g|ico"
+    r"|png|tiff?|mid|mp2|mp3|mp4"
+    r"|wav|avi|mov|mpeg|ram|m4v|mkv|ogg|ogv|pdf"
+    r"|ps|eps|tex|ppt|pptx|doc|docx|xls|xlsx|names"
+    r"|data|dat|exe|bz2|tar|msi|bin|7z|psd|dmg|iso"
+    r"|epub|dll|cnf|tgz|sha1"
+    r"|thmx|mso|arff|rtf|jar|csv"
+    r"|rm|smil|wmv|swf|wma|zip|rar|gz"
+    r"|txt|c|h|cpp|cc|py|java)$")
+
+from document import parse_document
+from word_stats import update_page, page_tokens
+#What a worker needs from a page, picklable so it can come from another
+#process (see PARSE_PROCESSES in config.ini)
+PageAnalysis = namedtuple(
+    "PageAnalysis", ["url", "links", "words", "word_count", "fingerprint"])
 
-from word_stats import update_from_html
 def scraper(url, resp):
     links = extract_next_links(url, resp)
-    return [link for link in links if is_valid(link)]
+    return filter_valid(links)
 
 def extract_next_links(url, resp):
     # Implementation required.
@@ -25,248 +54,201 @@ def extract_next_links(url, resp):
     #         resp.raw_response.content: the content of the page!
     # Return a list with the hyperlinks (as strings) scrapped from resp.raw_response.content
 
-    #Stores all hyperlinks extracted from the page
-    out_links = []
+    return record_page(url, analyze_page(url, resp))
+
+def analyze_page(url, resp):
+    # The CPU heavy half of extract_next_links. Only reads the response, so
+    # it can run in a process pool.
+
+    with metrics.timer("parse"):
+        #Step 1-4: validate the response and parse it once
+        doc = parse_response(url, resp)
+        if doc is None:
+            return None
+
+        with metrics.timer("tokenize"):
+            tokens = page_tokens(doc)
+        return PageAnalysis(
+            doc.url, doc.links, Counter(tokens), len(tokens),
+            duplicates.fingerprint(tokens))
+
+def record_page(url, page):
+    # The other half: updates the crawl's state with an analyzed page and
+    # returns its outlinks.
+    if page is None:
+        traps.observe(url)
+        return []
+
+    #Skip stats and outlinks of pages (nearly) identical to a crawled page
+    with metrics.timer("duplicate check"):
+        if duplicates.check_and_add(page.fingerprint, url):
+            metrics.count("duplicate pages")
+            traps.observe(url, duplicate=True)
+            return []
+    traps.observe(url, page.words, page.links)
 
-    #Step 1: validate response
-    #if resp is missing or has no raw_response, there is no page to parse
-    if resp is None or resp.raw_response is None:
-        return out_links
-
-    #Allow 200-399 so redirects don't stop the crawl
-    if resp.status < 200 or resp.status >= 400:
-        return out_links
+    # Update word stats only for pages we consider valid for this crawl
+    if is_valid(page.url):
+        with metrics.timer("stats update"):
+            update_page(page.url, page.words, page.word_count)
 
-    #save raw response URL
-    raw = resp.raw_response
+    #outlinks come from the same parse as the word stats
+    return page.links
 
-    #Step 2: check if content exists
-    content = raw.content
-    if not content:
-        return out_links
+def parse_response(url, resp):
+    # Returns the parsed Document for an html response, or None if there
+    # is no page to parse. Every consumer of the page reads from it.
 
-    #Treat extremely tiny bodies as "no data"
-    if len(content) < 100:
-        return out_links
+    #Step 1: validate response, before the page is unpickled
+    if resp is None:
+        return None
 
-    #Step 3: check if content type is HTML
-    ctype = (raw.headers.get("Content-Type") or "").lower()
+    #Allow 200-399 so redirects don't stop the crawl
+    if resp.status < 200 or resp.status >= 400:
+        return None
+
+    #Treat extremely tiny pages as "no data" (size is the body's length)
+    if resp.size < 100:
+        return None
+
+    #Step 2: check if content type is HTML. Only the status and headers are
+    #unpickled for it, the body stays in the pickle.
+    headers = resp.headers
+    if headers is None:
+        return None
+    ctype = (headers.get("Content-Type") or "").lower()
     if "text/html" not in ctype:
-        return out_links
+        return None
 
-    #Step 4: parse HTML and extract links
-    soup = BeautifulSoup(content, "lxml")
+    #Step 3: check if content exists. The body is copied out of the pickle
+    #here, already cut to MAX_BODY_BYTES.
+    raw = resp.raw_response
+    if raw is None:
+        return None
+    content = raw.content
+    if not content or len(content) < 100:
+        return None
 
+    #Step 4: parse HTML and extract links and text in one pass
     #Use final downloaded URL as base (handles redirects)
     base = raw.url or url
+    return parse_document(base, content)
 
-    # Update word stats only for pages we consider valid for this crawl
-    if is_valid(base):
-        update_from_html(base, content)
+def is_valid(url):
+    # Decide whether to crawl this url or not.
+    # If you decide to crawl it, return True; otherwise return False.
+    # The conditions that return False are the URL_RULES below.
+    try:
+        return _url_filter.is_valid(url)
+    except TypeError:
+        print ("TypeError for ", url)
+        raise
 
-    #update word stats
-    update_from_html(base, content)
+def filter_valid(urls):
+    # Same as [url for url in urls if is_valid(url)], but checks the whole
+    # list against the verdict cache at once. Rules see the canonical url,
+    # so ports, case or dot segments don't get a url past them. The urls
+    # are returned as found, the frontier counts the spellings it merged.
+    with metrics.timer("filter"):
+        canonical = [canonicalize(url) for url in urls]
+        valid = set(_url_filter.filter(canonical))
+        return [
+            url for url, canonical_url in zip(urls, canonical)
+            if canonical_url in valid and not is_trap(canonical_url)]
+
+def is_trap(url):
+    #Templates the trap detector learned to block, see trap_detector.py.
+    #Not cached like the rules, a template can be blocked at any time.
+    if traps.reason(url) is None:
+        return False
+    reject_and_log(url, "learned trap template")
+    return True
+    
+#write to a file so I can see what files are getting rejected
+def reject_and_log(url, exp):
+    #only enqueues, the file is written in batches by another thread
+    rejections.record(url, exp)
 
-    #Avoid duplicates on the same page
-    seen_on_page = set()
+#Rules used by is_valid, each rejecting a url with the given reason.
+#url_filter.UrlFilter compiles them once, runs the cheapest ones first,
+#reorders them by how often they reject, and caches the verdict per url.
+#Tests get a url_filter.UrlParts (netloc, path and query are lowercased).
+def on_gitlab(test):
+    return lambda p: "gitlab.ics.uci.edu" in p.netloc and test(p)
 
-    #Loop through all anchor tags with href
-    for a in soup.find_all("a", href = True):
-        #Get the href and clean
-        href = (a.get("href") or "").strip()
-        if not href:
-            continue
+URL_RULES = [
+    #only allow http/https
+    Rule("not http https", lambda p: p.scheme not in ("http", "https")),
 
-        #Convert relative URLs into absolute URLs
-        abs_url = urljoin(base, href)
+    #skip the eppstein pix gallery due to being nearly all pictures with low value captions
+    Rule("eppstein pix gallery", lambda p: p.netloc == "ics.uci.edu"
+         and p.path.startswith("/~eppstein/pix/")),
 
-        #Remove fragments (#...) so they dont count as different pages
-        abs_url, _ = urldefrag(abs_url)
+    #only allow the required domains
+    Rule("not in allowed domain", lambda p: not ALLOWED_DOMAINS.search(p.netloc)),
 
-        #Lowercase hostname only (keep the path)
-        p = urlparse(abs_url)
-        if p.netloc:
-            abs_url = p._replace(netloc=p.netloc.lower()).geturl()
+    #avoid extremely long URLS
+    Rule("len > 300", lambda p: len(p.url) > 300),
 
-        #Only add the URL once per page
-        if abs_url not in seen_on_page:
-            seen_on_page.add(abs_url)
-            out_links.append(abs_url)
-    #return the list
-    return out_links
+    #avoid session ids (also catches jsessionid)
+    Rule("jsessionid sessionid lower url", lambda p: "sessionid" in p.lower_url),
 
-def is_valid(url):
-    # Decide whether to crawl this url or not.
-    # If you decide to crawl it, return True; otherwise return False.
-    # There are already some conditions that return False.
-    try:
-        parsed = urlparse(url)
-        path = (parsed.path or "").lower()
-
-        #skip the eppstein pix gallery due to being nearly all pictures with low value captions
-        netloc = parsed.netloc.lower()
-        if netloc == "ics.uci.edu" and path.startswith("/~eppstein/pix/"):
-            reject_and_log(url, "eppstein pix gallery")
-            return False
-
-        #only allow http/https
-        if parsed.scheme not in set(["http", "https"]):
-            reject_and_log(url, "not http https")
-            return False
-
-        #only allow the required domains
-        allowed = ["ics.uci.edu", "cs.uci.edu", "informatics.uci.edu", "stat.uci.edu"]
-        if not any(netloc == d or netloc.endswith("." + d) for d in allowed):
-            reject_and_log(url, "not in allowed domain")
-            return False
+    #avoid directory listing sort traps
+    Rule("c= o=", lambda p: "c=" in p.query and "o=" in p.query),
 
+    #path traps, checked with one combined regex
+    AnyPattern("path", {
         #Avoid pages that have a bunch of dates at the end
-        if re.search(r"/\d{4}-\d{2}-\d{2}", path):
-            reject_and_log(url, "date sequence")
-            return False
-        
-        #Avoid lengthy urls
-        segments_num = [s for s in parsed.path.split("/") if s]
-        if len(segments_num) > 8:
-            reject_and_log(url, "too deep path")
-            return False
-        
-        #avoid extremely long URLS
-        if len(url) > 300:
-            reject_and_log(url, "len > 300")
-            return False
-    
-        #avoid session ids
-        lower_url = url.lower()
-        if "jsessionid" in lower_url or "sessionid" in lower_url:
-            reject_and_log(url, "jsessionid sessionid lower url")
-            return False
-    
-        #avoid directory listing sort traps
-        if "c=" in parsed.query.lower() and "o=" in parsed.query.lower():
-            reject_and_log(url, "c= o=")
-            return False
-
-        q = (parsed.query or "").lower()
-
-        #WordPress calendar + login traps
-        #if "isg.ics.uci.edu" in netloc:
-        #block login/admin 
-        if path.startswith("/wp-login.php") or path.startswith("/wp-admin"):
-            reject_and_log(url, "login or admin")
-            return False
-
-        #block calendar params
-        bad_params = [
-            "outlook-ical", "ical",          # export
-            "eventdisplay",                  # past/list views
-            "tribe-bar-date", "tribebar-date",# date pagination
-            "paged", "page", "offset"        # generic paging
-        ]
-        if any(bp in q for bp in bad_params):
-            reject_and_log(url, "bad params")
-            return False
-
+        "date sequence": r"/\d{4}-\d{2}-\d{2}",
+        #WordPress login/admin
+        "login or admin": r"\A/wp-(?:login\.php|admin)",
         #block endless calendar pages but keep event pages
-        if path.startswith("/events/tag/") or path.startswith("/events/category/"):
-            reject_and_log(url, "events tag or category")
-            return False
-        if path.startswith("/events/list") or path.startswith("/events/month"):
-            reject_and_log(url, "events list or month")
-            return False
-        #some pages are /events/tag/<tag>/<yyyy-mm>
-        if re.search(r"^/events/tag/[^/]+/\d{4}-\d{2}/?$", path):
-            reject_and_log(url, "events tag something else")
-            return False
-
-        #Gitlab traps
-        if "gitlab.ics.uci.edu" in netloc:
-
-            # reject any query string
-            if parsed.query:
-                reject_and_log(url, "parsed query")
-                return False
-
-            #block common infinite navigation sections
-            bad_gitlab = ["/-/commit/", "/-/commits/", "/-/tree/", "/-/tags", "/-/compare",
-                "/-/merge_requests", "/-/issues", "/-/pipelines", "/-/jobs",
-                "/-/branches", "/-/project_members", "/-/activity", "/-/blob/"
-            ]
-            if any(b in path for b in bad_gitlab):
-                reject_and_log(url, "bad gitlab")
-                return False
-
-            #block long hash tokens
-            if re.search(r"/[0-9a-f]{32,}(/|$)", path):
-                reject_and_log(url, "re search")
-                return False
+        #(also covers /events/tag/<tag>/<yyyy-mm>)
+        "events tag or category": r"\A/events/(?:tag|category)/",
+        "events list or month": r"\A/events/(?:list|month)",
+        #block internal search result pages
+        "low information value": r"/search",
+    }),
 
+    #query traps, checked with one combined regex
+    AnyPattern("query", {
+        #calendar exports, past/list views, date pagination, generic paging
+        "bad params": r"ical|eventdisplay|tribe-?bar-date|page|offset",
         #DokuWiki / wiki traps
-        trap_params = [
-            "do=", "idx=", "tab_files", "tab_details", "image=", "media=",
-            "sectok=", "ns=", "rev=", "diff="
-        ]
-        if any(tp in q for tp in trap_params):
-            reject_and_log(url, "trap_params")
-            return False
-
+        "trap_params": r"do=|idx=|tab_files|tab_details|image=|media="
+                       r"|sectok=|ns=|rev=|diff=",
         #calendar / paging / sort traps (endless page=1,2,3…)
-        if re.search(r"(?:^|[&;])(page|p|start|offset)=\d{3,}(?:$|[&;])", q):
-            reject_and_log(url, "page start offset")
-            return False
-
-        #repeated query keys (e.g., tab_details repeated, etc.)
-        if parsed.query:
-            keys = [kv.split("=", 1)[0].lower() for kv in re.split(r"[&;]", parsed.query) if kv.strip()]
-            if len(keys) != len(set(keys)):
-                reject_and_log(url, "repeated query keys")
-                return False
-        
-        #avoid too many query parameters
-        if parsed.query:
-            parts = re.split(r"[&;]", parsed.query)
-            if len([p for p in parts if p.strip()]) > 8:
-                reject_and_log(url, "too many query parameters")
-                return False
-    
-        #avoid repeated path segments
-        segments = [s for s in parsed.path.lower().split("/") if s]
-        count = {}
-        for s in segments:
-            count[s] = count.get(s, 0) + 1
-            if count[s] >= 4:
-                reject_and_log(url, "repeating path segments")
-                return False
-
+        "page start offset": r"(?:^|[&;])(?:page|p|start|offset)=\d{3,}(?:$|[&;])",
         #block pagination, sorting, and filtering traps
-        q = parsed.query.lower()
-        if any(k in q for k in ["page=", "offset=", "start=", "sort=", "filter=", "replytocom="]):
-            reject_and_log(url, "pagination, sorting, filtering")
-            return False
-
-        #block internal search result pages
-        path = parsed.path.lower()
-        if "/search" in path:
-            reject_and_log(url, "low information value")
-            return False
-
-        return not re.match(
-            r".*\.(css|js|bmp|gif|jpe?g|ico"
-            + r"|png|tiff?|mid|mp2|mp3|mp4"
-            + r"|wav|avi|mov|mpeg|ram|m4v|mkv|ogg|ogv|pdf"
-            + r"|ps|eps|tex|ppt|pptx|doc|docx|xls|xlsx|names"
-            + r"|data|dat|exe|bz2|tar|msi|bin|7z|psd|dmg|iso"
-            + r"|epub|dll|cnf|tgz|sha1"
-            + r"|thmx|mso|arff|rtf|jar|csv"
-            + r"|rm|smil|wmv|swf|wma|zip|rar|gz"
-            + r"|txt|c|h|cpp|cc|py|java)$", 
-            parsed.path.lower())
-    
-    except TypeError:
-        print ("TypeError for ", parsed)
-        raise
-    
-#write to a file so I can see what files are getting rejected
-def reject_and_log(url, exp):
-    with open(REJECTED_LOGS, "a", encoding="utf-8") as f:
-        f.write(f"{url}\t{exp}\n")
\ No newline at end of file
+        "pagination, sorting, filtering":
+            r"page=|offset=|start=|sort=|filter=|replytocom=",
+    }),
+
+    #Avoid lengthy urls
+    Rule("too deep path", lambda p: len(p.segments) > 8, cost=2),
+
+    #avoid repeated path segments
+    Rule("repeating path segments", lambda p: p.segments
+         and max(Counter(p.segments).values()) >= 4, cost=3),
+
+    #repeated query keys (e.g., tab_details repeated, etc.)
+    Rule("repeated query keys", lambda p: len(p.query_params)
+         != len({kv.split("=", 1)[0] for kv in p.query_params}), cost=3),
+
+    #avoid too many query parameters
+    Rule("too many query parameters", lambda p: len(p.query_params) > 8, cost=3),
+
+    #Gitlab traps: any query string, infinite navigation sections and
+    #long hash tokens
+    Rule("parsed query", on_gitlab(lambda p: p.query)),
+    Rule("bad gitlab", on_gitlab(lambda p: GITLAB_SECTIONS.search(p.path)), cost=2),
+    Rule("re search", on_gitlab(lambda p: GITLAB_HASH.search(p.path)), cost=2),
+
+    #not a webpage (not logged)
+    AnyPattern("path", {"file extension": FILE_EXTENSIONS}, log=False),
+]
+
+_url_filter = UrlFilter(URL_RULES, on_reject=reject_and_log)
+#Saved with pending frontier urls, which are only validated again when
+#the rules, filter_valid, is_trap or url_filter.py change
+RULES_VERSION = rules_version(URL_RULES, filter_valid, is_trap)
@@ -0,0 +1,188 @@
+import math
+
+from array import array
+from hashlib import blake2b
+
+# array typecode of a 64-bit digest
+_DIGEST = "Q"
+_EMPTY = 0
+
+
+def url_digest(url):
+    ''' 64-bit digest of a url. '''
+    return int.from_bytes(
+        blake2b(url.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def urlhash_digest(urlhash):
+    ''' 64-bit digest of a utils.get_urlhash hex string, its first 8 bytes. '''
+    return int(urlhash[:16], 16)
+
+
+class DigestSet(object):
+    ''' Set of 64-bit digests in an open addressing table backed by one
+    array: 8 bytes a slot, at most 2/3 of the slots used, instead of a
+    Python object per member. Digest 0 is stored as 1.
+
+    Not thread safe, callers lock around it. '''
+
+    def __init__(self, capacity=16):
+        size = 1 << max(4, math.ceil(math.log2(capacity * 3 / 2)))
+        self._table = array(_DIGEST, bytes(8 * size))
+        self._mask = size - 1
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _slot(self, digest):
+        # Index of digest's slot, or of the empty slot it would go in
+        table, mask = self._table, self._mask
+        i = digest & mask
+        while True:
+            found = table[i]
+            if found == digest or found == _EMPTY:
+                return i
+            i = (i + 1) & mask
+
+    def __contains__(self, digest):
+        digest = digest or 1
+        return self._table[self._slot(digest)] == digest
+
+    def add(self, digest):
+        ''' Adds digest, returns False if it was already in the set. '''
+        digest = digest or 1
+        i = self._slot(digest)
+        if self._table[i] == digest:
+            return False
+        self._table[i] = digest
+        self._count += 1
+        if self._count * 3 > len(self._table) * 2:
+            self._grow()
+        return True
+
+    def add_new(self, digests):
+        ''' Adds digests, returns the ones that were not in the set. '''
+        return [digest for digest in digests if self.add(digest)]
+
+    def _grow(self):
+        old = self._table
+        self._table = array(_DIGEST, bytes(16 * len(old)))
+        self._mask = len(self._table) - 1
+        table = self._table
+        for digest in old:
+            if digest != _EMPTY:
+                table[self._slot(digest)] = digest
+
+    def __iter__(self):
+        return (digest for digest in self._table if digest != _EMPTY)
+
+    def copy(self):
+        other = DigestSet.__new__(DigestSet)
+        other._table = array(_DIGEST, self._table)
+        other._mask = self._mask
+        other._count = self._count
+        return other
+
+    def tofile(self, file):
+        file.write(self._count.to_bytes(8, "little"))
+        file.write(len(self._table).to_bytes(8, "little"))
+        self._table.tofile(file)
+
+    @classmethod
+    def fromfile(cls, file):
+        digests = cls.__new__(cls)
+        digests._count = int.from_bytes(file.read(8), "little")
+        size = int.from_bytes(file.read(8), "little")
+        digests._table = array(_DIGEST)
+        digests._table.fromfile(file, size)
+        digests._mask = size - 1
+        return digests
+
+    @property
+    def nbytes(self):
+        return self._table.itemsize * len(self._table)
+
+
+class BloomFilter(object):
+    ''' Bloom filter over 64-bit digests. Once it holds `capacity` digests
+    another filter twice as large is chained on, so the false positive rate
+    stays near `error` however many are added.
+
+    Not thread safe, callers lock around it. '''
+
+    def __init__(self, capacity=1 << 20, error=0.01):
+        self.error = error
+        self._count = 0
+        self._filters = list()
+        self._add_filter(capacity)
+
+    def __len__(self):
+        return self._count
+
+    def _add_filter(self, capacity):
+        bits = max(64, int(-capacity * math.log(self.error) / math.log(2) ** 2))
+        hashes = max(1, round(bits / capacity * math.log(2)))
+        self._filters.append([bytearray((bits + 7) // 8), bits, hashes, capacity, 0])
+
+    def __contains__(self, digest):
+        # Double hashing over the two halves of the digest
+        low, high = digest & 0xFFFFFFFF, digest >> 32 | 1
+        for table, bits, hashes, _, _ in self._filters:
+            for i in range(hashes):
+                position = (low + i * high) % bits
+                if not table[position >> 3] & 1 << (position & 7):
+                    break
+            else:
+                return True
+        return False
+
+    def add(self, digest):
+        ''' Adds digest, returns False if it may have been added before. '''
+        if digest in self:
+            return False
+        last = self._filters[-1]
+        if last[4] >= last[3]:
+            self._add_filter(last[3] * 2)
+            last = self._filters[-1]
+        table, bits, hashes, _, _ = last
+        low, high = digest & 0xFFFFFFFF, digest >> 32 | 1
+        for i in range(hashes):
+            position = (low + i * high) % bits
+            table[position >> 3] |= 1 << (position & 7)
+        last[4] += 1
+        self._count += 1
+        return True
+
+    def copy(self):
+        other = BloomFilter.__new__(BloomFilter)
+        other.error = self.error
+        other._count = self._count
+        other._filters = [
+            [bytearray(table), *rest] for table, *rest in self._filters]
+        return other
+
+    def tofile(self, file):
+        file.write(len(self._filters).to_bytes(8, "little"))
+        for table, bits, hashes, capacity, filled in self._filters:
+            for value in (bits, hashes, capacity, filled):
+                file.write(value.to_bytes(8, "little"))
+            file.write(table)
+
+    @classmethod
+    def fromfile(cls, file, error=0.01):
+        bloom = cls.__new__(cls)
+        bloom.error = error
+        bloom._filters = list()
+        for _ in range(int.from_bytes(file.read(8), "little")):
+            bits, hashes, capacity, filled = (
+                int.from_bytes(file.read(8), "little") for _ in range(4))
+            bloom._filters.append(
+                [bytearray(file.read((bits + 7) // 8)), bits, hashes,
+                 capacity, filled])
+        bloom._count = sum(f[4] for f in bloom._filters)
+        return bloom
+
+    @property
+    def nbytes(self):
+        return sum(len(table) for table, *_ in self._filters)
@@ -0,0 +1,165 @@
+import os
+import struct
+
+from collections import Counter
+from functools import lru_cache
+from hashlib import blake2b
+from threading import Lock
+
+from seen_set import url_digest
+
+BITS = 64
+# Pages with fewer tokens than this are never treated as duplicates, so
+# link-only pages (navigation, redirects) keep their outlinks.
+MIN_TOKENS = 20
+# checksum, fingerprint and url hash of a page
+_RECORD = struct.Struct("<QQQ")
+# Width of the per bit token counts packed in simhash, enough for any page.
+_LANE = 32
+_LANE_MASK = (1 << _LANE) - 1
+# Each byte value with its bits spread to the bottom of 8 lanes.
+_SPREAD = [
+    sum(1 << (bit * _LANE) for bit in range(8) if byte >> bit & 1)
+    for byte in range(256)]
+
+
+def _token_hash(token):
+    return int.from_bytes(
+        blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+@lru_cache(maxsize=50000)
+def _token_lanes(token):
+    # Every bit of the token's hash moved to the bottom of its own lane.
+    h = _token_hash(token)
+    packed = 0
+    for byte in range(0, BITS, 8):
+        packed |= _SPREAD[h >> byte & 0xFF] << (byte * _LANE)
+    return packed
+
+
+def simhash(tokens):
+    ''' 64-bit SimHash of a token stream, each token weighted by its count.
+
+    The per bit counts are kept in lanes of one big int, so a token costs a
+    multiply-add instead of a loop over its 64 bits. '''
+    counts = Counter(tokens)
+    total = sum(counts.values())
+    ones = 0
+    for token, count in counts.items():
+        ones += count * _token_lanes(token)
+    fingerprint = 0
+    for bit in range(BITS):
+        # Set where the tokens with the bit outweigh those without it.
+        if 2 * (ones >> (bit * _LANE) & _LANE_MASK) > total:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def checksum(tokens):
+    digest = blake2b(digest_size=8)
+    for token in tokens:
+        digest.update(token.encode("utf-8"))
+        digest.update(b" ")
+    return int.from_bytes(digest.digest(), "little")
+
+
+class DuplicateIndex(object):
+    ''' Index of page fingerprints for exact and near-duplicate detection.
+
+    Exact duplicates are found through a set of token stream checksums.
+    Near duplicates (SimHash within `distance` bits) are found by splitting
+    each fingerprint into distance + 1 bands: two fingerprints that differ
+    in at most `distance` bits agree on at least one whole band, so only
+    pages sharing a band value are compared. A negative distance turns
+    detection off.
+
+    Fingerprints are appended to a file next to the frontier save so the
+    index survives a resume. A page crawled again after a resume, because
+    it was not committed as completed, is not a duplicate of itself. '''
+
+    def __init__(self, distance=3):
+        self._lock = Lock()
+        self._file = None
+        self._reset(distance)
+
+    def _reset(self, distance):
+        self.distance = distance
+        bands = max(distance, 0) + 1
+        edges = [BITS * i // bands for i in range(bands + 1)]
+        self._bands = [
+            (start, (1 << (end - start)) - 1)
+            for start, end in zip(edges, edges[1:])]
+        self._buckets = [dict() for _ in self._bands]
+        self._checksums = set()
+        self._restored_urls = set()
+        self.exact = 0
+        self.near = 0
+
+    def _add(self, fingerprint, page_checksum):
+        self._checksums.add(page_checksum)
+        for (shift, mask), buckets in zip(self._bands, self._buckets):
+            buckets.setdefault(fingerprint >> shift & mask, list()).append(
+                fingerprint)
+
+    def configure(self, config, restart):
+        ''' Loads the fingerprints persisted for config.save_file. '''
+        path = f"{config.save_file}.simhash"
+        with self._lock:
+            self._reset(config.near_duplicate_distance)
+            if restart and os.path.exists(path):
+                os.remove(path)
+            if os.path.exists(path):
+                with open(path, "rb") as saved:
+                    data = saved.read()
+                # Ignore a torn record at the end.
+                end = len(data) - len(data) % _RECORD.size
+                for page_checksum, fingerprint, page_url in (
+                        _RECORD.iter_unpack(data[:end])):
+                    self._add(fingerprint, page_checksum)
+                    self._restored_urls.add(page_url)
+            self._file = open(path, "ab")
+
+    def near_duplicate_of(self, fingerprint):
+        for (shift, mask), buckets in zip(self._bands, self._buckets):
+            for other in buckets.get(fingerprint >> shift & mask, ()):
+                if bin(fingerprint ^ other).count("1") <= self.distance:
+                    return other
+        return None
+
+    def fingerprint(self, tokens):
+        ''' (checksum, SimHash) of a page's tokens, or None for pages never
+        treated as duplicates. Does not depend on the index's state, so it
+        can be computed anywhere, even in another process. '''
+        if len(tokens) < MIN_TOKENS:
+            return None
+        return checksum(tokens), simhash(tokens)
+
+    def check_and_add(self, fingerprint, url):
+        ''' Returns "exact duplicate" or "near duplicate" if a page with this
+        fingerprint was seen before. Otherwise records the page, returns None. '''
+        if self.distance < 0 or fingerprint is None:
+            return None
+        page_url = url_digest(url)
+        if page_url in self._restored_urls:
+            return None
+        page_checksum, fingerprint = fingerprint
+        with self._lock:
+            if page_checksum in self._checksums:
+                self.exact += 1
+                return "exact duplicate"
+            if self.near_duplicate_of(fingerprint) is not None:
+                self.near += 1
+                return "near duplicate"
+            self._add(fingerprint, page_checksum)
+            if self._file:
+                self._file.write(
+                    _RECORD.pack(page_checksum, fingerprint, page_url))
+                self._file.flush()
+        return None
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
@@ -1,24 +1,39 @@
-# O(n) time: scans each character once to build lowercase alphanumeric tokens.
-def tokenize_text(text):
-    """Returns lowercase alphanumeric tokens from a string, skipping non-ASCII."""
-    tokens = []
-    current = []
+import re
+
+# Tokens are runs of ASCII letters and digits. Every other character,
+# including any non-ASCII one, ends the current token.
+_TOKEN = re.compile(r"[a-z0-9]+")
+_SEPARATOR = re.compile(r"[^A-Za-z0-9]")
+
 
-    for ch in text:
-        if ord(ch) > 127:
-            if current:
-                tokens.append("".join(current).lower())
-                current = []
-            continue
+def _ascii_lower(text):
+    # Non-ASCII characters become "?" (a separator) before lowercasing, so
+    # characters like the Kelvin sign cannot lowercase into ASCII letters.
+    return text.encode("ascii", "replace").decode("ascii").lower()
 
-        if ch.isalnum():
-            current.append(ch)
-        else:
-            if current:
-                tokens.append("".join(current).lower())
-                current = []
 
-    if current:
-        tokens.append("".join(current).lower())
+# O(n) time: a single regex scan over the lowercased ASCII text.
+def tokenize_text(text):
+    """Returns lowercase alphanumeric tokens from a string, skipping non-ASCII."""
+    return _TOKEN.findall(_ascii_lower(text))
+
 
-    return tokens
\ No newline at end of file
+def iter_tokens(text, stop_words=None, min_length=1, chunk_size=65536):
+    """Lazily yields the tokens of tokenize_text(text), scanning about
+    chunk_size characters at a time. Tokens shorter than min_length or in
+    stop_words are dropped as they are produced."""
+    stop_words = stop_words or frozenset()
+    start, end_of_text = 0, len(text)
+    while start < end_of_text:
+        end = start + chunk_size
+        if end < end_of_text:
+            # Extend the chunk to the next separator so no token is split.
+            separator = _SEPARATOR.search(text, end)
+            end = separator.start() if separator else end_of_text
+        tokens = _TOKEN.findall(_ascii_lower(text[start:end]))
+        if stop_words or min_length > 1:
+            tokens = [
+                t for t in tokens
+                if len(t) >= min_length and t not in stop_words]
+        yield from tokens
+        start = end
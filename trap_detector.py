@@ -0,0 +1,277 @@
+import os
+import pickle
+import re
+import time
+import zlib
+
+from threading import Lock
+from urllib.parse import urlsplit
+
+from seen_set import DigestSet, url_digest
+from utils import get_logger
+
+_NUMBER = re.compile(r"\d+")
+_HASH = re.compile(r"\A[0-9a-f]{8,}\Z|\A[0-9a-z_-]{22,}\Z")
+
+# Weight of the latest page in a template's yield and duplicate rate, and
+# in the yield of the whole crawl. Until there are 1 / weight pages, each
+# is a plain mean, so the first pages, where every word is new, do not
+# dominate them.
+YIELD_WEIGHT = 0.1
+CRAWL_YIELD_WEIGHT = 0.01
+# Templates still in the low yield zone below this multiple of the
+# threshold are fetched after everything else on their host.
+LOW_YIELD_MARGIN = 2.0
+# Share of min_pages a template must stay below the thresholds for, page
+# after page, before it is blocked.
+SUSTAINED_SHARE = 0.5
+# Persisted state is rewritten at most this often.
+SAVE_SECONDS = 30.0
+
+
+def url_template(url):
+    ''' host/path/with/<n>/and/<h>?sorted&query&keys. Digit runs become <n>,
+    hash or token like segments <h>, query values are dropped. '''
+    parts = urlsplit(url)
+    segments = list()
+    for segment in parts.path.lower().split("/"):
+        if _HASH.match(segment) and _NUMBER.search(segment):
+            segments.append("<h>")
+        else:
+            segments.append(_NUMBER.sub("<n>", segment))
+    template = parts.netloc.lower() + "/".join(segments).rstrip("/")
+    if parts.query:
+        keys = sorted({
+            pair.split("=", 1)[0]
+            for pair in re.split(r"[&;]", parts.query.lower()) if pair})
+        template += "?" + "&".join(keys)
+    return template
+
+
+def _moving_average(average, value, count, weight):
+    return average + max(weight, 1.0 / count) * (value - average)
+
+
+class _TemplateYield(object):
+    __slots__ = (
+        "pages", "yield_", "duplicates", "blocked", "low", "until", "blocks")
+
+    def __init__(self):
+        self.pages = 0
+        # Moving averages per page: new words plus new outlinks to other
+        # templates, and the fraction of (near) duplicate pages.
+        self.yield_ = 0.0
+        self.duplicates = 0.0
+        self.blocked = None
+        # Pages in a row below the thresholds.
+        self.low = 0
+        # Crawl page count the block lapses at, and how often it was blocked.
+        self.until = 0
+        self.blocks = 0
+
+    def __getstate__(self):
+        return (
+            self.pages, self.yield_, self.duplicates, self.blocked, self.low,
+            self.until, self.blocks)
+
+    def __setstate__(self, state):
+        # Saved before blocks lapsed: those lapse right away.
+        state = tuple(state) + (0, 0, 0)[len(state) - 4:]
+        (self.pages, self.yield_, self.duplicates, self.blocked, self.low,
+         self.until, self.blocks) = state
+
+
+class TrapDetector(object):
+    ''' Learns traps from what crawling them yields.
+
+    Every url maps to a url_template. For each template the detector keeps
+    a moving average of the yield of its pages: words never seen before in
+    the crawl plus outlinks never seen before that lead to other templates.
+    Links to more of the same template do not count, which is what makes
+    calendars, paged listings and wiki action urls look like traps. It
+    also tracks how often its pages are (near) duplicates. Fetches that
+    return no page (errors, not html) count as pages yielding nothing.
+
+    Yield falls for every template as the crawl goes on, so it is compared
+    to the moving average over all pages. After min_pages pages a template
+    that keeps yielding less than min_yield times that, or keeps a
+    duplicate rate above max_duplicates, for SUSTAINED_SHARE of min_pages
+    pages in a row is blocked: its urls are rejected with the reason kept
+    in blocked(). Templates close to it are deprioritized.
+
+    Blocks are probationary. One lapses after probation_pages more pages of
+    the crawl, twice that for the next block of the same template and so
+    on, so a template that yields again is crawled again. With
+    min_pages = 0 nothing is tracked. '''
+
+    def __init__(
+            self, min_pages=20, min_yield=0.1, max_duplicates=0.8,
+            probation_pages=500):
+        self.logger = get_logger("TRAPS")
+        self.min_pages = min_pages
+        self.min_yield = min_yield
+        self.max_duplicates = max_duplicates
+        self.probation_pages = probation_pages
+        self._templates = dict()
+        self._words = DigestSet()
+        self._links = DigestSet()
+        self._crawl_yield = None
+        self._crawl_pages = 0
+        self._blocked = 0
+        self._lock = Lock()
+        self._path = None
+        self._dirty = False
+        self._saved = 0.0
+
+    def configure(self, config, restart):
+        ''' Loads the state persisted for config.save_file. '''
+        self.min_pages = config.trap_min_pages
+        self.min_yield = config.trap_min_yield
+        self.max_duplicates = config.trap_max_duplicates
+        self.probation_pages = config.trap_probation_pages
+        path = f"{config.save_file}.traps"
+        with self._lock:
+            self._templates = dict()
+            self._words = DigestSet()
+            self._links = DigestSet()
+            self._crawl_yield = None
+            self._crawl_pages = 0
+            if restart and os.path.exists(path):
+                os.remove(path)
+            if os.path.exists(path):
+                with open(path, "rb") as saved:
+                    (self._templates, self._words, self._links,
+                     self._crawl_yield, *pages) = pickle.loads(
+                        zlib.decompress(saved.read()))
+                self._crawl_pages = pages[0] if pages else 0
+            self._blocked = sum(
+                1 for stats in self._templates.values() if stats.blocked)
+            self._path = path
+
+    def observe(self, url, words=(), links=(), duplicate=False):
+        ''' Records a crawled page: its words (any iterable, each distinct
+        word counted once), its outlinks and whether it was a duplicate. '''
+        if not self.min_pages:
+            return
+        template = url_template(url)
+        word_digests = {url_digest(word) for word in words}
+        link_digests = [
+            (url_digest(link), url_template(link) != template)
+            for link in links]
+        with self._lock:
+            new = len(self._words.add_new(word_digests))
+            for digest, elsewhere in link_digests:
+                if self._links.add(digest) and elsewhere:
+                    new += 1
+            stats = self._templates.get(template)
+            if stats is None:
+                stats = self._templates[template] = _TemplateYield()
+            stats.pages += 1
+            stats.yield_ = _moving_average(
+                stats.yield_, new, stats.pages, YIELD_WEIGHT)
+            stats.duplicates = _moving_average(
+                stats.duplicates, float(duplicate), stats.pages, YIELD_WEIGHT)
+            self._crawl_pages += 1
+            self._crawl_yield = _moving_average(
+                self._crawl_yield or 0.0, new, self._crawl_pages,
+                CRAWL_YIELD_WEIGHT)
+            if stats.blocked is None and stats.pages >= self.min_pages:
+                reason = self._block_reason(stats)
+                stats.low = stats.low + 1 if reason else 0
+                if stats.low >= max(1, self.min_pages * SUSTAINED_SHARE):
+                    self._block(template, stats, reason)
+            self._dirty = True
+
+    def _block(self, template, stats, reason):
+        # Caller holds _lock.
+        stats.blocked = reason
+        stats.low = 0
+        stats.until = (
+            self._crawl_pages + self.probation_pages * 2 ** stats.blocks)
+        stats.blocks += 1
+        self._blocked += 1
+        self.logger.info(
+            f"Blocked {template} for {stats.until - self._crawl_pages} "
+            f"pages: {reason}.")
+
+    def _lapse(self, template, stats):
+        # Caller holds _lock. The template is tried again, and blocked
+        # again only if it keeps yielding little.
+        if stats.blocked is None or stats.until > self._crawl_pages:
+            return
+        stats.blocked = None
+        self._blocked -= 1
+        self._dirty = True
+        self.logger.info(f"Block of {template} lapsed, crawling it again.")
+
+    def _block_reason(self, stats):
+        if stats.duplicates > self.max_duplicates:
+            return (
+                f"{stats.duplicates:.0%} duplicates over {stats.pages} pages")
+        if stats.yield_ < self.min_yield * self._crawl_yield:
+            return (
+                f"{stats.yield_:.2f} new words and outlinks a page over "
+                f"{stats.pages} pages, crawl average {self._crawl_yield:.2f}")
+        return None
+
+    def reason(self, url):
+        ''' Why url's template is blocked, or None. '''
+        if not self._blocked:
+            return None
+        template = url_template(url)
+        stats = self._templates.get(template)
+        if stats is None or stats.blocked is None:
+            return None
+        if stats.until <= self._crawl_pages:
+            with self._lock:
+                self._lapse(template, stats)
+        return stats.blocked
+
+    def low_yield(self, url):
+        ''' True for urls of templates heading for a block. '''
+        if not self.min_pages:
+            return False
+        stats = self._templates.get(url_template(url))
+        return (
+            stats is not None and stats.pages >= self.min_pages // 2
+            and stats.yield_
+            < self.min_yield * LOW_YIELD_MARGIN * (self._crawl_yield or 0))
+
+    def blocked(self):
+        ''' {template: reason} of every template blocked for now. '''
+        with self._lock:
+            return {
+                template: stats.blocked
+                for template, stats in self._templates.items()
+                if stats.blocked and stats.until > self._crawl_pages}
+
+    def checkpoint(self, force=False):
+        ''' Persists the state, at most every SAVE_SECONDS unless forced. '''
+        if self._path is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not self._dirty or (not force and now - self._saved < SAVE_SECONDS):
+                return
+            data = zlib.compress(pickle.dumps(
+                (self._templates, self._words, self._links,
+                 self._crawl_yield, self._crawl_pages),
+                pickle.HIGHEST_PROTOCOL), 1)
+            self._dirty = False
+            self._saved = now
+        with open(f"{self._path}.tmp", "wb") as out:
+            out.write(data)
+        os.replace(f"{self._path}.tmp", self._path)
+
+    def close(self):
+        self.checkpoint(force=True)
+        self._path = None
+
+    def write_report(self, blocked=None):
+        ''' Lists the blocked templates, these or this detector's. '''
+        if blocked is None:
+            blocked = self.blocked()
+        print("\n===== TRAP TEMPLATES =====")
+        print(f"Blocked: {len(blocked)}")
+        for template, reason in sorted(blocked.items()):
+            print(f"{template}\t{reason}")
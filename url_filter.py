@@ -0,0 +1,212 @@
+import inspect
+import re
+
+from collections import OrderedDict, Counter
+from hashlib import blake2b
+from functools import cached_property
+from threading import Lock
+from urllib.parse import urlparse
+
+_QUERY_SPLIT = re.compile(r"[&;]")
+
+
+def rules_version(rules, *functions):
+    ''' Fingerprint of what decides whether a url is valid: this module,
+    the rules (their patterns, or the source of their tests and the
+    constants those use) and the source of the given functions. Edits
+    elsewhere in the files they live in don't count as a rules change. '''
+    digest = blake2b(digest_size=8)
+    with open(__file__, "rb") as source:
+        digest.update(source.read())
+    for rule in rules:
+        digest.update(repr((type(rule).__name__, rule.reasons, rule.cost,
+                            rule.log)).encode())
+        if isinstance(rule, AnyPattern):
+            digest.update(repr((rule.field, rule.pattern)).encode())
+        else:
+            digest.update(_source_of(rule.test).encode())
+    for function in functions:
+        digest.update(_source_of(function).encode())
+    return digest.hexdigest()
+
+
+def _source_of(function):
+    # The source of a function, of the functions it closes over (rules
+    # built by helpers) and the values of the constants it reads
+    parts = [inspect.getsource(function)]
+    for cell in function.__closure__ or ():
+        if callable(cell.cell_contents):
+            parts.append(_source_of(cell.cell_contents))
+    for name in function.__code__.co_names:
+        value = function.__globals__.get(name)
+        if isinstance(value, (re.Pattern, str, int, tuple)):
+            parts.append(f"{name}={value!r}")
+    return "\n".join(parts)
+
+
+class UrlParts(object):
+    ''' A url split once into the lowercased pieces the rules look at.
+    Pieces only some rules need are computed on first use. '''
+
+    def __init__(self, url):
+        parsed = urlparse(url)
+        self.url = url
+        self.scheme = parsed.scheme
+        self.netloc = parsed.netloc.lower()
+        self.path = parsed.path.lower()
+        self.query = parsed.query.lower()
+
+    @cached_property
+    def lower_url(self):
+        return self.url.lower()
+
+    @cached_property
+    def segments(self):
+        return [s for s in self.path.split("/") if s]
+
+    @cached_property
+    def query_params(self):
+        return [p for p in _QUERY_SPLIT.split(self.query) if p.strip()]
+
+
+class Rule(object):
+    ''' Rejects a url with `reason` when test(parts) is true.
+
+    cost is a rough relative price of the test, used to order rules so that
+    cheap rejections run first. Rejections are passed to the filter's
+    on_reject callback unless log is False. '''
+
+    def __init__(self, reason, test, cost=1, log=True):
+        self.reason = reason
+        self.reasons = (reason,)
+        self.test = test
+        self.cost = cost
+        self.log = log
+
+    def match(self, parts):
+        return self.reason if self.test(parts) else None
+
+
+class AnyPattern(Rule):
+    ''' Several regex rules on the same url piece compiled into a single
+    alternation. A match is attributed to the alternative that matched. '''
+
+    def __init__(self, field, patterns, cost=2, log=True, flags=0):
+        self.field = field
+        self.reasons = tuple(patterns)
+        self._reason_of = dict()
+        alternatives = list()
+        for i, (reason, pattern) in enumerate(patterns.items()):
+            self._reason_of[f"r{i}"] = reason
+            alternatives.append(f"(?P<r{i}>{pattern})")
+        self.pattern = re.compile("|".join(alternatives), flags)
+        self.cost = cost
+        self.log = log
+
+    def match(self, parts):
+        m = self.pattern.search(getattr(parts, self.field))
+        return self._reason_of[m.lastgroup] if m else None
+
+
+class UrlFilter(object):
+    ''' Evaluates an ordered list of rules against urls.
+
+    Verdicts are memoized in a bounded LRU keyed by the url, so a url is
+    only ever evaluated (and its rejection reported) once while it stays in
+    the cache. Every rejection is counted per reason; reorder() sorts the
+    rules so those rejecting the most urls per unit of cost run first, and
+    happens on its own every `reorder_every` evaluations. '''
+
+    def __init__(
+            self, rules, on_reject=None, cache_size=100000,
+            reorder_every=10000):
+        self.rules = sorted(rules, key=lambda rule: rule.cost)
+        self.on_reject = on_reject
+        self.cache_size = cache_size
+        self.reorder_every = reorder_every
+        self.hits = Counter()
+        self.evaluations = 0
+        self.cache_hits = 0
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    def _evaluate(self, url):
+        parts = UrlParts(url)
+        for rule in self.rules:
+            reason = rule.match(parts)
+            if reason is not None:
+                return False, reason, rule.log
+        return True, None, False
+
+    def _lookup(self, url):
+        # Caller holds the lock.
+        verdict = self._cache.get(url)
+        if verdict is not None:
+            self._cache.move_to_end(url)
+            self.cache_hits += 1
+        return verdict
+
+    def _store(self, url, verdict, reason):
+        # Caller holds the lock.
+        self._cache[url] = verdict
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        self.evaluations += 1
+        if reason is not None:
+            self.hits[reason] += 1
+        if self.reorder_every and not self.evaluations % self.reorder_every:
+            self.reorder()
+
+    def is_valid(self, url):
+        with self._lock:
+            verdict = self._lookup(url)
+        if verdict is not None:
+            return verdict
+        verdict, reason, log = self._evaluate(url)
+        with self._lock:
+            self._store(url, verdict, reason)
+        if log and self.on_reject:
+            self.on_reject(url, reason)
+        return verdict
+
+    def filter(self, urls):
+        ''' Returns the valid urls out of urls, in order. Cached verdicts are
+        read under one lock acquisition and only unseen urls are evaluated. '''
+        urls = list(urls)
+        verdicts = dict()
+        with self._lock:
+            for url in urls:
+                if url not in verdicts:
+                    verdict = self._lookup(url)
+                    if verdict is not None:
+                        verdicts[url] = verdict
+        evaluated = list()
+        for url in urls:
+            if url not in verdicts:
+                verdict, reason, log = self._evaluate(url)
+                verdicts[url] = verdict
+                evaluated.append((url, verdict, reason, log))
+        if evaluated:
+            with self._lock:
+                for url, verdict, reason, _ in evaluated:
+                    self._store(url, verdict, reason)
+            if self.on_reject:
+                for url, _, reason, log in evaluated:
+                    if log:
+                        self.on_reject(url, reason)
+        return [url for url in urls if verdicts[url]]
+
+    def reorder(self):
+        ''' Puts the rules rejecting the most urls per unit of cost first. '''
+        def rejections_per_cost(rule):
+            return sum(self.hits[reason] for reason in rule.reasons) / rule.cost
+        self.rules = sorted(self.rules, key=rejections_per_cost, reverse=True)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "evaluations": self.evaluations,
+                "cache_hits": self.cache_hits,
+                "cached": len(self._cache),
+                "rejections": dict(self.hits.most_common()),
+                "order": [rule.reasons[0] for rule in self.rules]}
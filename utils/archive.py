@@ -0,0 +1,150 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+
+from threading import Lock
+from requests.structures import CaseInsensitiveDict
+
+from utils.response import Response
+
+# magic, status, flags, url length, meta length, body length
+_HEADER = struct.Struct("<4sHHIII")
+_MAGIC = b"RSP1"
+_COMPRESSED = 1
+# offset and length of each record in the segment
+_INDEX = struct.Struct("<QI")
+
+_archives = dict()
+_archives_lock = Lock()
+
+
+def get_archive(config):
+    ''' The archive shared by all workers, or None if ARCHIVE is not set. '''
+    if not config.archive_dir:
+        return None
+    with _archives_lock:
+        if config.archive_dir not in _archives:
+            _archives[config.archive_dir] = ResponseArchive(
+                config.archive_dir, config.archive_segment_bytes)
+        return _archives[config.archive_dir]
+
+
+def segment_paths(directory):
+    ''' Segment files of an archive directory, oldest first. '''
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.startswith("segment-") and name.endswith(".dat"))
+
+
+class ArchivedRaw(object):
+    ''' Stands in for the requests.Response in Response.raw_response. '''
+
+    def __init__(self, url, content, headers):
+        self.url = url
+        self.content = content
+        self.headers = headers
+
+
+class ResponseArchive(object):
+    ''' Appends fetched responses to segment files in a directory.
+
+    Each record holds the url, status, final url, headers and error as json,
+    and the zlib compressed body. segment-<n>.idx next to each
+    segment-<n>.dat lists the offset and length of every record, so replay
+    can jump straight to them. Segments roll over at segment_bytes. '''
+
+    def __init__(self, directory, segment_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self._lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+        existing = segment_paths(directory)
+        self._segment = (
+            int(os.path.basename(existing[-1])[8:-4]) + 1 if existing else 0)
+        self._open_segment()
+
+    def _open_segment(self):
+        base = os.path.join(self.directory, f"segment-{self._segment:05d}")
+        self._data = open(f"{base}.dat", "ab")
+        self._index = open(f"{base}.idx", "ab")
+        self._offset = self._data.tell()
+
+    def append(self, url, resp):
+        # Pages with an error status are never parsed, so their bodies are
+        # neither unpickled nor archived.
+        raw = resp.raw_response if 200 <= resp.status < 400 else None
+        meta = {"error": resp.error}
+        body = b""
+        if raw is not None:
+            meta["final_url"] = raw.url
+            meta["headers"] = dict(raw.headers)
+            body = zlib.compress(raw.content or b"", 6)
+        url = url.encode("utf-8")
+        meta = json.dumps(meta).encode("utf-8")
+        header = _HEADER.pack(
+            _MAGIC, resp.status, _COMPRESSED if raw is not None else 0,
+            len(url), len(meta), len(body))
+        length = _HEADER.size + len(url) + len(meta) + len(body)
+        with self._lock:
+            if self._offset and self._offset + length > self.segment_bytes:
+                self._data.close()
+                self._index.close()
+                self._segment += 1
+                self._open_segment()
+            self._data.write(b"".join((header, url, meta, body)))
+            self._data.flush()
+            self._index.write(_INDEX.pack(self._offset, length))
+            self._index.flush()
+            self._offset += length
+
+    def close(self):
+        with self._lock:
+            self._data.close()
+            self._index.close()
+
+
+def segment_length(path):
+    ''' Number of records in a segment. '''
+    return os.path.getsize(path[:-4] + ".idx") // _INDEX.size
+
+
+def read_segment(path, start=0, stop=None):
+    ''' Yields (url, Response) for records start..stop of a segment,
+    reading it through mmap. Records listed in the index but cut short by a
+    crash are skipped. '''
+    with open(path[:-4] + ".idx", "rb") as index:
+        index.seek(start * _INDEX.size)
+        entries = index.read(
+            -1 if stop is None else (stop - start) * _INDEX.size)
+    if not os.path.getsize(path):
+        return
+    with open(path, "rb") as data, \
+            mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        end = len(entries) - len(entries) % _INDEX.size
+        for offset, length in _INDEX.iter_unpack(entries[:end]):
+            if offset + length > len(view):
+                break
+            yield _decode(view, offset)
+
+
+def _decode(view, offset):
+    magic, status, flags, url_len, meta_len, body_len = _HEADER.unpack_from(
+        view, offset)
+    assert magic == _MAGIC, f"Corrupt archive record at offset {offset}."
+    start = offset + _HEADER.size
+    url = view[start:start + url_len].decode("utf-8")
+    start += url_len
+    meta = json.loads(view[start:start + meta_len].decode("utf-8"))
+    start += meta_len
+    resp_dict = {"url": url, "status": status}
+    if meta.get("error") is not None:
+        resp_dict["error"] = meta["error"]
+    resp = Response(resp_dict)
+    if flags & _COMPRESSED:
+        resp.raw_response = ArchivedRaw(
+            meta.get("final_url") or url,
+            zlib.decompress(view[start:start + body_len]),
+            CaseInsensitiveDict(meta.get("headers") or {}))
+    return url, resp
@@ -0,0 +1,155 @@
+import re
+
+from collections import OrderedDict
+from threading import Lock
+from urllib.parse import urlsplit, urlunsplit
+
+from seen_set import DigestSet, urlhash_digest
+
+# Query parameters that only say where a click came from. A trailing *
+# matches any parameter starting with the rest.
+TRACKING_PARAMS = (
+    "utm_*", "fbclid", "gclid", "dclid", "msclkid", "mc_cid", "mc_eid",
+    "_ga", "_gl", "yclid", "igshid")
+# Last path segments that name the same page as their directory.
+INDEX_PAGES = ("index.html", "index.htm")
+DEFAULT_PORTS = {"http": "80", "https": "443"}
+
+_ESCAPE = re.compile(r"%([0-9A-Fa-f]{2})")
+_UNRESERVED = frozenset(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~")
+
+
+def _normalize_escapes(text):
+    # %7e -> ~ for unreserved characters, %2f -> %2F for the others.
+    def fix(match):
+        char = chr(int(match.group(1), 16))
+        return char if char in _UNRESERVED else "%" + match.group(1).upper()
+    return _ESCAPE.sub(fix, text) if "%" in text else text
+
+
+def remove_dot_segments(path):
+    ''' /a/./b/../c -> /a/c, as in RFC 3986 section 5.2.4. '''
+    if "." not in path:
+        return path
+    output = list()
+    for segment in path.split("/"):
+        if segment == "..":
+            if len(output) > 1:
+                output.pop()
+        elif segment != ".":
+            output.append(segment)
+    if path.endswith(("/.", "/..")):
+        output.append("")
+    return "/".join(output)
+
+
+def canonical_url(url, tracking_params=TRACKING_PARAMS):
+    ''' The one spelling kept for all spellings of url that name the same
+    page: lowercase scheme and host, no default port, userinfo kept, dot
+    segments resolved, escapes normalized, no index page, no trailing
+    slash (as utils.normalize), tracking parameters dropped, query
+    parameters sorted by name and no fragment. Other schemes and urls that
+    do not parse are returned stripped of whitespace. '''
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS:
+        return url
+
+    host = (parts.hostname or "").rstrip(".")
+    if ":" in host:
+        host = f"[{host}]"
+    if port is not None and str(port) != DEFAULT_PORTS[scheme]:
+        host = f"{host}:{port}"
+    userinfo, at, _ = parts.netloc.rpartition("@")
+    netloc = f"{userinfo}{at}{host}"
+
+    path = remove_dot_segments(_normalize_escapes(parts.path))
+    head, _, last = path.rpartition("/")
+    if last.lower() in INDEX_PAGES:
+        path = head
+    path = path.rstrip("/")
+
+    query = ""
+    if parts.query:
+        params = list()
+        for param in parts.query.split("&"):
+            if not param:
+                continue
+            name = param.split("=", 1)[0].lower()
+            if not any(
+                    name.startswith(tracking[:-1]) if tracking.endswith("*")
+                    else name == tracking for tracking in tracking_params):
+                params.append(_normalize_escapes(param))
+        params.sort(key=lambda param: param.split("=", 1)[0])
+        query = "&".join(params)
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+
+class Canonicalizer(object):
+    ''' canonical_url with the tracking parameters from config.ini, memoized
+    in a bounded LRU keyed by the url as found.
+
+    Also counts the duplicate fetches canonicalization prevented: every
+    distinct other spelling of a url that the crawl would have fetched
+    separately when urls were only stripped of a trailing slash. '''
+
+    def __init__(self, tracking_params=TRACKING_PARAMS, cache_size=100000):
+        self.tracking_params = tuple(tracking_params)
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.lookups = 0
+        self.prevented = 0
+        self._cache = OrderedDict()
+        self._aliases = DigestSet()
+        self._lock = Lock()
+
+    def configure(self, config):
+        with self._lock:
+            self.tracking_params = tuple(config.tracking_params)
+            self._cache.clear()
+
+    def __call__(self, url):
+        with self._lock:
+            self.lookups += 1
+            canonical = self._cache.get(url)
+            if canonical is not None:
+                self._cache.move_to_end(url)
+                self.cache_hits += 1
+                return canonical
+        canonical = canonical_url(url, self.tracking_params)
+        with self._lock:
+            self._cache[url] = canonical
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return canonical
+
+    def count_prevented(self, aliases, plain, new):
+        ''' For a batch of urls, aliases: {urlhash: urlhashes of the other
+        spellings found}, plain: urlhashes also found spelled canonically,
+        new: urlhashes not known before. Returns how many fetches the batch
+        was spared. '''
+        prevented = 0
+        with self._lock:
+            for urlhash, spellings in aliases.items():
+                first = sum(
+                    1 for spelling in spellings
+                    if self._aliases.add(urlhash_digest(spelling)))
+                if urlhash in new and urlhash not in plain:
+                    # One of the other spellings is still fetched.
+                    first -= 1
+                prevented += max(first, 0)
+            self.prevented += prevented
+        return prevented
+
+
+canonicalizer = Canonicalizer()
+
+
+def canonicalize(url):
+    return canonicalizer(url)
@@ -1,5 +1,7 @@
 import re
 
+from utils.canonical import TRACKING_PARAMS
+
 
 class Config(object):
     def __init__(self, config):
@@ -9,11 +11,96 @@ class Config(object):
         assert re.match(r"^[a-zA-Z0-9_ ,]+$", self.user_agent), "User agent should not have any special characters outside '_', ',' and 'space'"
         self.threads_count = int(config["LOCAL PROPERTIES"]["THREADCOUNT"])
         self.save_file = config["LOCAL PROPERTIES"]["SAVE"]
+        self.save_durability = config["LOCAL PROPERTIES"].get(
+            "SAVE_DURABILITY", fallback="batch").strip().lower()
+        self.save_flush_records = int(config["LOCAL PROPERTIES"].get(
+            "SAVE_FLUSH_RECORDS", fallback="500"))
+        self.save_flush_seconds = float(config["LOCAL PROPERTIES"].get(
+            "SAVE_FLUSH_SECONDS", fallback="1.0"))
+        self.save_compact_records = int(config["LOCAL PROPERTIES"].get(
+            "SAVE_COMPACT_RECORDS", fallback="100000"))
+        self.reject_log = config["LOCAL PROPERTIES"].get(
+            "REJECT_LOG", fallback="rejected_urls.log")
+        self.reject_log_max_bytes = int(config["LOCAL PROPERTIES"].get(
+            "REJECT_LOG_MAX_BYTES", fallback="10485760"))
+        self.reject_log_backups = int(config["LOCAL PROPERTIES"].get(
+            "REJECT_LOG_BACKUPS", fallback="3"))
+        self.reject_log_sample = float(config["LOCAL PROPERTIES"].get(
+            "REJECT_LOG_SAMPLE", fallback="1.0"))
+        self.seen_set = config["LOCAL PROPERTIES"].get(
+            "SEEN_SET", fallback="digests").strip().lower()
+        self.archive_dir = config["LOCAL PROPERTIES"].get(
+            "ARCHIVE", fallback="").strip()
+        self.archive_segment_bytes = int(config["LOCAL PROPERTIES"].get(
+            "ARCHIVE_SEGMENT_MB", fallback="256")) * 1024 * 1024
+        self.parse_processes = int(config["LOCAL PROPERTIES"].get(
+            "PARSE_PROCESSES", fallback="0"))
+        self.parse_in_flight = int(config["LOCAL PROPERTIES"].get(
+            "PARSE_IN_FLIGHT", fallback="0"))
+        self.metrics_file = config["LOCAL PROPERTIES"].get(
+            "METRICS_FILE", fallback="").strip()
+        self.metrics_interval = float(config["LOCAL PROPERTIES"].get(
+            "METRICS_INTERVAL", fallback="10"))
+        self.metrics_port = int(config["LOCAL PROPERTIES"].get(
+            "METRICS_PORT", fallback="0"))
+        self.profile_seconds = float(config["LOCAL PROPERTIES"].get(
+            "PROFILE_SECONDS", fallback="10"))
 
         self.host = config["CONNECTION"]["HOST"]
         self.port = int(config["CONNECTION"]["PORT"])
+        self.connect_timeout = float(config["CONNECTION"].get(
+            "CONNECT_TIMEOUT", fallback="5"))
+        self.read_timeout = float(config["CONNECTION"].get(
+            "READ_TIMEOUT", fallback="30"))
+        self.download_retries = int(config["CONNECTION"].get(
+            "RETRIES", fallback="3"))
+        self.download_backoff = float(config["CONNECTION"].get(
+            "RETRY_BACKOFF", fallback="0.5"))
+        self.download_mode = config["CONNECTION"].get(
+            "DOWNLOAD_MODE", fallback="threads").strip().lower()
+        assert self.download_mode in ("threads", "async"), (
+            "DOWNLOAD_MODE should be threads or async")
+        self.async_in_flight = int(config["CONNECTION"].get(
+            "ASYNC_IN_FLIGHT", fallback="32"))
+        self.download_pool_size = int(config["CONNECTION"].get(
+            "POOL_SIZE", fallback="0")) or max(
+                self.threads_count, self.async_in_flight, 10)
+        self.max_body_bytes = int(config["CONNECTION"].get(
+            "MAX_BODY_BYTES", fallback="10485760"))
+        self.oversize_bodies = config["CONNECTION"].get(
+            "OVERSIZE_BODIES", fallback="skip").strip().lower()
+        assert self.oversize_bodies in ("skip", "truncate"), (
+            "OVERSIZE_BODIES should be skip or truncate")
 
         self.seed_urls = config["CRAWLER"]["SEEDURL"].split(",")
         self.time_delay = float(config["CRAWLER"]["POLITENESS"])
+        self.max_time_delay = float(config["CRAWLER"].get(
+            "POLITENESS_MAX", fallback="30"))
+        self.near_duplicate_distance = int(config["CRAWLER"].get(
+            "NEAR_DUPLICATE_DISTANCE", fallback="3"))
+        self.trap_min_pages = int(config["CRAWLER"].get(
+            "TRAP_MIN_PAGES", fallback="20"))
+        self.trap_min_yield = float(config["CRAWLER"].get(
+            "TRAP_MIN_YIELD", fallback="0.1"))
+        self.trap_max_duplicates = float(config["CRAWLER"].get(
+            "TRAP_MAX_DUPLICATES", fallback="0.8"))
+        self.trap_probation_pages = int(config["CRAWLER"].get(
+            "TRAP_PROBATION_PAGES", fallback="500"))
+        self.word_counter = config["CRAWLER"].get(
+            "WORD_COUNTER", fallback="exact").strip().lower()
+        assert self.word_counter in ("exact", "bounded"), (
+            "WORD_COUNTER should be exact or bounded")
+        self.word_counter_capacity = int(config["CRAWLER"].get(
+            "WORD_COUNTER_CAPACITY", fallback="10000"))
+        self.robots_ttl = float(config["CRAWLER"].get(
+            "ROBOTS_TTL", fallback="86400"))
+        self.max_sitemaps = int(config["CRAWLER"].get(
+            "MAX_SITEMAPS", fallback="10"))
+        self.max_sitemap_urls = int(config["CRAWLER"].get(
+            "MAX_SITEMAP_URLS", fallback="50000"))
+        self.tracking_params = [
+            param.strip().lower() for param in config["CRAWLER"].get(
+                "TRACKING_PARAMS", fallback=",".join(TRACKING_PARAMS)
+            ).split(",") if param.strip()]
 
         self.cache_server = None
\ No newline at end of file
@@ -1,21 +1,164 @@
 import requests
 import cbor
-import time
+
+from threading import Lock
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from utils.response import Response
 
-def download(url, config, logger=None):
-    host, port = config.cache_server
-    resp = requests.get(
-        f"http://{host}:{port}/",
-        params=[("q", f"{url}"), ("u", f"{config.user_agent}")])
+# Transient cache server statuses that are retried with backoff.
+RETRY_STATUSES = (500, 502, 503, 504)
+# Status of the Response for a url the cache server could not be reached for.
+UNREACHABLE_STATUS = 0
+# Status of the Response for a page over MAX_BODY_BYTES that was skipped.
+TOO_LARGE_STATUS = 413
+# Room for the cbor and pickle wrapping around a page's body, and for the
+# headers, when comparing a cache server response to MAX_BODY_BYTES.
+ENVELOPE_BYTES = 65536
+CHUNK_BYTES = 65536
+
+_session = None
+_session_lock = Lock()
+
+
+def get_session(config):
+    ''' The Session shared by every worker, so connections to the cache
+    server are pooled and kept alive. '''
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                retry = Retry(
+                    total=config.download_retries,
+                    backoff_factor=config.download_backoff,
+                    status_forcelist=RETRY_STATUSES,
+                    raise_on_status=False)
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=config.download_pool_size,
+                    max_retries=retry)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+
+def decode(status, content, url, logger=None, config=None):
     try:
-        if resp and resp.content:
-            return Response(cbor.loads(resp.content))
+        if status < 400 and content:
+            if config is None:
+                return Response(cbor.loads(content))
+            return Response(
+                cbor.loads(content), config.max_body_bytes,
+                truncate=config.oversize_bodies == "truncate")
     except (EOFError, ValueError) as e:
         pass
-    logger.error(f"Spacetime Response error {resp} with url {url}.")
+    if logger:
+        logger.error(f"Spacetime Response error <{status}> with url {url}.")
+    return Response({
+        "error": f"Spacetime Response error <{status}> with url {url}.",
+        "status": status,
+        "url": url})
+
+
+def unreachable(url, error, logger=None):
+    if logger:
+        logger.error(f"Cache server unreachable ({error}) with url {url}.")
+    return Response({
+        "error": f"Cache server unreachable ({error}) with url {url}.",
+        "status": UNREACHABLE_STATUS,
+        "url": url})
+
+
+def too_large(url, size, logger=None):
+    if logger:
+        logger.info(f"Skipped {url}, over {size} bytes.")
     return Response({
-        "error": f"Spacetime Response error {resp} with url {url}.",
-        "status": resp.status_code,
+        "error": f"Response over {size} bytes with url {url}.",
+        "status": TOO_LARGE_STATUS,
         "url": url})
+
+
+def body_limit(config):
+    ''' Bytes of cache server response past which the page is skipped
+    unread, or 0 to read responses whatever their size. '''
+    if not config.max_body_bytes or config.oversize_bodies != "skip":
+        return 0
+    return config.max_body_bytes + ENVELOPE_BYTES
+
+
+def read_capped(resp, limit):
+    ''' The body of a streamed requests.Response, or None, with the
+    connection closed, once it is known to be over limit bytes. '''
+    if int(resp.headers.get("Content-Length") or 0) > limit:
+        resp.close()
+        return None
+    chunks = list()
+    size = 0
+    for chunk in resp.iter_content(CHUNK_BYTES):
+        size += len(chunk)
+        if size > limit:
+            resp.close()
+            return None
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def download(url, config, logger=None):
+    host, port = config.cache_server
+    limit = body_limit(config)
+    try:
+        resp = get_session(config).get(
+            f"http://{host}:{port}/",
+            params=[("q", f"{url}"), ("u", f"{config.user_agent}")],
+            timeout=(config.connect_timeout, config.read_timeout),
+            stream=True)
+        content = read_capped(resp, limit) if limit else resp.content
+    except requests.RequestException as e:
+        return unreachable(url, e, logger)
+    if content is None:
+        return too_large(url, config.max_body_bytes, logger)
+    return decode(resp.status_code, content, url, logger, config)
+
+
+async def download_async(session, url, config, logger=None):
+    ''' download() for an aiohttp ClientSession, with the same timeouts and
+    retry policy. Many of these can be in flight on one event loop. '''
+    import asyncio
+    import aiohttp
+    host, port = config.cache_server
+    timeout = aiohttp.ClientTimeout(
+        sock_connect=config.connect_timeout, sock_read=config.read_timeout)
+    limit = body_limit(config)
+    for attempt in range(config.download_retries + 1):
+        backoff = config.download_backoff * (2 ** attempt)
+        try:
+            async with session.get(
+                    f"http://{host}:{port}/",
+                    params=[("q", f"{url}"), ("u", f"{config.user_agent}")],
+                    timeout=timeout) as resp:
+                if (resp.status in RETRY_STATUSES
+                        and attempt < config.download_retries):
+                    await asyncio.sleep(backoff)
+                    continue
+                if not limit:
+                    content = await resp.read()
+                elif (resp.content_length or 0) > limit:
+                    content = None
+                else:
+                    chunks = list()
+                    size = 0
+                    async for chunk in resp.content.iter_chunked(CHUNK_BYTES):
+                        size += len(chunk)
+                        if size > limit:
+                            break
+                        chunks.append(chunk)
+                    content = b"".join(chunks) if size <= limit else None
+                if content is None:
+                    resp.close()
+                    return too_large(url, config.max_body_bytes, logger)
+                return decode(resp.status, content, url, logger, config)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt == config.download_retries:
+                return unreachable(url, e, logger)
+            await asyncio.sleep(backoff)
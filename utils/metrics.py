@@ -0,0 +1,339 @@
+import json
+import math
+import os
+import signal
+import sys
+import time
+
+from collections import Counter, deque
+from threading import Thread, Lock, Event, get_ident
+from urllib.parse import urlparse, parse_qs
+
+from utils import get_logger
+
+# Histogram buckets grow by 2^(1/4), ~19% apart, from 10us to ~3 minutes.
+_BUCKET_BASE = 1e-5
+_BUCKETS_PER_DOUBLING = 4
+_BUCKET_COUNT = 96
+
+
+class Histogram(object):
+    ''' Latencies in seconds, in log spaced buckets: fixed memory however
+    many are observed, percentiles accurate to a bucket (~19%). '''
+
+    def __init__(self):
+        self.buckets = [0] * _BUCKET_COUNT
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = Lock()
+
+    def observe(self, seconds):
+        bucket = 0
+        if seconds > _BUCKET_BASE:
+            bucket = min(
+                _BUCKET_COUNT - 1,
+                int(math.log2(seconds / _BUCKET_BASE) * _BUCKETS_PER_DOUBLING))
+        with self._lock:
+            self.buckets[bucket] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, fraction):
+        ''' Upper bound of the bucket holding the given fraction. '''
+        with self._lock:
+            rank = fraction * self.count
+            seen = 0
+            for bucket, count in enumerate(self.buckets):
+                seen += count
+                if count and seen >= rank:
+                    return min(self.max, _BUCKET_BASE * 2 ** (
+                        (bucket + 1) / _BUCKETS_PER_DOUBLING))
+        return 0.0
+
+    def drain(self):
+        ''' Returns the observations as a small picklable state, nonzero
+        buckets only, and starts over. See merge(). '''
+        with self._lock:
+            state = (
+                {bucket: count for bucket, count in enumerate(self.buckets)
+                 if count},
+                self.count, self.total, self.max)
+            self.buckets = [0] * _BUCKET_COUNT
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+        return state
+
+    def merge(self, state):
+        ''' Adds observations drained from another histogram. '''
+        buckets, count, total, largest = state
+        with self._lock:
+            for bucket, n in buckets.items():
+                self.buckets[bucket] += n
+            self.count += count
+            self.total += total
+            if largest > self.max:
+                self.max = largest
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "total_s": round(self.total, 6),
+            "mean_ms": round(self.total / self.count * 1000, 3)
+            if self.count else 0.0,
+            "p50_ms": round(self.percentile(0.5) * 1000, 3),
+            "p90_ms": round(self.percentile(0.9) * 1000, 3),
+            "p99_ms": round(self.percentile(0.99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3)}
+
+
+class Metrics(object):
+    ''' Stage latency histograms, counters and gauges of one crawl process.
+
+    Stages are timed with `with metrics.timer("download"):` or observe().
+    Gauges are callables read when a snapshot is taken, e.g. queue depth.
+    Counters named in `rates` also get a per second rate over about the
+    last `recent_seconds`, the same for every reader of the snapshots: the
+    file writer and /metrics requests don't reset each other's baseline. '''
+
+    rates = ("pages",)
+    recent_seconds = 10.0
+
+    def __init__(self):
+        self.started = time.time()
+        self._histograms = dict()
+        self._counters = Counter()
+        self._gauges = dict()
+        self._lock = Lock()
+        # (monotonic time, counters) taken by snapshots, at most one a
+        # second. The oldest is the baseline of the recent rates.
+        self._samples = deque([(time.monotonic(), Counter())])
+
+    def histogram(self, stage):
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(stage, Histogram())
+        return histogram
+
+    def observe(self, stage, seconds):
+        self.histogram(stage).observe(seconds)
+
+    def timer(self, stage):
+        return _Timer(self.histogram(stage))
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] += n
+
+    def gauge(self, name, read):
+        self._gauges[name] = read
+
+    def drain_stages(self):
+        ''' Stage timings observed since the last call, picklable, for a
+        process whose metrics are never read (a parse process) to send to
+        the crawl's. See merge_stages(). '''
+        with self._lock:
+            histograms = list(self._histograms.items())
+        return {
+            stage: histogram.drain() for stage, histogram in histograms
+            if histogram.count}
+
+    def merge_stages(self, stages):
+        for stage, state in stages.items():
+            self.histogram(stage).merge(state)
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            counters = Counter(self._counters)
+            histograms = dict(self._histograms)
+            samples = self._samples
+            # Drops samples while the next one is old enough to be the
+            # baseline, then keeps this one if a second has passed.
+            while (len(samples) > 1
+                    and now - samples[1][0] >= self.recent_seconds):
+                samples.popleft()
+            last_time, last_counters = samples[0]
+            if now - samples[-1][0] >= 1.0:
+                samples.append((now, counters))
+        elapsed = time.time() - self.started
+        interval = max(now - last_time, 1e-9)
+        gauges = dict()
+        for name, read in list(self._gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception as e:
+                gauges[name] = repr(e)
+        return {
+            "time": time.time(),
+            "uptime_s": round(elapsed, 3),
+            "counters": dict(counters),
+            "rates": {
+                name: {
+                    "overall_per_s": round(counters[name] / elapsed, 3),
+                    "recent_per_s": round(
+                        (counters[name] - last_counters[name]) / interval, 3)}
+                for name in self.rates},
+            "gauges": gauges,
+            "stages": {
+                stage: histogram.summary()
+                for stage, histogram in sorted(histograms.items())}}
+
+
+class _Timer(object):
+    # A class rather than contextlib.contextmanager, which costs a few
+    # microseconds more per stage.
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+metrics = Metrics()
+
+
+def sample_stacks(seconds, interval=0.005):
+    ''' Samples the stacks of all other threads for `seconds`. Returns a
+    Counter of collapsed stacks ("outer;...;inner" -> samples), the input
+    format of flamegraph.pl and speedscope. Costs nothing outside a call. '''
+    stacks = Counter()
+    me = get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread, frame in sys._current_frames().items():
+            if thread == me:
+                continue
+            names = list()
+            while frame is not None:
+                code = frame.f_code
+                names.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                    f":{frame.f_lineno})")
+                frame = frame.f_back
+            stacks[";".join(reversed(names))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def format_stacks(stacks, top=None):
+    return "".join(
+        f"{stack} {samples}\n" for stack, samples in stacks.most_common(top))
+
+
+class MetricsReporter(object):
+    ''' Writes metrics.snapshot() as json to a file every `interval`
+    seconds and/or serves it on http://127.0.0.1:<port>/metrics.
+    /profile?seconds=N answers with the hot stacks of that window. With
+    a profile_dir, SIGUSR1 writes them to a file there instead. '''
+
+    def __init__(
+            self, path="", interval=10.0, port=0, profile_seconds=10.0,
+            profile_dir=None):
+        self.logger = get_logger("METRICS")
+        self.path = path
+        self.interval = interval
+        self.profile_seconds = profile_seconds
+        self.profile_dir = profile_dir
+        self._closed = Event()
+        self._writer = None
+        self._server = None
+        if path:
+            self._writer = Thread(target=self._run, daemon=True)
+            self._writer.start()
+        if port:
+            # Only imported when metrics are served, it is slow to import.
+            from http.server import ThreadingHTTPServer
+            self._server = ThreadingHTTPServer(
+                ("127.0.0.1", port), _handler(self))
+            self._server.daemon_threads = True
+            Thread(target=self._server.serve_forever, daemon=True).start()
+            self.logger.info(f"Serving metrics on 127.0.0.1:{port}/metrics.")
+        if profile_dir is not None and hasattr(signal, "SIGUSR1"):
+            try:
+                signal.signal(signal.SIGUSR1, self._on_signal)
+            except ValueError:
+                # Only the main thread can install handlers.
+                pass
+
+    def _run(self):
+        while not self._closed.wait(self.interval):
+            self.write()
+
+    def write(self):
+        with open(f"{self.path}.tmp", "w") as out:
+            json.dump(metrics.snapshot(), out, indent=1)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def _on_signal(self, signum, frame):
+        Thread(target=self.write_profile, daemon=True).start()
+
+    def write_profile(self):
+        path = os.path.join(
+            self.profile_dir, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.txt")
+        with open(path, "w") as out:
+            out.write(format_stacks(sample_stacks(self.profile_seconds)))
+        self.logger.info(f"Wrote {self.profile_seconds}s of stacks to {path}.")
+
+    def close(self):
+        self._closed.set()
+        if self._writer:
+            self._writer.join()
+            self.write()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def _handler(reporter):
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body, content_type):
+            body = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            if parsed.path == "/metrics":
+                self._send(
+                    200, json.dumps(metrics.snapshot(), indent=1),
+                    "application/json")
+            elif parsed.path == "/profile":
+                query = parse_qs(parsed.query)
+                seconds = float(
+                    query.get("seconds", [reporter.profile_seconds])[0])
+                self._send(
+                    200, format_stacks(sample_stacks(seconds)), "text/plain")
+            else:
+                self._send(404, "Not found\n", "text/plain")
+
+    return MetricsHandler
+
+
+def start_reporter(config):
+    ''' A MetricsReporter as set up in config.ini, or None if neither
+    METRICS_FILE nor METRICS_PORT is set. '''
+    if not config.metrics_file and not config.metrics_port:
+        return None
+    return MetricsReporter(
+        config.metrics_file, config.metrics_interval, config.metrics_port,
+        config.profile_seconds,
+        profile_dir=os.path.dirname(os.path.abspath(
+            config.metrics_file or config.save_file)))
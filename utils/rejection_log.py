@@ -0,0 +1,123 @@
+import atexit
+import os
+import random
+
+from collections import Counter
+from queue import SimpleQueue
+from threading import Thread, Lock, Event
+from urllib.parse import urlparse
+
+
+class RejectionLog(object):
+    ''' Background writer for rejected urls.
+
+    record() only enqueues. A writer thread drains the queue in batches,
+    counts every record per reason and per host, and appends a sample of
+    them (sample_rate, 1.0 keeps all) to the log file as "url\\treason"
+    lines. The file is rotated to path.1 ... path.<backups> once it would
+    grow past max_bytes (0 disables rotation). '''
+
+    def __init__(
+            self, path, max_bytes=10 * 1024 * 1024, backups=3,
+            sample_rate=1.0, batch_size=1000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.reasons = Counter()
+        self.hosts = Counter()
+        self._queue = SimpleQueue()
+        self._counts_lock = Lock()
+        self._start_lock = Lock()
+        self._writer = None
+
+    def configure(self, config):
+        self.path = config.reject_log
+        self.max_bytes = config.reject_log_max_bytes
+        self.backups = config.reject_log_backups
+        self.sample_rate = config.reject_log_sample
+
+    def record(self, url, reason):
+        if self._writer is None:
+            self._start()
+        self._queue.put((url, reason))
+
+    def _start(self):
+        with self._start_lock:
+            if self._writer is None:
+                self._writer = Thread(target=self._run, daemon=True)
+                self._writer.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get())
+            lines = list()
+            waiters = list()
+            reasons, hosts = Counter(), Counter()
+            for item in batch:
+                if isinstance(item, Event):
+                    waiters.append(item)
+                    continue
+                url, reason = item
+                reasons[reason] += 1
+                hosts[urlparse(url).netloc.lower()] += 1
+                if self.sample_rate >= 1 or random.random() < self.sample_rate:
+                    lines.append(f"{url}\t{reason}\n")
+            with self._counts_lock:
+                self.reasons.update(reasons)
+                self.hosts.update(hosts)
+            if lines:
+                self._write("".join(lines))
+            for waiter in waiters:
+                waiter.set()
+
+    def _write(self, data):
+        data = data.encode("utf-8")
+        if (self.max_bytes and os.path.exists(self.path)
+                and os.path.getsize(self.path) + len(data) > self.max_bytes):
+            self._rotate()
+        with open(self.path, "ab") as log:
+            log.write(data)
+
+    def _rotate(self):
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def flush(self, timeout=None):
+        ''' Blocks until everything recorded so far is counted and written. '''
+        if self._writer is None:
+            return
+        done = Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def counts(self):
+        with self._counts_lock:
+            return Counter(self.reasons), Counter(self.hosts)
+
+    def merge_counts(self, reasons, hosts):
+        ''' Adds counts() taken from another process. '''
+        with self._counts_lock:
+            self.reasons.update(reasons)
+            self.hosts.update(hosts)
+
+    def write_report(self, top=20):
+        self.flush()
+        reasons, hosts = self.counts()
+        print("\n===== REJECTED URLS =====")
+        print(f"Total rejected: {sum(reasons.values())}")
+        print("\nBy reason:")
+        for reason, count in reasons.most_common():
+            print(f"{reason}\t{count}")
+        print(f"\nTop {top} hosts:")
+        for host, count in hosts.most_common(top):
+            print(f"{host}\t{count}")
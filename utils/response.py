@@ -1,14 +1,149 @@
 import pickle
+import struct
+
+# How a pickled requests.Response holds its body: the "_content" key of its
+# state (SHORT_BINUNICODE from protocol 4, BINUNICODE before), an optional
+# memo opcode, then the bytes (SHORT_BINBYTES, BINBYTES or BINBYTES8).
+_CONTENT_KEYS = (b"\x8c\x08_content", b"X\x08\x00\x00\x00_content")
+_MEMO_LENGTHS = {0x94: 1, ord("q"): 2, ord("r"): 5}
+_BYTES_LENGTHS = {ord("C"): "<B", ord("B"): "<I", 0x8e: "<Q"}
+_FRAME = 0x95
+_FRAME_LENGTH = struct.Struct("<Q")
+
+
+def _locate_body(pickled):
+    # (opcode, start, end, frame) of the body's bytes opcode in the pickle,
+    # where frame is the offset of the FRAME opcode holding it or None, or
+    # None if the pickle is not laid out as expected (protocol 2 pickles
+    # bytes as text, for one).
+    for key in _CONTENT_KEYS:
+        position = pickled.find(key)
+        if position >= 0:
+            break
+    else:
+        return None
+    opcode = position + len(key)
+    if opcode < len(pickled):
+        opcode += _MEMO_LENGTHS.get(pickled[opcode], 0)
+    if opcode >= len(pickled) or pickled[opcode] not in _BYTES_LENGTHS:
+        return None
+    length = struct.Struct(_BYTES_LENGTHS[pickled[opcode]])
+    start = opcode + 1 + length.size
+    end = start + length.unpack_from(pickled, opcode + 1)[0]
+    if end > len(pickled):
+        return None
+    # Frames (protocol 4+) hold whole opcodes and follow each other. Bodies
+    # over the frame size are written between frames.
+    frame = None
+    position = 2
+    while position < len(pickled) and pickled[position] == _FRAME:
+        frame_end = (position + 1 + _FRAME_LENGTH.size
+                     + _FRAME_LENGTH.unpack_from(pickled, position + 1)[0])
+        if opcode < frame_end:
+            if end > frame_end:
+                return None
+            frame = position
+            break
+        position = frame_end
+    return opcode, start, end, frame
+
+
+def _without_body(pickled, location):
+    # The pickle with an empty body in place of the one at location.
+    opcode, start, end, frame = location
+    empty = b"C\x00"
+    pickled = b"".join((pickled[:opcode], empty, memoryview(pickled)[end:]))
+    if frame is not None:
+        # The frame holding the body shrinks with it.
+        length = (_FRAME_LENGTH.unpack_from(pickled, frame + 1)[0]
+                  - (end - opcode) + len(empty))
+        pickled = b"".join((
+            pickled[:frame + 1], _FRAME_LENGTH.pack(length),
+            memoryview(pickled)[frame + 1 + _FRAME_LENGTH.size:]))
+    return pickled
+
 
 class Response(object):
-    def __init__(self, resp_dict):
+    ''' A cache server response. The page is a pickled requests.Response.
+    Its status and headers are unpickled when headers or raw_response is
+    first read, without the body: it is only copied out of the pickle,
+    and cut to max_body first, when raw_response is read. Responses dropped
+    on their status, size or content type never materialize it.
+
+    max_body: bodies over this many bytes are cut to it, or with truncate
+    False dropped, leaving raw_response None. '''
+
+    def __init__(self, resp_dict, max_body=0, truncate=True):
         self.url = resp_dict["url"]
         self.status = resp_dict["status"]
         self.error = resp_dict["error"] if "error" in resp_dict else None
-        try:
-            self.raw_response = (
-                pickle.loads(resp_dict["response"])
-                if "response" in resp_dict else
-                None)
-        except TypeError:
-            self.raw_response = None
+        self.max_body = max_body
+        self.truncate = truncate
+        self.truncated = False
+        self._pickled = resp_dict.get("response")
+        self._body = None
+        self._head = None
+        self._raw_response = None
+        if self._pickled is not None:
+            self._body = _locate_body(self._pickled)
+
+    def _unpickle_head(self):
+        # The requests.Response with an empty body, or with its body when
+        # the pickle could not be split.
+        if self._head is None and self._pickled is not None:
+            pickled = self._pickled
+            if self._body is not None:
+                pickled = _without_body(pickled, self._body)
+            try:
+                self._head = pickle.loads(pickled)
+            except TypeError:
+                self._pickled = self._body = None
+        return self._head
+
+    @property
+    def headers(self):
+        ''' Headers of the page, or None if there is no page. Reading them
+        leaves the body in the pickle. '''
+        raw = (self._raw_response if self._pickled is None
+               else self._unpickle_head())
+        return getattr(raw, "headers", None)
+
+    @property
+    def raw_response(self):
+        if self._pickled is not None:
+            raw = self._unpickle_head()
+            if raw is not None:
+                if self._body is not None:
+                    _, start, end, _ = self._body
+                    source = self._pickled
+                else:
+                    # Not split, unpickled with its body
+                    source = getattr(raw, "_content", None) or b""
+                    start, end = 0, len(source)
+                if self.max_body and end - start > self.max_body:
+                    self.truncated = True
+                    end = start + self.max_body
+                    if not self.truncate:
+                        raw = None
+                if raw is not None:
+                    raw._content = source[start:end]
+            self._raw_response = raw
+            self._pickled = self._body = self._head = None
+        return self._raw_response
+
+    @raw_response.setter
+    def raw_response(self, raw_response):
+        self._pickled = self._body = self._head = None
+        self._raw_response = raw_response
+
+    @property
+    def size(self):
+        ''' Bytes of the page's body. '''
+        if self._body is not None:
+            _, start, end, _ = self._body
+            return end - start
+        if self._pickled is not None:
+            # Not split, about the size of the body
+            return len(self._pickled)
+        content = getattr(self._raw_response, "content", None)
+        return len(content) if content else 0
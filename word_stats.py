@@ -1,9 +1,17 @@
 from collections import Counter, defaultdict
+from contextlib import ExitStack
+import os
+import pickle
+import struct
 import threading
+import zlib
 from threading import Lock
-from bs4 import BeautifulSoup
-from tokenizer import tokenize_text
-from urllib.parse import urldefrag, urlparse
+from document import parse_document
+from heavy_hitters import SpaceSaving
+from seen_set import DigestSet, url_digest
+from tokenizer import iter_tokens
+from urllib.parse import urlparse
+from utils.canonical import canonicalize
 
 
 STOP_WORDS = {
@@ -14,67 +22,337 @@ STOP_WORDS = {
     "should","would","do","does","did"
 }
 
-_counter = Counter()
-_lock = Lock()
-unique_pages = set()
-subdomains_count = defaultdict(int)
-subdomains_lock = threading.Lock()
+# Word counts and the longest page are kept per worker thread in a _Shard,
+# so pages never wait on each other, and merged when a report is written.
+# Unique pages are shared, under pages_lock, as 64-bit url digests grouped
+# by host. Subdomain counts are the sizes of the groups.
+pages_by_host = defaultdict(DigestSet)
+pages_lock = Lock()
 
-longest_page_url = None
-longest_page_word_count = 0
+# exact   -> a Counter per shard, grows with the vocabulary.
+# bounded -> a SpaceSaving summary per shard, see heavy_hitters.py.
+counter_mode = "exact"
+counter_capacity = 10000
 
+_shards = list()
+_shards_lock = Lock()
+_generation = 0
+_local = threading.local()
 
-def update_from_html(url, html_bytes):
-    global longest_page_url
-    global longest_page_word_count
-    global unique_pages
+# Checkpoints, see configure(). Shards hold the counts since the last one,
+# _base everything checkpointed before. Each record is headed by its
+# length, crc and the counter mode it was written in.
+_CHECKPOINT_HEADER = struct.Struct("<IIB")
+_COUNTER_MODES = ("exact", "bounded")
+_base = {"counter": None, "longest_page": (None, 0)}
+_new_pages = list()
+_restored_pages = dict()
+_checkpoint_file = None
+_checkpoint_fsync = False
+_checkpoint_lock = Lock()
+
+
+class _Shard(object):
+    def __init__(self):
+        self.generation = _generation
+        self.counter = _new_counter()
+        self.longest_page = (None, 0)
+        # Only contended while a report or checkpoint goes over the shards
+        self.lock = Lock()
+
+
+def _new_counter():
+    if counter_mode == "bounded":
+        return SpaceSaving(counter_capacity)
+    return Counter()
+
+
+def _merge_counter(counter, other):
+    if isinstance(counter, SpaceSaving):
+        counter.merge(other)
+    else:
+        counter.update(other)
+
+
+def _convert_counter(counter):
+    # A checkpoint written with the other WORD_COUNTER. Exact counts are
+    # added to a summary word by word; a summary's counts are upper bounds,
+    # so an exact report resumed from one stays approximate for its words.
+    converted = _new_counter()
+    if isinstance(counter, SpaceSaving):
+        converted.update({
+            word: count for word, count, _ in counter.most_common()})
+    else:
+        converted.update(counter)
+    return converted
+
+
+def _shard():
+    shard = getattr(_local, "shard", None)
+    if shard is None or shard.generation != _generation:
+        shard = _local.shard = _Shard()
+        with _shards_lock:
+            _shards.append(shard)
+    return shard
+
+
+def _add_pages(pages):
+    # Adds (host, digest) pairs. Callers hold pages_lock
+    for netloc, digest in pages:
+        pages_by_host[netloc].add(digest)
+
+
+def _iter_pages():
+    for netloc, digests in pages_by_host.items():
+        for digest in digests:
+            yield netloc, digest
+
+
+def unique_page_count():
+    return sum(len(digests) for digests in pages_by_host.values())
+
+
+def subdomain_counts():
+    return {
+        netloc: len(digests) for netloc, digests in pages_by_host.items()
+        if netloc.endswith("uci.edu")}
+
+
+def configure_counter(config):
+    # Sets the counter mode, clearing the stats
+    global counter_mode
+    global counter_capacity
+
+    counter_mode = config.word_counter
+    counter_capacity = config.word_counter_capacity
+    reset()
+
+
+def configure(config, restart=True):
+    # Sets the counter mode and, unless restarting, loads the analytics
+    # checkpointed by an earlier run of the same save file.
+    global _checkpoint_file
+    global _checkpoint_fsync
 
+    close()
+    configure_counter(config)
+
+    path = f"{config.save_file}.stats"
+    if restart and os.path.exists(path):
+        os.remove(path)
+    if os.path.exists(path):
+        _load_checkpoints(path)
+        _restored_pages.update(
+            (netloc, digests.copy())
+            for netloc, digests in pages_by_host.items())
+        # One record with the whole state replaces the deltas
+        with open(f"{path}.tmp", "wb") as snapshot:
+            snapshot.write(_encode_checkpoint(
+                _base["counter"], list(_iter_pages()),
+                _base["longest_page"]))
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(f"{path}.tmp", path)
+    _checkpoint_fsync = config.save_durability != "none"
+    _checkpoint_file = open(path, "ab")
+
+
+def _encode_checkpoint(counter, pages, longest_page):
+    data = zlib.compress(pickle.dumps(
+        (counter, pages, longest_page), pickle.HIGHEST_PROTOCOL), 1)
+    mode = _COUNTER_MODES.index(
+        "bounded" if isinstance(counter, SpaceSaving) else "exact")
+    return _CHECKPOINT_HEADER.pack(len(data), zlib.crc32(data), mode) + data
+
+
+def _load_checkpoints(path):
+    with open(path, "rb") as saved:
+        data = saved.read()
+    offset = 0
+    while offset + _CHECKPOINT_HEADER.size <= len(data):
+        length, crc, mode = _CHECKPOINT_HEADER.unpack_from(data, offset)
+        offset += _CHECKPOINT_HEADER.size
+        record = data[offset:offset + length]
+        if (len(record) < length or zlib.crc32(record) != crc
+                or mode >= len(_COUNTER_MODES)):
+            # Torn write at the tail of the file
+            break
+        offset += length
+        counter, pages, longest_page = pickle.loads(zlib.decompress(record))
+        if _COUNTER_MODES[mode] != counter_mode:
+            counter = _convert_counter(counter)
+        _merge_counter(_base["counter"], counter)
+        with pages_lock:
+            _add_pages(pages)
+        if longest_page[1] > _base["longest_page"][1]:
+            _base["longest_page"] = longest_page
+
+
+def checkpoint():
+    # Appends what changed since the last checkpoint. Runs before each
+    # group commit of the frontier (Frontier.on_commit), so every page
+    # committed as completed has its words on disk. Pages that were
+    # checkpointed but not committed are skipped when crawled again.
+    with _checkpoint_lock:
+        if _checkpoint_file is None:
+            return
+        with _shards_lock:
+            shards = list(_shards)
+        with ExitStack() as stack:
+            for shard in shards:
+                stack.enter_context(shard.lock)
+            stack.enter_context(pages_lock)
+            counters = list()
+            longest_page = _base["longest_page"]
+            for shard in shards:
+                counters.append(shard.counter)
+                shard.counter = _new_counter()
+                if shard.longest_page[1] > longest_page[1]:
+                    longest_page = shard.longest_page
+            pages = list(_new_pages)
+            _new_pages.clear()
+        if not pages and not any(counters):
+            return
+        delta = _new_counter()
+        for counter in counters:
+            _merge_counter(delta, counter)
+        _checkpoint_file.write(_encode_checkpoint(delta, pages, longest_page))
+        _checkpoint_file.flush()
+        if _checkpoint_fsync:
+            os.fsync(_checkpoint_file.fileno())
+        _merge_counter(_base["counter"], delta)
+        _base["longest_page"] = longest_page
+
+
+def close():
+    global _checkpoint_file
+
+    checkpoint()
+    with _checkpoint_lock:
+        if _checkpoint_file is not None:
+            _checkpoint_file.close()
+            _checkpoint_file = None
+
+
+def update_from_html(url, html_bytes):
     if not html_bytes:
         return
 
-    soup = BeautifulSoup(html_bytes, "lxml")
+    update_from_document(parse_document(url, html_bytes))
 
-    # Remove scripts/styles
-    for tag in soup(["script", "style", "noscript"]):
-        tag.decompose()
 
-    text = soup.get_text(separator=" ", strip=True)
-    tokens = tokenize_text(text)
-    url_defrag = urldefrag(url)[0]
-    if url_defrag not in unique_pages:
-        unique_pages.add(url_defrag)
+def page_tokens(doc):
+    # Words counted for a page: scripts/styles are already left out of the
+    # document text, stopwords and single characters are filtered while
+    # tokenizing
+    return list(iter_tokens(doc.text, STOP_WORDS, min_length=2))
 
-        
-        netloc = urlparse(url).netloc.lower()
-        if netloc.endswith("uci.edu"):
-            with subdomains_lock:
-                subdomains_count[netloc] += 1
 
-    # Filter stopwords
-    filtered = [t for t in tokens if t not in STOP_WORDS and len(t) > 1]
+def update_from_document(doc, filtered=None):
+    if filtered is None:
+        filtered = page_tokens(doc)
+    update_page(doc.url, filtered, len(filtered))
+
+
+def update_page(url, words, word_count):
+    # words: the page's filtered tokens, or a mapping of token -> count
+    url = canonicalize(url)
+    digest = url_digest(url)
+    netloc = urlparse(url).netloc
+    shard = _shard()
+    # The page and its words go into a checkpoint together
+    with shard.lock:
+        with pages_lock:
+            if digest in _restored_pages.get(netloc, ()):
+                # Counted before the crawl was resumed
+                return
+            if (pages_by_host[netloc].add(digest)
+                    and _checkpoint_file is not None):
+                _new_pages.append((netloc, digest))
+
+        if not word_count:
+            return
+
+        shard.counter.update(words)
+        if word_count > shard.longest_page[1]:
+            shard.longest_page = (url, word_count)
 
-    if not filtered:
-        return
 
-    with _lock:
-        _counter.update(filtered)
+def merged():
+    # (word counter, (longest page url, word count)) over all shards
+    counter = _new_counter()
+    with _checkpoint_lock:
+        _merge_counter(counter, _base["counter"])
+        longest_page = _base["longest_page"]
+    with _shards_lock:
+        shards = list(_shards)
+    for shard in shards:
+        with shard.lock:
+            _merge_counter(counter, shard.counter)
+            if shard.longest_page[1] > longest_page[1]:
+                longest_page = shard.longest_page
+    return counter, longest_page
 
-        if len(filtered) > longest_page_word_count:
-            longest_page_word_count = len(filtered)
-            longest_page_url = url
 
+def export_state():
+    # Everything write_report needs, e.g. to hand to another process
+    counter, longest_page = merged()
+    with pages_lock:
+        return {
+            "counter": counter,
+            "pages_by_host": {
+                netloc: digests.copy()
+                for netloc, digests in pages_by_host.items()},
+            "longest_page": longest_page}
+
+
+def reset():
+    global _generation
+
+    with _shards_lock, pages_lock:
+        _shards.clear()
+        _generation += 1
+        pages_by_host.clear()
+        _new_pages.clear()
+        _restored_pages.clear()
+        _base["counter"] = _new_counter()
+        _base["longest_page"] = (None, 0)
+
+
+def merge_state(state):
+    # Adds the stats exported by another process to this one's
+    shard = _shard()
+    with shard.lock:
+        with pages_lock:
+            # Pages both processes saw are only kept once
+            for netloc, digests in state["pages_by_host"].items():
+                pages_by_host[netloc].add_new(digests)
+        _merge_counter(shard.counter, state["counter"])
+        if state["longest_page"][1] > shard.longest_page[1]:
+            shard.longest_page = state["longest_page"]
 
 
 def write_report():
+    counter, (longest_page_url, longest_page_word_count) = merged()
+
     print("\n===== REPORT =====")
-    print(f"Number of unique pages: {len(unique_pages)}")
+    print(f"Number of unique pages: {unique_page_count()} "
+          f"(kept in {sum(d.nbytes for d in pages_by_host.values()) / 1024:.0f} KB)")
     print(f"Longest page: {longest_page_url}")
     print(f"Word count: {longest_page_word_count}")
 
     print("\nTop 50 words:")
-    for word, count in _counter.most_common(50):
-        print(f"{word}\t{count}")
+    if isinstance(counter, SpaceSaving):
+        # Counts are upper bounds, the true count is at most error lower
+        for word, count, error in counter.most_common(50):
+            print(f"{word}\t{count}\t(-{error})" if error else f"{word}\t{count}")
+        print(f"(approximate, {len(counter)} words kept, "
+              f"words under {counter.floor} may be missing)")
+    else:
+        for word, count in counter.most_common(50):
+            print(f"{word}\t{count}")
 
     print("\nSubdomains:")
-    for sd in sorted(subdomains_count.keys()):
-        print(f"{sd}, {subdomains_count[sd]}")
+    subdomains = subdomain_counts()
+    for sd in sorted(subdomains.keys()):
+        print(f"{sd}, {subdomains[sd]}")